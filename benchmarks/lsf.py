@@ -0,0 +1,22 @@
+"""Benchmark construction of the line spread function matrices on APOGEE-sized grids."""
+
+import numpy as np
+from time import time
+
+from astra.specutils.lsf import instrument_lsf_sparse_matrix, rotational_broadening_sparse_matrix
+
+
+if __name__ == "__main__":
+
+    λ_output = 10**(4.179 + 6e-6 * np.arange(8575))
+    λ_input = np.arange(λ_output[0] - 5, λ_output[-1] + 5, 0.01)
+
+    t_init = time()
+    K = instrument_lsf_sparse_matrix(λ_input, λ_output, 22_500)
+    t_lsf = time() - t_init
+    print(f"instrument_lsf_sparse_matrix ({λ_input.size} x {λ_output.size}, nnz={K.nnz}): {t_lsf:.2f} s")
+
+    t_init = time()
+    K = rotational_broadening_sparse_matrix(λ_input, 10, 0.6)
+    t_rot = time() - t_init
+    print(f"rotational_broadening_sparse_matrix ({λ_input.size} x {λ_input.size}, nnz={K.nnz}): {t_rot:.2f} s")
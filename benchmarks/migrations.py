@@ -0,0 +1,197 @@
+"""
+Benchmark the vectorised migrations in `astra.migrations.misc` on a local SQLite fixture.
+
+The previous approach (per-row Python and `Model.bulk_update`) is timed on a subset of rows, as it is too slow
+to run on the full fixture, and the results of both approaches are compared.
+
+    python benchmarks/migrations.py [N]
+"""
+
+import os
+import sys
+import numpy as np
+from tempfile import TemporaryDirectory
+from time import time
+from peewee import SqliteDatabase, chunked
+from astropy.coordinates import SkyCoord
+from astropy import units as u
+
+from astra.models.source import Source
+from astra.models.aspcap import ASPCAP
+from astra.migrations.misc import (
+    von,
+    GONZALEZ_HERNANDEZ_B_DWARF,
+    GONZALEZ_HERNANDEZ_B_GIANT,
+    GONZALEZ_HERNANDEZ_DWARF_RANGES,
+    GONZALEZ_HERNANDEZ_GIANT_RANGES,
+    compute_gonzalez_hernandez_irfm_effective_temperatures_from_vmk,
+    compute_casagrande_irfm_effective_temperatures,
+    compute_w1mag_and_w2mag,
+    update_galactic_coordinates,
+)
+
+
+def per_row_gonzalez_hernandez_irfm_teff(where, dwarf_giant_logg_split=3.8, batch_size=10_000):
+    q = (
+        ASPCAP
+        .select(ASPCAP, Source)
+        .join(Source, on=(ASPCAP.source_pk == Source.pk), attr="_source")
+        .where(where)
+    )
+    for batch in chunked(q.iterator(), batch_size):
+        for row in batch:
+            X = von(row._source.v_jkc_mag) - von(row._source.k_mag)
+            fe_h, logg = (von(row.fe_h), von(row.logg))
+            is_dwarf = (logg >= dwarf_giant_logg_split)
+            if is_dwarf:
+                B, (valid_v_k, valid_fe_h) = (GONZALEZ_HERNANDEZ_B_DWARF, GONZALEZ_HERNANDEZ_DWARF_RANGES)
+            else:
+                B, (valid_v_k, valid_fe_h) = (GONZALEZ_HERNANDEZ_B_GIANT, GONZALEZ_HERNANDEZ_GIANT_RANGES)
+            row.irfm_teff = 5040 / np.sum(B * np.array([1, X, X**2, X*fe_h, fe_h, fe_h**2]))
+            row.flag_as_dwarf_for_irfm_teff = is_dwarf
+            row.flag_as_giant_for_irfm_teff = not is_dwarf
+            row.flag_out_of_v_k_bounds = not (valid_v_k[0] <= X <= valid_v_k[1])
+            row.flag_out_of_fe_h_bounds = not (valid_fe_h[0] <= fe_h <= valid_fe_h[1])
+            row.flag_extrapolated_v_mag = (row._source.v_jkc_mag_flag == 0)
+            row.flag_poor_quality_k_mag = (
+                (row._source.ph_qual is None)
+            or  (row._source.ph_qual[-1] != "A")
+            or  (row._source.e_k_mag > 0.1)
+            )
+            row.flag_ebv_used_is_upper_limit = row._source.flag_ebv_upper_limit
+        # SQLite limits the number of query parameters, so the CASE statements are built in smaller batches.
+        ASPCAP.bulk_update(batch, fields=[ASPCAP.irfm_teff, ASPCAP.irfm_teff_flags], batch_size=1_000)
+
+
+def per_row_w1mag_and_w2mag(where, batch_size=1000):
+    q = (
+        Source
+        .select(Source.pk, Source.w1_flux, Source.w1_dflux, Source.w2_flux, Source.w2_dflux)
+        .where(where)
+    )
+    for batch in chunked(q, batch_size):
+        for source in batch:
+            source.w1_mag = -2.5 * np.log10(von(source.w1_flux)) + 22.5 - 4 * 1e-3
+            source.e_w1_mag = (2.5 / np.log(10)) * von(source.w1_dflux) / von(source.w1_flux)
+            source.w2_mag = -2.5 * np.log10(von(source.w2_flux)) + 22.5 - 32 * 1e-3
+            source.e_w2_mag = (2.5 / np.log(10)) * von(source.w2_dflux) / von(source.w2_flux)
+        Source.bulk_update(batch, fields=[Source.w1_mag, Source.e_w1_mag, Source.w2_mag, Source.e_w2_mag])
+
+
+def per_row_galactic_coordinates(where, frame="icrs", batch_size=1000):
+    q = Source.select(Source.pk, Source.ra, Source.dec).where(where)
+    for batch in chunked(q, batch_size):
+        coord = SkyCoord(ra=[s.ra for s in batch] * u.degree, dec=[s.dec for s in batch] * u.degree, frame=frame)
+        for source, position in zip(batch, coord.galactic):
+            source.l = position.l.value
+            source.b = position.b.value
+        Source.bulk_update(batch, fields=[Source.l, Source.b])
+
+
+def insert_fixture_rows(model, fields, rows):
+    # Every row gets the default values of the first row, so that rows can be inserted through the cursor.
+    rows = list(rows)
+    sql, params = model.insert_many(rows[:1], fields=fields).sql()
+    defaults = tuple(params[len(fields):])
+    model._meta.database.cursor().executemany(sql, [row + defaults for row in rows])
+
+
+def create_fixture(N, seed=0):
+    rng = np.random.default_rng(seed)
+    k_mag = rng.uniform(6, 14, N)
+    pk = np.arange(1, N + 1)
+    source_rows = zip(
+        pk.tolist(),
+        (k_mag + rng.uniform(0.5, 4, N)).tolist(),
+        k_mag.tolist(),
+        rng.uniform(0.01, 0.15, N).tolist(),
+        rng.integers(0, 2, N).tolist(),
+        rng.choice(["AAA", "AAB", "ABC"], N).tolist(),
+        rng.integers(0, 2, N).tolist(),
+        rng.uniform(0, 360, N).tolist(),
+        np.rad2deg(np.arcsin(rng.uniform(-1, 1, N))).tolist(),
+        *[v.tolist() for v in rng.uniform(10, 1e5, (4, N))],
+    )
+    aspcap_rows = zip(pk.tolist(), pk.tolist(), rng.uniform(0, 5, N).tolist(), rng.uniform(-3, 0.5, N).tolist())
+    with Source._meta.database.atomic():
+        insert_fixture_rows(
+            Source,
+            [
+                Source.pk, Source.v_jkc_mag, Source.k_mag, Source.e_k_mag, Source.v_jkc_mag_flag, Source.ph_qual,
+                Source.ebv_flags, Source.ra, Source.dec, Source.w1_flux, Source.w1_dflux, Source.w2_flux, Source.w2_dflux
+            ],
+            source_rows
+        )
+        insert_fixture_rows(ASPCAP, [ASPCAP.source_pk, ASPCAP.spectrum_pk, ASPCAP.logg, ASPCAP.fe_h], aspcap_rows)
+
+
+def benchmark_irfm_teff(N, N_per_row):
+    t_init = time()
+    compute_gonzalez_hernandez_irfm_effective_temperatures_from_vmk(ASPCAP, ASPCAP.logg, ASPCAP.fe_h)
+    t_vectorized = time() - t_init
+    print(f"compute_gonzalez_hernandez_irfm_effective_temperatures_from_vmk: {t_vectorized:.1f} s ({N / t_vectorized:.0f} rows per second)")
+
+    q = (
+        ASPCAP
+        .select(ASPCAP.irfm_teff, ASPCAP.irfm_teff_flags)
+        .where(ASPCAP.task_pk <= N_per_row)
+        .order_by(ASPCAP.task_pk)
+        .tuples()
+    )
+    expected = list(q)
+    ASPCAP.update(irfm_teff=None, irfm_teff_flags=0).where(ASPCAP.task_pk <= N_per_row).execute()
+
+    t_init = time()
+    per_row_gonzalez_hernandez_irfm_teff(ASPCAP.task_pk <= N_per_row)
+    t_per_row = time() - t_init
+    print(f"Per-row Python and bulk_update ({N_per_row} rows): {t_per_row:.1f} s ({N_per_row / t_per_row:.0f} rows per second)")
+
+    (expected_teff, expected_flags), (actual_teff, actual_flags) = (zip(*expected), zip(*q))
+    print(
+        f"  max |delta irfm_teff| = {np.nanmax(np.abs(np.array(expected_teff) - np.array(actual_teff))):.2e} K, "
+        f"identical flags: {expected_flags == actual_flags}"
+    )
+
+    t_init = time()
+    compute_casagrande_irfm_effective_temperatures(ASPCAP, ASPCAP.fe_h)
+    t_vectorized = time() - t_init
+    print(f"compute_casagrande_irfm_effective_temperatures: {t_vectorized:.1f} s ({N / t_vectorized:.0f} rows per second)")
+
+
+def benchmark_update_columns(N, N_per_row):
+    for update_columns_function, per_row_function, fields in (
+        (compute_w1mag_and_w2mag, per_row_w1mag_and_w2mag, [Source.w1_mag, Source.e_w1_mag, Source.w2_mag, Source.e_w2_mag]),
+        (update_galactic_coordinates, per_row_galactic_coordinates, [Source.l, Source.b]),
+    ):
+        t_init = time()
+        update_columns_function()
+        t_update_columns = time() - t_init
+        print(f"{update_columns_function.__name__} (update_columns): {t_update_columns:.1f} s ({N / t_update_columns:.0f} rows per second)")
+
+        q = Source.select(*fields).where(Source.pk <= N_per_row).order_by(Source.pk).tuples()
+        expected = np.array(list(q), dtype=float)
+        Source.update({ field: None for field in fields }).where(Source.pk <= N_per_row).execute()
+
+        t_init = time()
+        per_row_function(Source.pk <= N_per_row)
+        t_per_row = time() - t_init
+        print(f"Per-row Python and bulk_update ({N_per_row} rows): {t_per_row:.1f} s ({N_per_row / t_per_row:.0f} rows per second)")
+        print(f"  max |delta| = {np.max(np.abs(expected - np.array(list(q), dtype=float))):.2e}")
+
+
+if __name__ == "__main__":
+
+    N = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    N_per_row = min(N, 50_000)
+
+    with TemporaryDirectory() as dir:
+        fixture = SqliteDatabase(os.path.join(dir, "fixture.db"), pragmas=dict(journal_mode="off", synchronous="off"))
+        fixture.bind([Source, ASPCAP])
+        fixture.create_tables([Source, ASPCAP])
+
+        t_init = time()
+        create_fixture(N)
+        print(f"Created fixture with {N} rows in {time() - t_init:.1f} s")
+
+        benchmark_irfm_teff(N, N_per_row)
+        benchmark_update_columns(N, N_per_row)
@@ -12,7 +12,8 @@ from astra.models.source import Source
 from astra.models.base import database
 from astra.utils import expand_path, flatten, log
 
-from astra.migrations.utils import enumerate_new_spectrum_pks, upsert_many
+from astra.migrations.utils import enumerate_new_spectrum_pks, upsert_many, update_from_staging_table
+from astra.migrations.headers import harvest_primary_header_cards, as_int, as_float, DEFAULT_HEADER_CACHE_PATH
 
 
 def copy_doppler_results_from_visit_to_coadd(batch_size: Optional[int] = 100, limit: Optional[int] = None):
@@ -2316,108 +2317,12 @@ def migrate_apvisit_from_sdss5_apogee_drpdb(
     return N
         
 
-def _migrate_apvisit_metadata(apVisits, raise_exceptions=False):
-    def float_or_nan(x):
-        try:
-            return float(x)
-        except:
-            return np.nan
-    keys_dtypes = {
-        "NAXIS1": int,
-        "SNR": float_or_nan,
-        "NCOMBINE": int, 
-        "EXPTIME": float_or_nan,
-    }
-    K = len(keys_dtypes)
-    keys_str = "|".join([f"({k})" for k in keys_dtypes.keys()])
-
-    # 80 chars per line, 150 lines -> 12000
-    command_template = " | ".join([
-        'hexdump -n 12000 -e \'80/1 "%_p" "\\n"\' {path}',
-        f'egrep "{keys_str}"',
-        f"head -n {K}"
-    ])
-    commands = ""
-    for apVisit in apVisits:
-        path = expand_path(apVisit.path)
-        commands += f"{command_template.format(path=path)}\n"
-    
-    outputs = subprocess.check_output(commands, shell=True, text=True)
-    outputs = outputs.strip().split("\n")
-
-    index, all_metadata = (0, {})
-    for line in outputs:
-        all_metadata.setdefault(apVisits[index].spectrum_pk, {})
-        key, value = line.split("=")
-        key, value = (key.strip(), value.split()[0].strip(" '"))
-        value = keys_dtypes[key](value)
-        if key == "NAXIS1":
-            # @Nidever: "if there’s 2048 then it hasn’t been dithered, if it’s 4096 then it’s dithered."
-            all_metadata[apVisits[index].spectrum_pk]["dithered"] = (value == 4096)
-            index += 1            
-        elif key == "NCOMBINE":
-            all_metadata[apVisits[index].spectrum_pk]["n_frames"] = value
-        else:
-            all_metadata[apVisits[index].spectrum_pk][key.lower()] = value
-            
-        
-    '''
-    if len(outputs) != (K * len(apVisits)):
-
-        if raise_exceptions:
-            raise OSError(f"Unexpected outputs from `hexdump` on {apVisits}")
-
-        log.warning(f"Unexpected length of outputs from `hexdump`!")
-        log.warning(f"Running this chunk one-by-one to be sure... this chunk goes from {apVisits[0]} to {apVisits[-1]}")
-        
-        # Do it manually
-        all_metadata = {}
-        for apVisit in apVisits:
-            try:
-                this_metadata = _migrate_apvisit_metadata([apVisit], raise_exceptions=True)
-            except OSError:
-                log.exception(f"Exception on {apVisit}:")
-                # Failure mode values.
-                all_metadata[apVisit.spectrum_pk] = (False, -1, -1, None)
-                if raise_exceptions:
-                    raise
-                continue
-            else:
-                all_metadata.update(this_metadata)    
-        
-        log.info(f"Finished chunk that goes from {apVisits[0]} to {apVisits[-1]} one-by-one")
-
-    else:
-        all_metadata = {}
-        for apVisit, output in zip(apVisits, chunked(outputs, K)):
-            metadata = {}
-            for line in output:
-                key, value = line.split("=")
-                key, value = (key.strip(), value.split()[0].strip(" '"))
-                if key in metadata:
-                    log.warning(f"Multiple key `{key}` found in {apVisit}: {expand_path(apVisit.path)}")
-                    raise a
-                else:
-                    metadata[key] = value
-
-            # @Nidever: "if there’s 2048 then it hasn’t been dithered, if it’s 4096 then it’s dithered."
-            dithered = int(metadata["NAXIS1"]) == 4096
-            snr = float(metadata["SNR"])
-            n_frames = int(metadata["NCOMBINE"])
-            exptime = float(metadata["EXPTIME"])
-
-            all_metadata[apVisit.spectrum_pk] = (dithered, snr, n_frames, exptime)
-    '''
-    
-    return all_metadata
-
-
-
 def migrate_apvisit_metadata_from_image_headers(
     where=(ApogeeVisitSpectrum.dithered.is_null() | ApogeeVisitSpectrum.snr.is_null() | ApogeeVisitSpectrum.exptime.is_null()), 
     max_workers: Optional[int] = 8, 
     batch_size: Optional[int] = 100, 
-    limit: Optional[int] = None
+    limit: Optional[int] = None,
+    cache_path: Optional[str] = DEFAULT_HEADER_CACHE_PATH,
 ):
     """
     Gather metadata information from the headers of apVisit files and put that information in to the database.
@@ -2426,6 +2331,7 @@ def migrate_apvisit_metadata_from_image_headers(
         - `SNR`: the estimated signal-to-noise ratio goes to the `ApogeeVisitSpectrum.snr` attribute
         - `NAXIS1`: for determining `ApogeeVisitSpectrum.dithered` status
         - `NCOMBINE`: for determining the number of frames combined (`ApogeeVisitSpectrum.n_frames`)
+        - `EXPTIME`: the exposure time goes to the `ApogeeVisitSpectrum.exptime` attribute
         
     :param where: [optional]
         A `where` clause for the `ApogeeVisitSpectrum.select()` statement.
@@ -2434,10 +2340,13 @@ def migrate_apvisit_metadata_from_image_headers(
         Maximum number of parallel workers to use.
         
     :param batch_size: [optional]
-        The batch size to use when updating `ApogeeVisitSpectrum` objects, and for chunking to workers.
+        The number of files to send to each worker at once.
 
     :param limit: [optional]
         Limit the number of apVisit files to query.
+
+    :param cache_path: [optional]
+        The path of the local header cache. If `None`, no cache is used.
     """
 
     q = (
@@ -2447,44 +2356,28 @@ def migrate_apvisit_metadata_from_image_headers(
         .limit(limit)
         .iterator()
     )
+    items = [(apVisit.pk, apVisit.path) for apVisit in tqdm(q, desc="Retrieving paths", unit="spectra")]
+
+    all_cards = harvest_primary_header_cards(
+        items,
+        ("NAXIS1", "SNR", "NCOMBINE", "EXPTIME"),
+        max_workers=max_workers,
+        batch_size=batch_size,
+        cache_path=cache_path
+    )
+    if not all_cards:
+        return 0
 
-    executor = concurrent.futures.ProcessPoolExecutor(max_workers)
-
-    apVisits, futures, total = ({}, [], 0)
-    with tqdm(total=limit or 0, desc="Retrieving metadata", unit="spectra") as pb:
-        for chunk in chunked(q, batch_size):
-            futures.append(executor.submit(_migrate_apvisit_metadata, chunk))
-            for total, apVisit in enumerate(chunk, start=1 + total):
-                apVisits[apVisit.spectrum_pk] = apVisit
-                pb.update()
-
-
-    with tqdm(total=total, desc="Collecting results", unit="spectra") as pb:
-        for future in concurrent.futures.as_completed(futures):
-            for spectrum_pk, meta in future.result().items():
-                for key, value in meta.items():
-                    setattr(apVisits[spectrum_pk], key, value)
-                
-                pb.update()
-
-    with tqdm(total=total, desc="Updating", unit="spectra") as pb:     
-        for chunk in chunked(apVisits.values(), batch_size):
-            pb.update(
-                ApogeeVisitSpectrum  
-                .bulk_update(
-                    chunk,
-                    fields=[
-                        ApogeeVisitSpectrum.dithered,
-                        ApogeeVisitSpectrum.snr,
-                        ApogeeVisitSpectrum.n_frames,
-                        ApogeeVisitSpectrum.exptime
-                    ]
-                )
-            )
-
-    return pb.n
-
-
+    pks, cards = zip(*all_cards.items())
+    return update_from_staging_table(
+        ApogeeVisitSpectrum,
+        np.array(pks),
+        # @Nidever: "if there’s 2048 then it hasn’t been dithered, if it’s 4096 then it’s dithered."
+        dithered=np.array([as_int(c["NAXIS1"]) == 4096 for c in cards]),
+        snr=np.array([as_float(c["SNR"]) for c in cards]),
+        n_frames=np.array([as_int(c["NCOMBINE"]) for c in cards]),
+        exptime=np.array([as_float(c["EXPTIME"]) for c in cards]),
+    )
 
 
 def migrate_apstar_from_sdss5_database(apred, where=None, limit=None, batch_size=100, max_workers=8):
@@ -3,14 +3,14 @@ from astropy.table import Table
 from astropy.time import Time
 from tqdm import tqdm
 import numpy as np
-import subprocess
-import concurrent.futures
+from itertools import chain
 
 from astra.utils import log, expand_path
 from astra.models.base import database
 from astra.models.boss import BossVisitSpectrum
 from astra.models.source import Source
-from astra.migrations.utils import enumerate_new_spectrum_pks, upsert_many
+from astra.migrations.utils import enumerate_new_spectrum_pks, upsert_many, update_from_staging_table
+from astra.migrations.headers import harvest_primary_header_cards, as_int, as_float, DEFAULT_HEADER_CACHE_PATH
 
 from peewee import (
     chunked,
@@ -51,89 +51,25 @@ def migrate_spectra_from_spall_file(
     if gzip:
         path += ".gz"
 
-    spAll = Table.read(expand_path(path))
-    spAll.sort(["CATALOGID"])
-
-    if limit is not None:
-        spAll = spAll[:limit]
-
-    translations = {
-        "NEXP": "n_exp",
-        "XCSAO_RV": "xcsao_v_rad",
-        "XCSAO_ERV": "xcsao_e_v_rad",
-        "XCSAO_RXC": "xcsao_rxc",
-        "XCSAO_TEFF": "xcsao_teff",
-        "XCSAO_ETEFF": "xcsao_e_teff",
-        "XCSAO_LOGG": "xcsao_logg",
-        "XCSAO_ELOGG": "xcsao_e_logg",
-        "XCSAO_FEH": "xcsao_fe_h",
-        "XCSAO_EFEH": "xcsao_e_fe_h",
-        "ZWARNING": ("zwarning_flags", lambda x: x or 0),
-        "EXPTIME": "exptime",
-
-        # Not yet done: gri_gaia_transform, because it is accidentally missing from the IPL3 files
-        "AIRMASS": "airmass",
-        "SEEING50": "seeing",
-    
-        "OBS": ("telescope", lambda x: f"{x.lower()}25m"),
-        "MOON_DIST": ("moon_dist_mean", lambda x: np.mean(tuple(map(float, x.split())))),
-        "MOON_PHASE": ("moon_phase_mean", lambda x: np.mean(tuple(map(float, x.split())))),
-
-        "FIELD": "fieldid",
-        "MJD": "mjd",
-        "CATALOGID": "catalogid",
-        "HEALPIX": "healpix",
-        "DELTA_RA_LIST": ("delta_ra", lambda x: np.array(x.split(), dtype=float)),
-        "DELTA_DEC_LIST": ("delta_dec", lambda x: np.array(x.split(), dtype=float)),
-        "SN_MEDIAN_ALL": "snr",
-
-        # Some additional identifiers that we don't necessarily need, but will take for now
-
-        "CATALOGID_V0": "catalogid_v0",
-        "CATALOGID_V0P5": "catalogid_v0p5",
-        "SDSS_ID": "sdss_id",
-        "GAIA_ID": "gaia_dr2_source_id",
-        "FIRSTCARTON": "carton_0"
-    }
-    source_keys_only = ("catalogid_v0", "catalogid_v0p5", "sdss_id", "gaia_dr2_source_id", "carton_0") 
-
-    spectrum_data = []
-    for i, row in enumerate(tqdm(spAll)):
-
-        row_data = dict(zip(row.keys(), row.values()))
-        
-        sanitised_row_data = {
-            "release": "sdss5",
-            "run2d": run2d,
-            "filetype": "specFull",
-        }
-        for from_key, to in translations.items():
-            if isinstance(to, str):
-                sanitised_row_data[to] = row_data[from_key]
-            else:
-                to_key, to_callable = to
-                sanitised_row_data[to_key] = to_callable(row_data[from_key])
-        
-        offset = np.abs(sanitised_row_data["delta_ra"]) + np.abs(sanitised_row_data["delta_dec"])
-        sanitised_row_data["fiber_offset"] = np.any(offset > 0)
-        spectrum_data.append(sanitised_row_data)
+    spectrum_data, source_only_data = read_spall_columns(path, limit=limit)
+    N = spectrum_data["catalogid"].size
 
     # We need to get sdss_id and catalog information for each source.
-    source_data = {}
-    with tqdm(total=len(spectrum_data), desc="Linking to Catalog") as pb:
-        for chunk in chunked(spectrum_data, batch_size):
-
-            chunk_catalogids = []
-            gaia_dr2_source_id_given_catalogid = {}
-            for row in chunk:
-                for key in ("catalogid", "catalogid_v0", "catalogid_v0p5"):
-                    try:
-                        if np.all(row[key].mask):
-                            continue
-                    except:
-                        chunk_catalogids.append(row[key])
-                        gaia_dr2_source_id_given_catalogid[row[key]] = row["gaia_dr2_source_id"]
+    gaia_dr2_source_id_given_catalogid = {}
+    for key in ("catalogid", "catalogid_v0", "catalogid_v0p5"):
+        column = source_only_data[key]
+        valid = ~np.ma.getmaskarray(column)
+        gaia_dr2_source_id_given_catalogid.update(
+            zip(
+                np.ma.getdata(column)[valid].tolist(),
+                np.ma.getdata(source_only_data["gaia_dr2_source_id"])[valid].tolist()
+            )
+        )
 
+    source_data = {}
+    catalogids = list(gaia_dr2_source_id_given_catalogid.keys())
+    with tqdm(total=len(catalogids), desc="Linking to Catalog") as pb:
+        for chunk_catalogids in chunked(catalogids, batch_size):
             q = (
                 Catalog
                 .select(
@@ -173,7 +109,7 @@ def migrate_spectra_from_spall_file(
                     gaia_dr2_source_id = None
                 source_data[row[reference_key]]["gaia_dr2_source_id"] = gaia_dr2_source_id
             
-            pb.update(batch_size)
+            pb.update(len(chunk_catalogids))
     
 
     # Upsert the sources
@@ -208,50 +144,49 @@ def migrate_spectra_from_spall_file(
         for catalogid in catalogids:
             source_pk_by_catalogid[catalogid] = pk
     
-    n_warnings = 0
-    for each in spectrum_data:
-        try:
-            each["source_pk"] = source_pk_by_catalogid[each["catalogid"]]
-        except:
-            # log warning?
-            n_warnings += 1
-        finally:
-            for source_key_only in source_keys_only:
-                each.pop(source_key_only, None)
-
-            try:
-                # Missing catalogid!
-                if np.all(each["catalogid"].mask):
-                    each["catalogid"] = -1 # cannot be null
-            except:
-                None
-
-
+    source_pk = list(map(source_pk_by_catalogid.get, spectrum_data["catalogid"].tolist()))
+    n_warnings = source_pk.count(None)
     if n_warnings > 0:
         log.warning(f"There were {n_warnings} spectra with no source_pk, probably because of missing or fake catalogids")
+
+    # Build the rows as tuples, column by column.
+    spectrum_data["source_pk"] = source_pk
+    constants = {
+        "release": "sdss5",
+        "run2d": run2d,
+        "filetype": "specFull",
+    }
+    names = [name for name in (*constants, *spectrum_data) if name in BossVisitSpectrum._meta.fields]
+    columns = [
+        [constants[name]] * N if name in constants else _to_list(spectrum_data[name])
+        for name in names
+    ]
+    spectrum_rows = list(zip(*columns))
     
     pks = upsert_many(
         BossVisitSpectrum,
         BossVisitSpectrum.pk,
-        spectrum_data,
+        spectrum_rows,
         batch_size,
-        desc="Upserting spectra"
+        desc="Upserting spectra",
+        fields=[BossVisitSpectrum._meta.fields[name] for name in names]
     )
-
+    
     # Assign spectrum_pk values to any spectra missing it.
     N = len(pks)
     if pks:
+        new_spectrum_pks = list(enumerate_new_spectrum_pks(pks))
         with tqdm(total=N, desc="Assigning primary keys to spectra") as pb:
             N_assigned = 0
-            for batch in chunked(pks, batch_size):
+            for batch in chunked(new_spectrum_pks, batch_size):
                 B = (
                     BossVisitSpectrum
                     .update(
                         spectrum_pk=Case(None, (
-                            (BossVisitSpectrum.pk == pk, spectrum_pk) for spectrum_pk, pk in enumerate_new_spectrum_pks(batch)
+                            (BossVisitSpectrum.pk == pk, spectrum_pk) for spectrum_pk, pk in batch
                         ))
                     )
-                    .where(BossVisitSpectrum.pk.in_(batch))
+                    .where(BossVisitSpectrum.pk.in_([pk for _, pk in batch]))
                     .execute()
                 )
                 pb.update(B)
@@ -265,80 +200,133 @@ def migrate_spectra_from_spall_file(
 
 
 
-def _migrate_specfull_metadata(spectra, fields, raise_exceptions=False, full_output=False):
+def _filled(column, fill_value):
+    return np.ma.filled(column, fill_value) if np.ma.isMaskedArray(column) else np.asarray(column)
+
+
+def _as_str(column):
+    column = _filled(column, "")
+    return column.astype(str) if column.dtype.kind == "S" else column
+
+
+def _to_list(column):
+    return _as_str(column).tolist() if isinstance(column, np.ndarray) else list(column)
+
+
+def _parse_number_lists(column):
+    """
+    Parse a column of whitespace-separated numbers into a flat array of values and the count per row.
+    """
+    split = np.char.split(np.char.strip(_as_str(column)))
+    counts = np.fromiter(map(len, split), dtype=int, count=len(split))
+    values = np.fromiter(chain.from_iterable(split), dtype=float, count=np.sum(counts))
+    return (values, counts)
+
+
+def _mean_of_number_lists(column):
+    values, counts = _parse_number_lists(column)
+    sums = np.bincount(np.repeat(np.arange(counts.size), counts), weights=values, minlength=counts.size)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts
+
+
+def _split_number_lists(column):
+    values, counts = _parse_number_lists(column)
+    return [each.tolist() for each in np.split(values, np.cumsum(counts)[:-1])]
+
+
+# spAll column: spectrum field name, or (spectrum field name, column-wise translation)
+SPALL_TRANSLATIONS = {
+    "NEXP": "n_exp",
+    "XCSAO_RV": "xcsao_v_rad",
+    "XCSAO_ERV": "xcsao_e_v_rad",
+    "XCSAO_RXC": "xcsao_rxc",
+    "XCSAO_TEFF": "xcsao_teff",
+    "XCSAO_ETEFF": "xcsao_e_teff",
+    "XCSAO_LOGG": "xcsao_logg",
+    "XCSAO_ELOGG": "xcsao_e_logg",
+    "XCSAO_FEH": "xcsao_fe_h",
+    "XCSAO_EFEH": "xcsao_e_fe_h",
+    "ZWARNING": ("zwarning_flags", lambda x: _filled(x, 0).astype(int)),
+    "EXPTIME": "exptime",
+
+    # Not yet done: gri_gaia_transform, because it is accidentally missing from the IPL3 files
+    "AIRMASS": "airmass",
+    "SEEING50": "seeing",
+
+    "OBS": ("telescope", lambda x: np.char.add(np.char.lower(np.char.strip(_as_str(x))), "25m")),
+    "MOON_DIST": ("moon_dist_mean", _mean_of_number_lists),
+    "MOON_PHASE": ("moon_phase_mean", _mean_of_number_lists),
+
+    "FIELD": "fieldid",
+    "MJD": "mjd",
+    "CATALOGID": "catalogid",
+    "HEALPIX": "healpix",
+    "DELTA_RA_LIST": ("delta_ra", _split_number_lists),
+    "DELTA_DEC_LIST": ("delta_dec", _split_number_lists),
+    "SN_MEDIAN_ALL": "snr",
+}
+
+# spAll columns that are only needed to link spectra to sources
+SPALL_SOURCE_TRANSLATIONS = {
+    "CATALOGID": "catalogid",
+    "CATALOGID_V0": "catalogid_v0",
+    "CATALOGID_V0P5": "catalogid_v0p5",
+    "SDSS_ID": "sdss_id",
+    "GAIA_ID": "gaia_dr2_source_id",
+    "FIRSTCARTON": "carton_0"
+}
+
+
+def read_spall_columns(path, limit=None):
+    """
+    Read the spectrum and source columns needed from a spAll file, and apply all translations column-wise.
 
-    K = len(fields)
-    keys_str = "|".join([f"({k})" for k in fields.values()])
+    Only the required columns are read, and the file is memory-mapped unless it is compressed.
 
-    # 80 chars per line, 150 lines -> 12000
-    command_template = " | ".join([
-        'hexdump -n 80000 -e \'80/1 "%_p" "\\n"\' {path}',
-        f'egrep "{keys_str}"',
-        f"head -n {K+5}"
-    ])
-    commands = ""
-    for specFull in spectra:
-        path = expand_path(specFull.path)
-        commands += f"{command_template.format(path=path)}\n"
+    :param path:
+        The path of the spAll file.
     
-    outputs = subprocess.check_output(commands, shell=True, text=True)
-    outputs = outputs.strip().split("\n")
-
-    p, all_metadata = (-1, {})
-    for line in outputs:
-        try:
-            key, *values = line.split("= ")
-            key, value = (key.strip(), values[0].split()[0].strip(" '"))
-        except (IndexError, ValueError): # binary data, probably
-            continue
-
-        for field, from_key in fields.items():
-            if from_key == key:
-                break
+    :param limit: [optional]
+        Only read this many rows (after sorting by `CATALOGID`).
+
+    :returns:
+        A two-length tuple of dictionaries. The first contains the spectrum columns (with a
+        `catalogid` of -1 where it is missing), and the second contains the (possibly masked)
+        columns needed to link spectra to sources.
+    """
+    path = expand_path(path)
+    spAll = Table.read(path, hdu=1, memmap=not path.endswith(".gz"))
+    order = np.argsort(_filled(spAll["CATALOGID"], -1), kind="stable")[:limit]
+
+    spectrum_data = {}
+    for from_key, to in SPALL_TRANSLATIONS.items():
+        column = spAll[from_key][order]
+        if isinstance(to, str):
+            spectrum_data[to] = column
         else:
-            continue
-
-        name = field.name
-        if line[8:10] != "= ": # not a key=value line
-            log.warning(f"Skipping line '{line}' because not a valid line")
-            continue
-
-        if name == "plateid":
-            p += 1
-        pk = spectra[p].pk
-        all_metadata.setdefault(pk, {})
-        if name in all_metadata[pk]:
-            log.warning(f"Multiple key `{name}` found in {spectra[p]}: {expand_path(spectra[p].path)}")
-            log.warning(f"\tKeeping existing (k, v) pair: {name}={all_metadata[pk][name]} and ignoring new value: {value}")
-            continue
-        
-        if isinstance(field, IntegerField):
-            try:
-                value = int(float(value))
-            except:
-                value = -1
-        elif isinstance(field, FloatField):
-            try:
-                value = float(value)
-            except:
-                value = np.nan
-
-        all_metadata[pk][name] = value
+            to_key, to_callable = to
+            spectrum_data[to_key] = to_callable(column)
         
-    missing_key_counts, examples = ({}, {})
-    for pk, meta in all_metadata.items():
-        for field, from_key in fields.items():
-            if field.name not in meta:
-                missing_key_counts.setdefault(field.name, 0)
-                missing_key_counts[field.name] += 1
-                examples[field.name] = pk
+    offset = (
+        np.abs(np.concatenate([*spectrum_data["delta_ra"], []]))
+    +   np.abs(np.concatenate([*spectrum_data["delta_dec"], []]))
+    )
+    counts = np.fromiter(map(len, spectrum_data["delta_ra"]), dtype=int, count=order.size)
+    spectrum_data["fiber_offset"] = np.bincount(
+        np.repeat(np.arange(order.size), counts), 
+        weights=(offset > 0), 
+        minlength=order.size
+    ) > 0
 
-    #if missing_key_counts:
-    #    log.warning(f"There are missing keys in some spectra:")    
-    #    for key, count in missing_key_counts.items():
-    #        log.warning(f"\t{key} is missing in {count} spectra in this batch. Example pk={examples[key]}")
+    source_only_data = { to: spAll[from_key][order] for from_key, to in SPALL_SOURCE_TRANSLATIONS.items() }
 
-    return (all_metadata, missing_key_counts, outputs) if full_output else (all_metadata, missing_key_counts)
+    # Missing catalogid! (cannot be null)
+    spectrum_data["catalogid"] = _filled(spectrum_data["catalogid"], -1)
+    for key, column in spectrum_data.items():
+        if np.ma.isMaskedArray(column):
+            spectrum_data[key] = np.where(np.ma.getmaskarray(column), None, np.ma.getdata(column))
+    return (spectrum_data, source_only_data)
 
 
 def migrate_specfull_metadata_from_image_headers(
@@ -346,7 +334,27 @@ def migrate_specfull_metadata_from_image_headers(
     max_workers: Optional[int] = 8,
     limit: Optional[int] = None,
     batch_size: Optional[int] = 100,
+    cache_path: Optional[str] = DEFAULT_HEADER_CACHE_PATH,
 ):
+    """
+    Gather metadata information from the primary headers of specFull files and put that information in to
+    the database.
+
+    :param where: [optional]
+        A `where` clause for the `BossVisitSpectrum.select()` statement.
+
+    :param max_workers: [optional]
+        Maximum number of parallel workers to use.
+
+    :param limit: [optional]
+        Limit the number of specFull files to query.
+
+    :param batch_size: [optional]
+        The number of files to send to each worker at once.
+
+    :param cache_path: [optional]
+        The path of the local header cache. If `None`, no cache is used.
+    """
 
     q = (
         BossVisitSpectrum
@@ -396,53 +404,46 @@ def migrate_specfull_metadata_from_image_headers(
         BossVisitSpectrum.schi2max: "SCHI2MAX",
     }
 
-    executor = concurrent.futures.ProcessPoolExecutor(max_workers)
-
-    specFulls, futures, total = ({}, [], 0)
-    with tqdm(total=limit or 0, desc="Submitting work", unit="spectra") as pb:
-        for chunk in chunked(q, batch_size):
-            futures.append(executor.submit(_migrate_specfull_metadata, chunk, fields))
-            for total, spec in enumerate(chunk, start=1 + total):
-                specFulls[spec.pk] = spec
-                pb.update()
+    items = [(spec.pk, spec.path) for spec in tqdm(q, desc="Retrieving paths", unit="spectra")]
+    all_cards = harvest_primary_header_cards(
+        items,
+        fields.values(),
+        max_workers=max_workers,
+        batch_size=batch_size,
+        cache_path=cache_path
+    )
+    if not all_cards:
+        return 0
 
-    defaults = {
-        "n_guide": -1,
-        "airtemp": np.nan,
-        "dewpoint": np.nan,
-        "n_std": -1
-    }
+    pks, cards = zip(*all_cards.items())
 
     all_missing_counts = {}
-    with tqdm(total=total, desc="Collecting headers", unit="spectra") as pb:
-        for future in concurrent.futures.as_completed(futures):
-            metadata, missing_counts = future.result()
-
-            for name, missing_count in missing_counts.items():
-                all_missing_counts.setdefault(name, 0)
-                all_missing_counts[name] += missing_count
-
-            for pk, meta in metadata.items():
-                for key, value in meta.items():
-                    setattr(specFulls[pk], key, value)
-                for key, value in defaults.items():
-                    if key not in meta:
-                        setattr(specFulls[pk], key, value)
-                pb.update()
+    for field, key in fields.items():
+        n_missing = sum(c[key] is None for c in cards)
+        if n_missing:
+            all_missing_counts[field.name] = n_missing
 
     if all_missing_counts:
         log.warning(f"There were missing keys:")
         for name, count in all_missing_counts.items():
             log.warning(f"\t{name}: {count} missing")
 
-    with tqdm(total=total, desc="Updating", unit="spectra") as pb:     
-        for chunk in chunked(specFulls.values(), batch_size):
-            pb.update(
-                BossVisitSpectrum  
-                .bulk_update(
-                    chunk,
-                    fields=list(fields.keys())
-                )
-            )
+    # Missing keys are null, except for these fields. Invalid integer values become -1, and invalid float
+    # values become NaN.
+    defaults = {
+        BossVisitSpectrum.n_guide: -1,
+        BossVisitSpectrum.airtemp: np.nan,
+        BossVisitSpectrum.dewpoint: np.nan,
+        BossVisitSpectrum.n_std: -1,
+    }
+    columns = {}
+    for field, key in fields.items():
+        as_value = as_int if isinstance(field, IntegerField) else as_float
+        default = defaults.get(field, None)
+        columns[field.name] = np.array(
+            [default if c[key] is None else as_value(c[key]) for c in cards],
+            dtype=object if default is None else None
+        )
+
+    return update_from_staging_table(BossVisitSpectrum, np.array(pks), **columns)
 
-    return pb.n
@@ -0,0 +1,264 @@
+"""Harvest header cards from the primary HDU of many FITS files, with a local cache."""
+
+import os
+import json
+import sqlite3
+import numpy as np
+import concurrent.futures
+from peewee import chunked
+from tqdm import tqdm
+
+from astra.utils import log, expand_path
+
+DEFAULT_HEADER_CACHE_PATH = "$MWM_ASTRA/aux/headers/header_cache.db"
+
+FITS_BLOCK_SIZE = 2880
+FITS_CARD_SIZE = 80
+
+
+def _parse_card_value(value):
+    """
+    Parse the value part (columns 11-80) of a FITS header card.
+
+    :returns:
+        The value as a `str`, `bool`, `int`, or `float`, or `None` if the value is undefined.
+    """
+    value = value.strip()
+    if value.startswith("'"):
+        # Strings are quoted, with quotes escaped by doubling them, and trailing spaces are not significant.
+        characters, i = ([], 1)
+        while i < len(value):
+            if value[i] == "'":
+                if value[i + 1:i + 2] == "'":
+                    characters.append("'")
+                    i += 2
+                    continue
+                break
+            characters.append(value[i])
+            i += 1
+        return "".join(characters).rstrip()
+
+    value = value.split("/")[0].strip()
+    if value == "":
+        return None
+    if value in ("T", "F"):
+        return (value == "T")
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value.replace("D", "E"))
+    except ValueError:
+        return value
+
+
+def as_float(value):
+    """Convert a header value to a float, or NaN if it cannot be converted."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def as_int(value):
+    """Convert a header value to an integer, or -1 if it cannot be converted."""
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return -1
+
+
+def read_primary_header_cards(path, keys=None):
+    """
+    Read header cards from the primary HDU of a FITS file.
+
+    This reads the file one 2880-byte block at a time until the `END` card, and parses the 80-byte cards
+    directly, without constructing any astropy HDUs.
+
+    :param path:
+        The path of the FITS file.
+
+    :param keys: [optional]
+        The keys to return. If `None`, all keys with values are returned.
+
+    :returns:
+        A dictionary of keys and values. If a key appears more than once, the first value is kept.
+        Any requested keys that are not in the header are given `None`.
+    """
+    keys = None if keys is None else set(keys)
+    cards = {}
+    with open(path, "rb") as fp:
+        while True:
+            block = fp.read(FITS_BLOCK_SIZE)
+            if len(block) < FITS_BLOCK_SIZE:
+                raise OSError(f"Unexpected end of file in primary header of {path}")
+
+            for i in range(0, FITS_BLOCK_SIZE, FITS_CARD_SIZE):
+                card = block[i:i + FITS_CARD_SIZE].decode("ascii", errors="replace")
+                key = card[:8].strip()
+                if key == "END":
+                    break
+                if card[8:10] != "= " or key in cards or (keys is not None and key not in keys):
+                    continue
+                cards[key] = _parse_card_value(card[10:])
+            else:
+                continue
+            break
+
+    if keys is not None:
+        for key in keys.difference(cards):
+            cards[key] = None
+    return cards
+
+
+def _read_primary_header_cards_for_paths(items, keys):
+    """
+    Read header cards for a list of `(pk, path)` tuples.
+
+    :returns:
+        A list of `(pk, path, mtime, size, cards)` tuples. Files that cannot be read are given `None` cards.
+    """
+    results = []
+    for pk, path in items:
+        try:
+            stat = os.stat(path)
+            cards = read_primary_header_cards(path, keys)
+        except OSError as e:
+            log.warning(f"Could not read primary header of {path}: {e}")
+            results.append((pk, path, None, None, None))
+        else:
+            results.append((pk, path, stat.st_mtime, stat.st_size, cards))
+    return results
+
+
+class HeaderCache(object):
+
+    def __init__(self, path=DEFAULT_HEADER_CACHE_PATH):
+        """
+        A local SQLite cache of header cards, keyed by the path, modification time, and size of each file.
+
+        :param path: [optional]
+            The path of the SQLite cache file. Use `:memory:` to avoid writing a cache to disk.
+        """
+        self.path = path if path == ":memory:" else expand_path(path)
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, cards TEXT)"
+        )
+        return None
+
+    def get_many(self, paths, batch_size=500):
+        """
+        Get the cached entries for many paths.
+
+        :param paths:
+            A list of paths.
+
+        :returns:
+            A dictionary of paths and `(mtime, size, cards)` tuples.
+        """
+        entries = {}
+        for chunk in chunked(paths, batch_size):
+            rows = self.connection.execute(
+                f"SELECT path, mtime, size, cards FROM headers WHERE path IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            for path, mtime, size, cards in rows:
+                entries[path] = (mtime, size, json.loads(cards))
+        return entries
+
+    def put_many(self, rows):
+        """
+        Store many entries in the cache.
+
+        :param rows:
+            An iterable of `(path, mtime, size, cards)` tuples.
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO headers (path, mtime, size, cards) VALUES (?, ?, ?, ?)",
+                ((path, mtime, size, json.dumps(cards)) for path, mtime, size, cards in rows)
+            )
+
+
+def harvest_primary_header_cards(
+    items,
+    keys,
+    max_workers=8,
+    batch_size=100,
+    cache_path=DEFAULT_HEADER_CACHE_PATH,
+):
+    """
+    Harvest header cards from the primary HDU of many FITS files.
+
+    Files are only read if they are not in the cache, or if their modification time or size has changed
+    since they were cached, or if the cached entry is missing some of the requested keys. Only the
+    `(pk, path)` tuples of those files are sent to the workers.
+
+    :param items:
+        An iterable of `(pk, path)` tuples.
+
+    :param keys:
+        The header keys to harvest.
+
+    :param max_workers: [optional]
+        The number of processes to read files with.
+
+    :param batch_size: [optional]
+        The number of files to send to each worker at once.
+
+    :param cache_path: [optional]
+        The path of the header cache. If `None`, no cache is used.
+
+    :returns:
+        A dictionary of primary keys and dictionaries of header cards. Files that could not be read
+        are not included.
+    """
+    keys = list(keys)
+    items = [(pk, expand_path(path)) for pk, path in items]
+    cache = HeaderCache(cache_path or ":memory:")
+    cached = cache.get_many(list({path for pk, path in items}))
+
+    all_cards, stale = ({}, [])
+    for pk, path in items:
+        try:
+            mtime, size, cards = cached[path]
+            stat = os.stat(path)
+        except (KeyError, OSError):
+            stale.append((pk, path))
+        else:
+            if (mtime, size) == (stat.st_mtime, stat.st_size) and all(key in cards for key in keys):
+                all_cards[pk] = cards
+            else:
+                stale.append((pk, path))
+
+    log.info(f"Using cached headers for {len(all_cards)} files, and reading {len(stale)} files")
+
+    chunks = chunked(stale, batch_size)
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers) if max_workers > 1 else None
+    try:
+        if executor is not None:
+            futures = [executor.submit(_read_primary_header_cards_for_paths, chunk, keys) for chunk in chunks]
+            results = (future.result() for future in concurrent.futures.as_completed(futures))
+        else:
+            results = (_read_primary_header_cards_for_paths(chunk, keys) for chunk in chunks)
+
+        n_failed = 0
+        with tqdm(total=len(stale), desc="Reading headers", unit="files") as pb:
+            for result in results:
+                readable = [(pk, path, mtime, size, cards) for pk, path, mtime, size, cards in result if cards is not None]
+                n_failed += len(result) - len(readable)
+                for pk, path, mtime, size, cards in readable:
+                    all_cards[pk] = cards
+                cache.put_many([(path, mtime, size, cards) for pk, path, mtime, size, cards in readable])
+                pb.update(len(result))
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    if n_failed:
+        log.warning(f"Could not read the primary headers of {n_failed} files")
+    return all_cards
@@ -1,15 +1,15 @@
+import os
 import numpy as np
 from astropy.time import Time
 import astropy.coordinates as coord
 import astropy.units as u
-from scipy.signal import argrelmin
 from tqdm import tqdm
 from peewee import chunked
-from peewee import fn, JOIN
-import concurrent.futures
+from peewee import fn, JOIN, PostgresqlDatabase
 
 import pickle
 from astra.utils import log, flatten, expand_path
+from astra.migrations.utils import update_from_staging_table, update_columns, iter_column_chunks
 from astra.models.source import Source
 from astra.models.apogee import ApogeeVisitSpectrum
 from astra.models.boss import BossVisitSpectrum
@@ -19,97 +19,112 @@ from astropy import units as u
 
 von = lambda v: v or np.nan
 
+DEFAULT_SUN_EPHEMERIS_PATH = "$MWM_ASTRA/aux/ephemeris/sun_horizon_crossings_{observatory}.npz"
+
+def wise_vega_magnitudes(flux, e_flux, offset):
+    """
+    Convert unWISE fluxes (in Vega nanomaggies) to Vega magnitudes.
+
+    :param flux:
+        An array of fluxes.
+
+    :param e_flux:
+        An array of flux uncertainties.
+
+    :param offset:
+        The offset (in magnitudes) to apply to the unWISE flux scale.
+
+    :returns:
+        A two-length tuple of magnitudes and magnitude uncertainties.
+    """
+    flux, e_flux = (np.asarray(flux, dtype=float), np.asarray(e_flux, dtype=float))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mag = -2.5 * np.log10(flux) + 22.5 - offset
+        e_mag = (2.5 / np.log(10)) * e_flux / flux
+    return (mag, e_mag)
+
+
+def _compute_w1mag_and_w2mag(w1_flux, w1_dflux, w2_flux, w2_dflux):
+    # See https://catalog.unwise.me/catalogs.html (Flux Scale) for justification of 32 mmag offset in W2, and 4 mmag offset in W1
+    w1_mag, e_w1_mag = wise_vega_magnitudes(w1_flux, w1_dflux, 4 * 1e-3)
+    w2_mag, e_w2_mag = wise_vega_magnitudes(w2_flux, w2_dflux, 32 * 1e-3)
+    return dict(w1_mag=w1_mag, e_w1_mag=e_w1_mag, w2_mag=w2_mag, e_w2_mag=e_w2_mag)
+
+
 def compute_w1mag_and_w2mag(
     where=(
         (Source.w1_flux.is_null(False) & Source.w1_mag.is_null(True))
     |   (Source.w2_flux.is_null(False) & Source.w2_mag.is_null(True))
     ),
     limit=None, 
-    batch_size=1000
+    batch_size=10_000,
+    chunk_size=100_000,
 ):
+    """
+    Compute W1 and W2 Vega magnitudes from unWISE fluxes.
 
-    q = (
-        Source
-        .select(
-            Source.pk,
-            Source.w1_flux,
-            Source.w1_dflux,
-            Source.w2_flux,
-            Source.w2_dflux,
-        )
-        .where(where)
-        .limit(limit)
-    )
-    n_updated = 0
-    with tqdm(total=len(q)) as pb:
-    
-        for batch in chunked(q, batch_size):
-            
-            for source in batch:
-                # See https://catalog.unwise.me/catalogs.html (Flux Scale) for justification of 32 mmag offset in W2, and 4 mmag offset in W1
-                source.w1_mag = -2.5 * np.log10(von(source.w1_flux)) + 22.5 - 4 * 1e-3 # Vega
-                source.e_w1_mag = (2.5 / np.log(10)) * von(source.w1_dflux) / von(source.w1_flux)
-                source.w2_mag = -2.5 * np.log10(von(source.w2_flux)) + 22.5 - 32 * 1e-3 # Vega
-                source.e_w2_mag = (2.5 / np.log(10)) * von(source.w2_dflux) / von(source.w2_flux)
-            
-            n_updated += Source.bulk_update(
-                batch,
-                fields=[
-                    Source.w1_mag,
-                    Source.e_w1_mag,
-                    Source.w2_mag,
-                    Source.e_w2_mag
-                ]
-            )
-            pb.update(len(batch)) 
-    
-    return n_updated                
+    :param where: [optional]
+        A condition to restrict which sources are updated.
 
+    :param limit: [optional]
+        Limit the number of sources to update.
+
+    :param batch_size: [optional]
+        The number of rows to insert into the staging table per statement.
+
+    :param chunk_size: [optional]
+        The number of rows to fetch and compute at once.
+    """
+    return update_columns(
+        Source,
+        [Source.w1_flux, Source.w1_dflux, Source.w2_flux, Source.w2_dflux],
+        _compute_w1mag_and_w2mag,
+        where=where,
+        limit=limit,
+        chunk_size=chunk_size,
+        batch_size=batch_size,
+    )
 
 
 def update_galactic_coordinates(
     where=(Source.ra.is_null(False) & Source.l.is_null(True)),
     limit=None,
     frame="icrs", 
-    batch_size=1000
+    batch_size=10_000,
+    chunk_size=100_000,
 ):
-    
-    q = (
-        Source
-        .select(
-            Source.pk,
-            Source.ra,
-            Source.dec
-        )
-        .where(where)
-        .limit(limit)
+    """
+    Compute galactic coordinates for sources.
+
+    :param where: [optional]
+        A condition to restrict which sources are updated.
+
+    :param limit: [optional]
+        Limit the number of sources to update.
+
+    :param frame: [optional]
+        The reference frame of the source positions.
+
+    :param batch_size: [optional]
+        The number of rows to insert into the staging table per statement.
+
+    :param chunk_size: [optional]
+        The number of rows to fetch and compute at once.
+    """
+
+    def galactic_coordinates(ra, dec):
+        position = SkyCoord(ra=ra * u.degree, dec=dec * u.degree, frame=frame).galactic
+        return dict(l=position.l.value, b=position.b.value)
+
+    return update_columns(
+        Source,
+        [Source.ra, Source.dec],
+        galactic_coordinates,
+        where=where,
+        limit=limit,
+        chunk_size=chunk_size,
+        batch_size=batch_size,
     )
-    
-    n_updated = 0
-    with tqdm(total=len(q)) as pb:
-        
-        for batch in chunked(q, batch_size):
-            
-            coord = SkyCoord(
-                ra=[s.ra for s in batch] * u.degree,
-                dec=[s.dec for s in batch] * u.degree,
-                frame=frame
-            )
-            
-            for source, position in zip(batch, coord.galactic):
-                source.l = position.l.value
-                source.b = position.b.value
-                
-            n_updated += Source.bulk_update(
-                batch,
-                fields=[
-                    Source.l,
-                    Source.b
-                ]
-            )
-            pb.update(len(batch))
-    
-    return n_updated            
 
 
 def backup_unsigned_apogee_flags():
@@ -161,6 +176,133 @@ def fix_unsigned_apogee_flags():
     return updated
 
 
+# These are from Table 2 of https://arxiv.org/pdf/0901.3034.pdf
+GONZALEZ_HERNANDEZ_B_DWARF = np.array([0.5201, 0.2511, -0.0118, -0.0186, 0.0408, 0.0033])
+GONZALEZ_HERNANDEZ_B_GIANT = np.array([0.5293, 0.2489, -0.0119, -0.0042, 0.0135, 0.0010])
+GONZALEZ_HERNANDEZ_DWARF_RANGES = ([0.7, 3.0], [-3.5, 0.5]) # (V-Ks, [Fe/H])
+GONZALEZ_HERNANDEZ_GIANT_RANGES = ([1.1, 3.4], [-4, 0.2]) # (V-Ks, [Fe/H])
+
+#https://www.aanda.org/articles/aa/full_html/2010/04/aa13204-09/aa13204-09.html
+CASAGRANDE_A = np.array([0.5057, 0.2600, -0.0146, -0.0131, 0.0288, 0.0016])
+CASAGRANDE_V_K_RANGE = [0.78, 3.15]
+
+
+def _irfm_theta(coefficients, X, fe_h):
+    """
+    Evaluate the IRFM colour-temperature polynomial, theta = 5040 / Teff.
+
+    :param coefficients:
+        An array of 6 coefficients, or a (N, 6) shape array of per-row coefficients.
+
+    :param X:
+        An array of colours.
+
+    :param fe_h:
+        An array of metallicities.
+    """
+    A = np.array([np.ones_like(X), X, X**2, X*fe_h, fe_h, fe_h**2]).T
+    return np.sum(coefficients * A, axis=-1)
+
+
+def _outside(x, bounds):
+    with np.errstate(invalid="ignore"):
+        return ~((bounds[0] <= x) & (x <= bounds[1]))
+
+
+def gonzalez_hernandez_irfm_teff_from_vmk(v_k, fe_h, logg, dwarf_giant_logg_split=3.8):
+    """
+    Compute IRFM effective temperatures from the V-Ks colour, using the Gonzalez Hernandez & Bonifacio
+    (2009) relations for dwarfs and giants.
+
+    :param v_k:
+        An array of V-Ks colours.
+
+    :param fe_h:
+        An array of metallicities.
+
+    :param logg:
+        An array of surface gravities. Stars with `logg >= dwarf_giant_logg_split` are treated as dwarfs,
+        and all others (including those with no surface gravity) are treated as giants.
+
+    :param dwarf_giant_logg_split: [optional]
+        The surface gravity that separates dwarfs from giants.
+
+    :returns:
+        A four-length tuple containing the effective temperatures, a boolean array indicating which
+        stars were treated as dwarfs, and boolean arrays indicating which stars are outside the valid
+        V-Ks and [Fe/H] ranges.
+    """
+    v_k, fe_h, logg = (np.asarray(v_k, dtype=float), np.asarray(fe_h, dtype=float), np.asarray(logg, dtype=float))
+    with np.errstate(invalid="ignore"):
+        is_dwarf = (logg >= dwarf_giant_logg_split)
+
+    B = np.where(is_dwarf[:, None], GONZALEZ_HERNANDEZ_B_DWARF, GONZALEZ_HERNANDEZ_B_GIANT)
+    with np.errstate(divide="ignore"):
+        teff = 5040 / _irfm_theta(B, v_k, fe_h)
+
+    (dwarf_v_k, dwarf_fe_h), (giant_v_k, giant_fe_h) = (GONZALEZ_HERNANDEZ_DWARF_RANGES, GONZALEZ_HERNANDEZ_GIANT_RANGES)
+    out_of_v_k = np.where(is_dwarf, _outside(v_k, dwarf_v_k), _outside(v_k, giant_v_k))
+    out_of_fe_h = np.where(is_dwarf, _outside(fe_h, dwarf_fe_h), _outside(fe_h, giant_fe_h))
+    return (teff, is_dwarf, out_of_v_k, out_of_fe_h)
+
+
+def casagrande_irfm_teff_from_vmk(v_k, fe_h):
+    """
+    Compute IRFM effective temperatures from the V-Ks colour, using the Casagrande et al. (2010) scale.
+
+    :param v_k:
+        An array of V-Ks colours.
+
+    :param fe_h:
+        An array of metallicities.
+
+    :returns:
+        A two-length tuple containing the effective temperatures, and a boolean array indicating which
+        stars are outside the valid V-Ks range.
+    """
+    v_k, fe_h = (np.asarray(v_k, dtype=float), np.asarray(fe_h, dtype=float))
+    with np.errstate(divide="ignore"):
+        teff = 5040 / _irfm_theta(CASAGRANDE_A, v_k, fe_h)
+    return (teff, _outside(v_k, CASAGRANDE_V_K_RANGE))
+
+
+def _iter_irfm_columns(model, fields, where, chunk_size):
+    """
+    Yield the primary keys, current IRFM flags, and photometry of model rows as column arrays.
+    """
+    primary_key = model._meta.primary_key
+    q = (
+        model
+        .select(
+            primary_key,
+            model.irfm_teff_flags,
+            Source.v_jkc_mag,
+            Source.k_mag,
+            Source.e_k_mag,
+            Source.v_jkc_mag_flag,
+            Source.ph_qual,
+            Source.ebv_flags,
+            *fields
+        )
+        .join(Source, on=(model.source_pk == Source.pk))
+    )
+    if where:
+        q = q.where(where)
+
+    for pk, flags, v_jkc_mag, k_mag, e_k_mag, v_jkc_mag_flag, ph_qual, ebv_flags, *values in iter_column_chunks(q, primary_key, chunk_size):
+        good_k_mag = np.array([(v is not None) and v.endswith("A") for v in ph_qual])
+        yield (
+            np.array(pk),
+            np.array([v or 0 for v in flags], dtype=int),
+            np.array(v_jkc_mag, dtype=float) - np.array(k_mag, dtype=float),
+            np.array(e_k_mag, dtype=float),
+            np.array(v_jkc_mag_flag, dtype=float) == 0,
+            ~good_k_mag,
+            (np.array([v or 0 for v in ebv_flags], dtype=int) & Source.flag_ebv_upper_limit._value) > 0,
+            *[np.array(v, dtype=float) for v in values]
+        )
+
+
 def compute_gonzalez_hernandez_irfm_effective_temperatures_from_vmk(
     model,
     logg_field,
@@ -170,100 +312,72 @@ def compute_gonzalez_hernandez_irfm_effective_temperatures_from_vmk(
     &   Source.k_mag.is_null(False)
     ),
     dwarf_giant_logg_split=3.8,
-    batch_size=10_000
+    batch_size=10_000,
+    chunk_size=100_000,
 ):
-    '''
-    # These are from Table 2 of https://arxiv.org/pdf/0901.3034.pdf
-    A_dwarf = np.array([2.3522, -1.8817, 0.6229, -0.0745, 0.0371, -0.0990, -0.0052])
-    A_giant = np.array([2.1304, -1.5438, 0.4562, -0.0483, 0.0132, 0.0456, -0.0026])
-    
-    dwarf_colour_range = [1, 3]
-    dwarf_fe_h_range = [-3.5, 0.3]
+    """
+    Compute IRFM effective temperatures using the V-Ks colour and the Gonzalez Hernandez & Bonifacio
+    (2009) relations for dwarfs and giants.
 
-    giant_colour_range = [0.7, 3.8]
-    giant_fe_h_range = [-4.0, 0.1]
-    '''
-    
-    B_dwarf = np.array([0.5201, 0.2511, -0.0118, -0.0186, 0.0408, 0.0033])
-    B_giant = np.array([0.5293, 0.2489, -0.0119, -0.0042, 0.0135, 0.0010])
-    
-    #dwarf_colour_range = [0.1, 0.8] ### WRONG
-    dwarf_colour_range = [0.7, 3.0]
-    dwarf_fe_h_range = [-3.5, 0.5]
-    
-    giant_colour_range = [1.1, 3.4]
-    giant_fe_h_range = [-4, 0.2]
-    
-    
-    q = (
-        model
-        .select(
-            model,
-            Source,
-        )
-        .join(Source, on=(model.source_pk == Source.pk), attr="_source")
+    :param model:
+        The model to update.
+
+    :param logg_field:
+        The field of `model` that stores the surface gravity.
+
+    :param fe_h_field:
+        The field of `model` that stores the metallicity.
+
+    :param where: [optional]
+        A condition to restrict which rows are updated.
+
+    :param dwarf_giant_logg_split: [optional]
+        The surface gravity that separates dwarfs from giants.
+
+    :param batch_size: [optional]
+        The number of rows to insert into the staging table at once.
+
+    :param chunk_size: [optional]
+        The number of rows to fetch and compute at once.
+    """
+
+    # Bits that are re-computed each time. The dwarf/giant bits are only ever set.
+    computed = (
+        model.flag_out_of_v_k_bounds._value
+    |   model.flag_out_of_fe_h_bounds._value
+    |   model.flag_extrapolated_v_mag._value
+    |   model.flag_poor_quality_k_mag._value
+    |   model.flag_ebv_used_is_upper_limit._value
     )
-    
-    if where:
-        q = q.where(where)
 
-    n_updated, batch = (0, [])
-    for row in tqdm(q.iterator()):
-        X = (row._source.v_jkc_mag or np.nan) - (row._source.k_mag or np.nan)
-        fe_h = getattr(row, fe_h_field.name) or np.nan
-        logg = getattr(row, logg_field.name) or np.nan
-        
-        if logg >= dwarf_giant_logg_split:
-            # dwarf
-            B = B_dwarf
-            valid_v_k = dwarf_colour_range
-            valid_fe_h = dwarf_fe_h_range
-            row.flag_as_dwarf_for_irfm_teff = True
-        else:
-            # giant
-            B = B_giant
-            valid_v_k = giant_colour_range
-            valid_fe_h = giant_fe_h_range
-            row.flag_as_giant_for_irfm_teff = True
-            
-        theta = np.sum(B * np.array([1, X, X**2, X*fe_h, fe_h, fe_h**2]))
-        
-        row.irfm_teff = 5040/theta
-        row.flag_out_of_v_k_bounds = not (valid_v_k[0] <= X <= valid_v_k[1])
-        row.flag_out_of_fe_h_bounds = not (valid_fe_h[0] <= fe_h <= valid_fe_h[1])
-        row.flag_extrapolated_v_mag = (row._source.v_jkc_mag_flag == 0)
-        row.flag_poor_quality_k_mag = (
-            (row._source.ph_qual is None) 
-        or  (row._source.ph_qual[-1] != "A") 
-        or  (row._source.e_k_mag > 0.1)
+    n_updated = 0
+    chunks = _iter_irfm_columns(model, (logg_field, fe_h_field), where, chunk_size)
+    for pk, flags, v_k, e_k_mag, extrapolated_v_mag, poor_quality_k_mag, ebv_upper_limit, logg, fe_h in tqdm(chunks):
+        teff, is_dwarf, out_of_v_k, out_of_fe_h = gonzalez_hernandez_irfm_teff_from_vmk(
+            v_k, fe_h, logg, dwarf_giant_logg_split
         )
-        row.flag_ebv_used_is_upper_limit = row._source.flag_ebv_upper_limit        
-        batch.append(row)
-        
-        if len(batch) >= batch_size:
-            model.bulk_update(
-                batch,
-                fields=[
-                    model.irfm_teff,
-                    model.irfm_teff_flags,
-                ]
-            )
-            n_updated += batch_size
-            batch = []
-            
-    if len(batch) > 0:
-        model.bulk_update(
-            batch,
-            fields=[
-                model.irfm_teff,
-                model.irfm_teff_flags,
-            ]
+        with np.errstate(invalid="ignore"):
+            poor_quality_k_mag |= (e_k_mag > 0.1)
+
+        flags = (
+            (flags & ~computed)
+        |   np.where(is_dwarf, model.flag_as_dwarf_for_irfm_teff._value, model.flag_as_giant_for_irfm_teff._value)
+        |   (out_of_v_k * model.flag_out_of_v_k_bounds._value)
+        |   (out_of_fe_h * model.flag_out_of_fe_h_bounds._value)
+        |   (extrapolated_v_mag * model.flag_extrapolated_v_mag._value)
+        |   (poor_quality_k_mag * model.flag_poor_quality_k_mag._value)
+        |   (ebv_upper_limit * model.flag_ebv_used_is_upper_limit._value)
         )
-        n_updated += len(batch)
-    
+        n_updated += update_from_staging_table(
+            model,
+            pk,
+            batch_size=batch_size,
+            irfm_teff=teff,
+            irfm_teff_flags=flags,
+        )
+
     return n_updated
-        
-        
+
 
 def compute_casagrande_irfm_effective_temperatures(
     model, 
@@ -272,147 +386,156 @@ def compute_casagrande_irfm_effective_temperatures(
         Source.v_jkc_mag.is_null(False)
     &   Source.k_mag.is_null(False)
     ),
-    batch_size=10_000
+    batch_size=10_000,
+    chunk_size=100_000,
 ):
     """
     Compute IRFM effective temperatures using the V-Ks colour and the Casagrande et al. (2010) scale.
+
+    :param model:
+        The model to update.
+
+    :param fe_h_field:
+        The field of `model` that stores the metallicity.
+
+    :param where: [optional]
+        A condition to restrict which rows are updated.
+
+    :param batch_size: [optional]
+        The number of rows to insert into the staging table at once.
+
+    :param chunk_size: [optional]
+        The number of rows to fetch and compute at once.
     """
-    
-    valid_v_k = [0.78, 3.15]
-    
-    #https://www.aanda.org/articles/aa/full_html/2010/04/aa13204-09/aa13204-09.html
-    a0, a1, a2, a3, a4, a5 = (
-        +0.5057,
-        +0.2600,
-        -0.0146,
-        -0.0131,
-        +0.0288,
-        +0.0016
-    )
-    
-    q = (
-        model
-        .select(
-            model,
-            Source,
-        )
-        .join(Source, on=(model.source_pk == Source.pk), attr="_source")
+
+    computed = (
+        model.flag_out_of_v_k_bounds._value
+    |   model.flag_extrapolated_v_mag._value
+    |   model.flag_poor_quality_k_mag._value
+    |   model.flag_ebv_used_is_upper_limit._value
     )
-    
-    if where:
-        q = q.where(where)
 
-    n_updated, batch = (0, [])
-    for row in tqdm(q.iterator()):
-        
-        X = (row._source.v_jkc_mag or np.nan) - (row._source.k_mag or np.nan)
-        fe_h = getattr(row, fe_h_field.name) or np.nan
-        theta = a0 + a1 * X + a2*X**2 + a3*X*fe_h + a4*fe_h + a5*fe_h**2
-        
-        row.irfm_teff = 5040/theta
-        row.e_irfm_teff = np.nan
-        
-        #_source.e_irfm_teff = 5040 * np.sqrt(
-        #    (a1 + 2*a2*X + a3*fe_h) ** 2 * _source.e_v_jkc_mag**2
-        #+   (a1 + 2*a2*X + a3*fe_h) ** 2 * _source.e_k_mag**2
-        #+   (a3*X + a4 + 2*a5*fe_h) ** 2 * _source.e_fe_h**2
+    n_updated = 0
+    chunks = _iter_irfm_columns(model, (fe_h_field, ), where, chunk_size)
+    for pk, flags, v_k, e_k_mag, extrapolated_v_mag, poor_quality_k_mag, ebv_upper_limit, fe_h in tqdm(chunks):
+        teff, out_of_v_k = casagrande_irfm_teff_from_vmk(v_k, fe_h)
+
+        #e_irfm_teff = 5040 * np.sqrt(
+        #    (a1 + 2*a2*X + a3*fe_h) ** 2 * e_v_jkc_mag**2
+        #+   (a1 + 2*a2*X + a3*fe_h) ** 2 * e_k_mag**2
+        #+   (a3*X + a4 + 2*a5*fe_h) ** 2 * e_fe_h**2
         #)
-        
-        
-        row.flag_out_of_v_k_bounds = not (valid_v_k[0] <= X <= valid_v_k[1])
-        row.flag_extrapolated_v_mag = (row._source.v_jkc_mag_flag == 0)
-        row.flag_poor_quality_k_mag = (row._source.ph_qual is None) or (row._source.ph_qual[-1] != "A")
-        row.flag_ebv_used_is_upper_limit = row._source.flag_ebv_upper_limit        
-        batch.append(row)
-        
-        if len(batch) >= batch_size:
-            model.bulk_update(
-                batch,
-                fields=[
-                    model.irfm_teff,
-                    model.e_irfm_teff,
-                    model.irfm_teff_flags,
-                ]
-            )
-            n_updated += batch_size
-            batch = []
-            
-    if len(batch) > 0:
-        model.bulk_update(
-            batch,
-            fields=[
-                model.irfm_teff,
-                model.e_irfm_teff,
-                model.irfm_teff_flags,
-            ]
+
+        flags = (
+            (flags & ~computed)
+        |   (out_of_v_k * model.flag_out_of_v_k_bounds._value)
+        |   (extrapolated_v_mag * model.flag_extrapolated_v_mag._value)
+        |   (poor_quality_k_mag * model.flag_poor_quality_k_mag._value)
+        |   (ebv_upper_limit * model.flag_ebv_used_is_upper_limit._value)
         )
-        n_updated += len(batch)
-    
+        columns = dict(irfm_teff=teff, irfm_teff_flags=flags)
+        if hasattr(model, "e_irfm_teff"):
+            columns["e_irfm_teff"] = np.nan * np.ones_like(teff)
+        n_updated += update_from_staging_table(model, pk, batch_size=batch_size, **columns)
+
     return n_updated
 
 
 
-def update_visit_spectra_counts(batch_size=10_000):
-    
+def update_visit_spectra_counts(since_spectrum_pk=None):
+    """
+    Update the number of APOGEE and BOSS visits (and their MJD ranges) for every source, in the database.
+
+    This is a single `UPDATE` statement. On PostgreSQL the counts are joined from a grouped sub-query
+    (`UPDATE ... FROM (SELECT ... GROUP BY source_pk)`), and on SQLite each count is a correlated
+    sub-query. Nothing is loaded into memory.
+
+    :param since_spectrum_pk: [optional]
+        If given, only update sources that have a visit spectrum with a `spectrum_pk` greater than this
+        value (e.g., the largest `spectrum_pk` from when this was last run).
+
+    :returns:
+        The number of sources updated.
+    """
+
     # TODO: Switch this to distinct on (mjd, telescope, fiber) etc if you are including multiple reductions
-    q_apogee_counts = (
-        Source
-        .select(
-            Source.pk,
-            fn.count(ApogeeVisitSpectrum.pk).alias("n_apogee_visits"),
-            fn.min(ApogeeVisitSpectrum.mjd).alias("apogee_min_mjd"),
-            fn.max(ApogeeVisitSpectrum.mjd).alias("apogee_max_mjd"),
+    if since_spectrum_pk is not None:
+        touched = Source.pk.in_(
+            ApogeeVisitSpectrum
+            .select(ApogeeVisitSpectrum.source_pk)
+            .where(ApogeeVisitSpectrum.spectrum_pk > since_spectrum_pk)
+            .union(
+                BossVisitSpectrum
+                .select(BossVisitSpectrum.source_pk)
+                .where(BossVisitSpectrum.spectrum_pk > since_spectrum_pk)
+            )
         )
-        .join(ApogeeVisitSpectrum, JOIN.LEFT_OUTER, on=(Source.pk == ApogeeVisitSpectrum.source_pk))
-        .group_by(Source.pk)
-        .dicts()
-    )
-    q_boss_counts = (
-        Source
-        .select(
-            Source.pk,
-            fn.count(BossVisitSpectrum.pk).alias("n_boss_visits"),
-            fn.min(BossVisitSpectrum.mjd).alias("boss_min_mjd"),
-            fn.max(BossVisitSpectrum.mjd).alias("boss_max_mjd"),            
+
+    if isinstance(Source._meta.database, PostgresqlDatabase):
+        counts = {}
+        for prefix, model in (("apogee", ApogeeVisitSpectrum), ("boss", BossVisitSpectrum)):
+            counts[prefix] = (
+                model
+                .select(
+                    model.source_pk.alias("source_pk"),
+                    fn.count(model.pk).alias("n_visits"),
+                    fn.min(model.mjd).alias("min_mjd"),
+                    fn.max(model.mjd).alias("max_mjd"),
+                )
+                .group_by(model.source_pk)
+                .alias(f"{prefix}_counts")
+            )
+
+        SourceAlias = Source.alias()
+        apogee, boss = (counts["apogee"], counts["boss"])
+        sq = (
+            SourceAlias
+            .select(
+                SourceAlias.pk.alias("source_pk"),
+                fn.coalesce(apogee.c.n_visits, 0).alias("n_apogee_visits"),
+                apogee.c.min_mjd.alias("apogee_min_mjd"),
+                apogee.c.max_mjd.alias("apogee_max_mjd"),
+                fn.coalesce(boss.c.n_visits, 0).alias("n_boss_visits"),
+                boss.c.min_mjd.alias("boss_min_mjd"),
+                boss.c.max_mjd.alias("boss_max_mjd"),
+            )
+            .join(apogee, JOIN.LEFT_OUTER, on=(apogee.c.source_pk == SourceAlias.pk))
+            .join_from(SourceAlias, boss, JOIN.LEFT_OUTER, on=(boss.c.source_pk == SourceAlias.pk))
+            .alias("visit_counts")
         )
-        .join(BossVisitSpectrum, JOIN.LEFT_OUTER, on=(Source.pk == BossVisitSpectrum.source_pk))
-        .group_by(Source.pk)
-        .dicts()
-    )
-    
-    # merge counts
-    all_counts = {}
-    for each in q_apogee_counts:
-        all_counts[each.pop("pk")] = each
-    
-    for each in q_boss_counts:
-        all_counts[each.pop("pk")].update(each)
-        
-    q = { s.pk: s for s in Source.select() }
-    
-    update = []
-    for pk, counts in all_counts.items():
-        s = q[pk]
-        for k, v in counts.items():
-            setattr(s, k, v)
-            
-        update.append(s)
-    
-    with tqdm(total=len(update)) as pb:
-        for batch in chunked(update, batch_size):
-            Source.bulk_update(
-                batch,
-                fields=[
-                    Source.n_apogee_visits,
-                    Source.apogee_min_mjd,
-                    Source.apogee_max_mjd,
-                    Source.n_boss_visits,
-                    Source.boss_min_mjd,
-                    Source.boss_max_mjd,
-                ]
+        q = (
+            Source
+            .update(
+                n_apogee_visits=sq.c.n_apogee_visits,
+                apogee_min_mjd=sq.c.apogee_min_mjd,
+                apogee_max_mjd=sq.c.apogee_max_mjd,
+                n_boss_visits=sq.c.n_boss_visits,
+                boss_min_mjd=sq.c.boss_min_mjd,
+                boss_max_mjd=sq.c.boss_max_mjd,
             )
-            pb.update(batch_size)
-    return len(update)
+            .from_(sq)
+            .where(Source.pk == sq.c.source_pk)
+        )
+    else:
+        correlated = lambda model, aggregate: model.select(aggregate).where(model.source_pk == Source.pk)
+        q = (
+            Source
+            .update(
+                n_apogee_visits=correlated(ApogeeVisitSpectrum, fn.count(ApogeeVisitSpectrum.pk)),
+                apogee_min_mjd=correlated(ApogeeVisitSpectrum, fn.min(ApogeeVisitSpectrum.mjd)),
+                apogee_max_mjd=correlated(ApogeeVisitSpectrum, fn.max(ApogeeVisitSpectrum.mjd)),
+                n_boss_visits=correlated(BossVisitSpectrum, fn.count(BossVisitSpectrum.pk)),
+                boss_min_mjd=correlated(BossVisitSpectrum, fn.min(BossVisitSpectrum.mjd)),
+                boss_max_mjd=correlated(BossVisitSpectrum, fn.max(BossVisitSpectrum.mjd)),
+            )
+        )
+
+    if since_spectrum_pk is not None:
+        q = q.where(touched)
+
+    n_updated = q.execute()
+    log.info(f"Updated visit spectra counts for {n_updated} sources")
+    return n_updated
 
 
 def compute_n_neighborhood(
@@ -426,9 +549,37 @@ def compute_n_neighborhood(
     radius=3, # arcseconds
     brightness=5, # magnitudes
     batch_size=1000,
-    limit=None
+    limit=None,
+    backend=None,
 ):
+    """
+    Compute the number of Gaia sources within some radius of each source that are brighter than the
+    source magnitude plus some limit.
+
+    :param where: [optional]
+        A condition to restrict which sources are updated.
+
+    :param radius: [optional]
+        The search radius (in arcseconds).
+
+    :param brightness: [optional]
+        Only count neighbours with G-band magnitudes less than the source magnitude plus `brightness`.
+
+    :param batch_size: [optional]
+        The number of sources to query (or update) at once.
+
+    :param limit: [optional]
+        Limit the number of sources to update.
+
+    :param backend: [optional]
+        A neighbour-count backend (e.g., `astra.migrations.neighborhood.HEALPixNeighborhood`) built from a
+        local Gaia catalog. If `None`, neighbours are counted with q3c joins against the Gaia DR3 table in
+        the operations database.
+    """
     #"Sources within 3\" and G_MAG < G_MAG_source + 5"
+
+    if backend is not None:
+        return _compute_n_neighborhood_from_backend(backend, where, radius, brightness, batch_size, limit)
     
     from astra.migrations.sdss5db.catalogdb import Gaia_DR3
 
@@ -481,6 +632,33 @@ def compute_n_neighborhood(
     return n_updated            
 
 
+def _compute_n_neighborhood_from_backend(backend, where, radius, brightness, batch_size, limit):
+    q = (
+        Source
+        .select(
+            Source.pk,
+            Source.gaia_dr3_source_id
+        )
+        .where(where)
+        .limit(limit)
+        .tuples()
+    )
+    rows = list(q)
+    if not rows:
+        return 0
+
+    pks, source_ids = map(np.array, zip(*rows))
+    n_neighborhood = backend.count(source_ids, radius=radius, brightness=brightness)
+    counted = (n_neighborhood >= 0)
+    log.info(f"Counted neighbours for {np.sum(counted)} of {len(pks)} sources")
+    return update_from_staging_table(
+        Source,
+        pks[counted],
+        batch_size=batch_size,
+        n_neighborhood=n_neighborhood[counted]
+    )
+
+
 def set_missing_gaia_source_ids_to_null():
     (
         Source
@@ -501,7 +679,7 @@ def compute_f_night_time_for_boss_visits(
         &   BossVisitSpectrum.tai_end.is_null(False)
         &   BossVisitSpectrum.tai_beg.is_null(False) # sometimes we don't have tai_beg or tai_end
         ),
-        limit=None, batch_size=1000, n_time=256, max_workers=128):
+        limit=None, batch_size=1000, n_time=256, ephemeris_path=DEFAULT_SUN_EPHEMERIS_PATH):
     """
     Compute `f_night_time`, which is the observation mid-point expressed as a fraction of time between local sunset and sunrise.
     
@@ -515,10 +693,10 @@ def compute_f_night_time_for_boss_visits(
         The number of visits to update at a time.
     
     :param n_time:
-        The number of points to use when computing the sun's position.
+        The number of points to use (per 24 hour period) when computing the sun's position.
 
-    :param max_workers:
-        The maximum number of workers to use when computing `f_night_time`.
+    :param ephemeris_path:
+        The path template for the cached sunset and sunrise times of each observatory.
     """
         
     q = (
@@ -528,12 +706,12 @@ def compute_f_night_time_for_boss_visits(
         .limit(limit)
     )
 
-    get_obs_time = lambda v: Time((v.tai_beg + 0.5 * (v.tai_end - v.tai_beg))/(24*3600), format="mjd").datetime
+    get_obs_mjd = lambda v: (v.tai_beg + 0.5 * (v.tai_end - v.tai_beg))/(24*3600)
 
-    return _compute_f_night_time_for_visits(q, BossVisitSpectrum, get_obs_time, batch_size, n_time, max_workers)
+    return _compute_f_night_time_for_visits(q, BossVisitSpectrum, get_obs_mjd, batch_size, n_time, ephemeris_path)
 
     
-def compute_f_night_time_for_apogee_visits(where=ApogeeVisitSpectrum.f_night_time.is_null(), limit=None, batch_size=1000, n_time=256, max_workers=128):
+def compute_f_night_time_for_apogee_visits(where=ApogeeVisitSpectrum.f_night_time.is_null(), limit=None, batch_size=1000, n_time=256, ephemeris_path=DEFAULT_SUN_EPHEMERIS_PATH):
     """
     Compute `f_night_time`, which is the observation mid-point expressed as a fraction of time between local sunset and sunrise.
     
@@ -549,8 +727,8 @@ def compute_f_night_time_for_apogee_visits(where=ApogeeVisitSpectrum.f_night_tim
     :param n_time:
         The number of points to use (per 24 hour period) when computing the sun's position.
     
-    :param max_workers:
-        The maximum number of workers to use when computing `f_night_time`.        
+    :param ephemeris_path:
+        The path template for the cached sunset and sunrise times of each observatory.
     """
         
     q = (
@@ -559,76 +737,115 @@ def compute_f_night_time_for_apogee_visits(where=ApogeeVisitSpectrum.f_night_tim
         .where(where)
         .limit(limit)
     )
-    return _compute_f_night_time_for_visits(q, ApogeeVisitSpectrum, lambda v: v.date_obs, batch_size, n_time, max_workers)
+    return _compute_f_night_time_for_visits(q, ApogeeVisitSpectrum, lambda v: Time(v.date_obs).mjd, batch_size, n_time, ephemeris_path)
+
+
+def get_sun_horizon_crossings(observatory_name, mjd_min, mjd_max, n_time=256, path=DEFAULT_SUN_EPHEMERIS_PATH):
+    """
+    Return the times when the sun crosses the horizon (sunset and sunrise) at an observatory.
+
+    The crossings are computed once for a whole range of nights and stored on disk. If the stored
+    crossings do not cover the requested range (or were computed with a different `n_time`), they
+    are re-computed for the union of both ranges.
 
+    :param observatory_name:
+        The observatory name (e.g., `APO`, `LCO`).
+    
+    :param mjd_min:
+        The earliest MJD that the crossings must cover.
+    
+    :param mjd_max:
+        The latest MJD that the crossings must cover.
 
-def _compute_f_night_time(pk, observatory, time, n_time):
-    # Thanks to Adrian Price-Whelan for blogging about this. This code from his post: https://adrian.pw/blog/sunset-times/
-    time_grid = time + np.linspace(-24, 24, 2 * n_time) * u.hour
+    :param n_time:
+        The number of points to use (per 24 hour period) when computing the sun's position.
 
-    sun = coord.get_sun(time_grid[:, None])
-    altaz_frame = coord.AltAz(location=observatory, obstime=time_grid[:, None])
-    sun_altaz = sun.transform_to(altaz_frame)
+    :param path:
+        The path template for the cached crossings, formatted with the observatory name.
 
-    min_idx = np.array(
-        [argrelmin(a**2, axis=0, mode="wrap")[0] for a in sun_altaz.alt.degree.T]
-    ).flatten()
+    :returns:
+        A two-length tuple containing a sorted array of MJDs where the sun crosses the horizon, and
+        a boolean array indicating whether each crossing is a sunrise.
+    """
+    # Any visit needs a crossing before and after it.
+    mjd_min, mjd_max = (np.floor(mjd_min) - 1, np.ceil(mjd_max) + 1)
+    path = expand_path(path.format(observatory=observatory_name))
+    if os.path.exists(path):
+        cached = np.load(path)
+        if cached["n_time"] == n_time:
+            if cached["mjd_min"] <= mjd_min and mjd_max <= cached["mjd_max"]:
+                return (cached["mjd"], cached["rising"])
+            mjd_min, mjd_max = (min(mjd_min, cached["mjd_min"]), max(mjd_max, cached["mjd_max"]))
+
+    log.info(f"Computing sun horizon crossings at {observatory_name} from MJD {mjd_min:.0f} to {mjd_max:.0f}")
+    observatory = coord.EarthLocation.of_site(observatory_name)
+    mjd_grid = np.arange(mjd_min, mjd_max + 1 / n_time, 1 / n_time)
+    alt = np.empty(mjd_grid.size)
+    for si in range(0, mjd_grid.size, 100_000):
+        time_grid = Time(mjd_grid[si:si + 100_000], format="mjd")
+        altaz_frame = coord.AltAz(location=observatory, obstime=time_grid)
+        alt[si:si + 100_000] = coord.get_sun(time_grid).transform_to(altaz_frame).alt.degree
+    
+    # Linearly interpolate between the grid points on either side of each crossing.
+    i = np.where(np.sign(alt[:-1]) != np.sign(alt[1:]))[0]
+    mjd = mjd_grid[i] - alt[i] * (mjd_grid[i + 1] - mjd_grid[i]) / (alt[i + 1] - alt[i])
+    rising = alt[i + 1] > alt[i]
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fp:
+        np.savez(fp, mjd=mjd, rising=rising, mjd_min=mjd_min, mjd_max=mjd_max, n_time=n_time)
+    return (mjd, rising)
+
+
+def compute_f_night_time(observatory_name, mjd, n_time=256, path=DEFAULT_SUN_EPHEMERIS_PATH):
+    """
+    Compute the fraction of time between the nearest sun horizon crossings for many observing times at once.
 
-    # Take the two closest to the middle (e.g., the observing time)
-    sunset_idx, sunrise_idx = min_idx[min_idx.searchsorted(n_time) - 1:][:2]
+    This is the observation time expressed as a fraction of time between local sunset and sunrise.
 
-    f_night_time = ((time - time_grid[sunset_idx]) / (time_grid[sunrise_idx] - time_grid[sunset_idx])).value
-    return (pk, f_night_time)
+    :param observatory_name:
+        The observatory name (e.g., `APO`, `LCO`).
+    
+    :param mjd:
+        An array of observation times (MJD).
 
+    :param n_time:
+        The number of points to use (per 24 hour period) when computing the sun's position.
 
+    :param path:
+        The path template for the cached crossings, formatted with the observatory name.
+    """
+    mjd = np.atleast_1d(mjd).astype(float)
+    crossings, _ = get_sun_horizon_crossings(observatory_name, np.min(mjd), np.max(mjd), n_time, path)
+    index = np.searchsorted(crossings, mjd)
+    sunset, sunrise = (crossings[index - 1], crossings[index])
+    return (mjd - sunset) / (sunrise - sunset)
 
-def _compute_f_night_time_for_visits(q, model, get_obs_time, batch_size, n_time, max_workers):
-        
-    executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
 
-    futures, visit_by_pk, observatories = ([], {}, {})
-    for visit in tqdm(q.iterator(), desc="Submitting jobs", total=1):
-        time = Time(get_obs_time(visit))
-        observatory_name = visit.telescope[:3].upper()
+def _compute_f_night_time_for_visits(q, model, get_obs_mjd, batch_size, n_time, ephemeris_path):
 
-        try:
-            observatory = observatories[observatory_name]
-        except:
-            observatory = observatories[observatory_name] = coord.EarthLocation.of_site(observatory_name)
-        
-        futures.append(executor.submit(_compute_f_night_time, visit.pk, observatory, time, n_time))
-        visit_by_pk[visit.pk] = visit
+    visits_by_observatory = {}
+    for visit in tqdm(q.iterator(), desc="Reading visits", total=1):
+        visits_by_observatory.setdefault(visit.telescope[:3].upper(), []).append(visit)
 
-    updated = []
     n_updated = 0
-
-    with tqdm(total=len(futures), desc="Computing") as pb:
-        for future in concurrent.futures.as_completed(futures):
-            pk, f_night_time = future.result()
-            visit = visit_by_pk[pk]
-            visit.f_night_time = f_night_time
-            if not (0 <= f_night_time <= 1):
-                log.warning(f"Bad f_night_time for {visit} (f_night_time={f_night_time})")
-            updated.append(visit)
-            pb.update()                        
-
-            if len(updated) >= batch_size:
+    for observatory_name, visits in visits_by_observatory.items():
+        mjd = np.array(list(map(get_obs_mjd, visits)))
+        f_night_time = compute_f_night_time(observatory_name, mjd, n_time, ephemeris_path)
+        for visit, f in zip(visits, f_night_time):
+            visit.f_night_time = f
+            if not (0 <= f <= 1):
+                log.warning(f"Bad f_night_time for {visit} (f_night_time={f})")
+        
+        with tqdm(total=len(visits), desc=f"Updating {observatory_name}") as pb:
+            for batch in chunked(visits, batch_size):
                 n_updated += (
                     model
                     .bulk_update(
-                        updated,
+                        batch,
                         fields=[model.f_night_time],
                     )
                 )
-                updated = []
-
-    if len(updated) > 0:
-        n_updated += (
-            model
-            .bulk_update(
-                updated,
-                fields=[model.f_night_time],
-            )
-        )    
+                pb.update(len(batch))
         
     return n_updated    
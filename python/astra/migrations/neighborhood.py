@@ -0,0 +1,242 @@
+"""Count neighbouring Gaia sources using a spatial index over a local catalog."""
+
+import numpy as np
+import concurrent.futures
+from itertools import chain
+from scipy.spatial import cKDTree
+
+from astra.utils import log, expand_path
+
+
+def unit_vectors(ra, dec):
+    """
+    Convert positions to 3D unit vectors.
+
+    :param ra:
+        An array of right ascensions (in degrees).
+
+    :param dec:
+        An array of declinations (in degrees).
+    """
+    ra, dec = (np.deg2rad(ra), np.deg2rad(dec))
+    return np.vstack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)]).T
+
+
+def _chord_length(radius):
+    """The chord length between two unit vectors separated by `radius` arcseconds."""
+    return 2 * np.sin(np.deg2rad(radius / 3600) / 2)
+
+
+def count_neighbors(xyz, phot_g_mean_mag, query_xyz, query_phot_g_mean_mag, radius=3, brightness=5, tree=None):
+    """
+    Count the catalog entries within some radius of each query position that are brighter than the
+    query magnitude plus some limit. If the query positions are themselves in the catalog, then they
+    are included in the counts.
+
+    :param xyz:
+        A (N, 3) shape array of catalog unit vectors.
+
+    :param phot_g_mean_mag:
+        An array of N catalog magnitudes.
+
+    :param query_xyz:
+        A (M, 3) shape array of query unit vectors.
+
+    :param query_phot_g_mean_mag:
+        An array of M query magnitudes.
+
+    :param radius: [optional]
+        The search radius (in arcseconds).
+
+    :param brightness: [optional]
+        Only count entries with magnitudes less than the query magnitude plus `brightness`.
+
+    :param tree: [optional]
+        A pre-built `cKDTree` of `xyz`.
+
+    :returns:
+        An array of M counts.
+    """
+    M = len(query_xyz)
+    if M == 0:
+        return np.zeros(0, dtype=int)
+    tree = tree or cKDTree(xyz)
+    matches = tree.query_ball_point(query_xyz, _chord_length(radius))
+    n_matches = np.fromiter(map(len, matches), dtype=int, count=M)
+    neighbour = np.fromiter(chain.from_iterable(matches), dtype=int, count=np.sum(n_matches))
+    query = np.repeat(np.arange(M), n_matches)
+    brighter = phot_g_mean_mag[neighbour] < (query_phot_g_mean_mag[query] + brightness)
+    return np.bincount(query[brighter], minlength=M)
+
+
+def _count_neighbors_in_tile(args):
+    return count_neighbors(*args)
+
+
+class KDTreeNeighborhood(object):
+
+    def __init__(self, source_id, ra, dec, phot_g_mean_mag):
+        """
+        A neighbour-count backend that uses a KD-tree over the 3D unit vectors of a local catalog.
+
+        :param source_id:
+            An array of catalog source identifiers (e.g., Gaia DR3 source IDs).
+
+        :param ra:
+            An array of right ascensions (in degrees).
+
+        :param dec:
+            An array of declinations (in degrees).
+
+        :param phot_g_mean_mag:
+            An array of G-band magnitudes.
+        """
+        source_id = np.asarray(source_id, dtype=np.int64)
+        self.sort_indices = np.argsort(source_id)
+        self.source_id = source_id[self.sort_indices]
+        self.ra = np.asarray(ra, dtype=float)[self.sort_indices]
+        self.dec = np.asarray(dec, dtype=float)[self.sort_indices]
+        self.phot_g_mean_mag = np.asarray(phot_g_mean_mag, dtype=float)[self.sort_indices]
+        self.xyz = unit_vectors(self.ra, self.dec)
+        return None
+
+    @classmethod
+    def from_path(cls, path, **kwargs):
+        """
+        Load a local catalog that has `source_id`, `ra`, `dec`, and `phot_g_mean_mag` columns.
+
+        :param path:
+            The path of the catalog. This can be any format that `astropy.table.Table` can read.
+        """
+        from astropy.table import Table
+
+        t = Table.read(expand_path(path))
+        log.info(f"Loaded {len(t)} catalog sources from {path}")
+        return cls(
+            np.array(t["source_id"]),
+            np.array(t["ra"]),
+            np.array(t["dec"]),
+            np.ma.filled(np.ma.array(t["phot_g_mean_mag"], dtype=float), np.nan),
+            **kwargs
+        )
+
+    @property
+    def tree(self):
+        try:
+            return self._tree
+        except AttributeError:
+            self._tree = cKDTree(self.xyz)
+            return self._tree
+
+    def _count(self, indices, radius, brightness):
+        return count_neighbors(
+            self.xyz,
+            self.phot_g_mean_mag,
+            self.xyz[indices],
+            self.phot_g_mean_mag[indices],
+            radius=radius,
+            brightness=brightness,
+            tree=self.tree
+        )
+
+    def count(self, source_ids, radius=3, brightness=5):
+        """
+        Count the neighbours of catalog sources, excluding the source itself.
+
+        :param source_ids:
+            An array of source identifiers to count neighbours for.
+
+        :param radius: [optional]
+            The search radius (in arcseconds).
+
+        :param brightness: [optional]
+            Only count neighbours with G-band magnitudes less than the source magnitude plus `brightness`.
+
+        :returns:
+            An array of neighbour counts, with -1 for any source that is not in the catalog or has no
+            G-band magnitude.
+        """
+        source_ids = np.atleast_1d(np.asarray(source_ids, dtype=np.int64))
+        indices = np.clip(np.searchsorted(self.source_id, source_ids), 0, max(0, len(self.source_id) - 1))
+        found = (self.source_id[indices] == source_ids) if len(self.source_id) else np.zeros(len(source_ids), dtype=bool)
+        found[found] = np.isfinite(self.phot_g_mean_mag[indices[found]])
+
+        n_neighborhood = -np.ones(len(source_ids), dtype=int)
+        n_neighborhood[found] = self._count(indices[found], radius, brightness) - 1 # exclude self
+        return n_neighborhood
+
+
+class HEALPixNeighborhood(KDTreeNeighborhood):
+
+    def __init__(self, source_id, ra, dec, phot_g_mean_mag, nside=32, max_workers=1):
+        """
+        A neighbour-count backend that partitions a local catalog into HEALPix tiles, and builds a KD-tree
+        for each tile (and its neighbouring tiles) so that tiles can be counted in parallel.
+
+        :param source_id:
+            An array of catalog source identifiers (e.g., Gaia DR3 source IDs).
+
+        :param ra:
+            An array of right ascensions (in degrees).
+
+        :param dec:
+            An array of declinations (in degrees).
+
+        :param phot_g_mean_mag:
+            An array of G-band magnitudes.
+
+        :param nside: [optional]
+            The number of sides of the HEALPix tiling. Tiles must be much larger than the search radius.
+
+        :param max_workers: [optional]
+            The number of processes to count tiles with.
+        """
+        from healpy import ang2pix
+
+        super(HEALPixNeighborhood, self).__init__(source_id, ra, dec, phot_g_mean_mag)
+        self.nside = nside
+        self.max_workers = max_workers
+        self.pixel = ang2pix(nside, self.ra, self.dec, lonlat=True)
+        self.pixel_order = np.argsort(self.pixel, kind="stable")
+        self.sorted_pixel = self.pixel[self.pixel_order]
+        return None
+
+    def _tile_members(self, pixels):
+        si = np.searchsorted(self.sorted_pixel, pixels, side="left")
+        ei = np.searchsorted(self.sorted_pixel, pixels, side="right")
+        return np.hstack([self.pixel_order[s:e] for s, e in zip(si, ei)])
+
+    def _count(self, indices, radius, brightness):
+        from healpy import get_all_neighbours, nside2resol
+
+        if radius / 3600 >= 0.5 * np.rad2deg(nside2resol(self.nside)):
+            raise ValueError(f"radius of {radius}\" is too large for HEALPix tiles with nside={self.nside}")
+
+        query_pixel = self.pixel[indices]
+        order = np.argsort(query_pixel, kind="stable")
+        pixels, starts = np.unique(query_pixel[order], return_index=True)
+        tiles = np.split(order, starts[1:])
+
+        def iter_tile_args():
+            for pixel, tile in zip(pixels, tiles):
+                nearby = get_all_neighbours(self.nside, pixel)
+                members = self._tile_members(np.sort(np.unique(np.append(nearby[nearby >= 0], pixel))))
+                yield (
+                    self.xyz[members],
+                    self.phot_g_mean_mag[members],
+                    self.xyz[indices[tile]],
+                    self.phot_g_mean_mag[indices[tile]],
+                    radius,
+                    brightness
+                )
+
+        if self.max_workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(self.max_workers) as executor:
+                counts = list(executor.map(_count_neighbors_in_tile, iter_tile_args(), chunksize=16))
+        else:
+            counts = list(map(_count_neighbors_in_tile, iter_tile_args()))
+
+        n = np.zeros(len(indices), dtype=int)
+        for tile, tile_counts in zip(tiles, counts):
+            n[tile] = tile_counts
+        return n
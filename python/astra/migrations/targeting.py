@@ -1,6 +1,8 @@
+import numpy as np
+from itertools import chain
 from peewee import fn, chunked
 from tqdm import tqdm
-from astra.models.source import Source
+from astra.models.source import Source, SourceCarton
 from astra.utils import log, expand_path
 from astropy.table import Table
 from astropy.table import join
@@ -30,95 +32,290 @@ def merge_carton_to_bit_mapping_and_meta():
 
 
 
-def migrate_carton_assignments_to_bigbitfield(
-    where=None,
-    batch_size=500,
-    limit=None,
-    from_cache=False
-):
+def carton_bitfields(carton_pks, bits, n_bytes=None):
+    """
+    Build `BigBitField` bytes for groups of carton assignments.
 
-    bit_mapping = {}
-    for row in get_carton_to_bit_mapping():
-        row_as_dict = dict(zip(row.keys(), row.values()))
-        bit_mapping[row_as_dict["carton_pk"]] = row_as_dict
+    :param carton_pks:
+        A list where each entry is a list of carton primary keys assigned to one source.
 
-    # Retrieve sources which have gaia identifiers but not astrometry
-    q = (
-        Source
-        .select()
-    )
+    :param bits:
+        An array that maps each carton primary key to a bit position.
+
+    :param n_bytes: [optional]
+        The length of each bitfield. If `None`, the minimum length needed for all bits is used.
+
+    :returns:
+        A list of bytes, one per source. Bit `b` is bit `b % 8` of byte `b // 8`, as in `BigBitField`.
+    """
+    n_cartons = np.array([len(c) for c in carton_pks], dtype=int)
+    source = np.repeat(np.arange(len(carton_pks)), n_cartons)
+    set_bits = bits[np.fromiter(chain.from_iterable(carton_pks), dtype=int, count=np.sum(n_cartons))]
+    n_bytes = n_bytes or (1 + np.max(bits) // 8)
+
+    flags = np.zeros((len(carton_pks), 8 * n_bytes), dtype=bool)
+    flags[source, set_bits] = True
+    return [bytes(b) for b in np.packbits(flags, axis=1, bitorder="little")]
+
+
+def _or_bitfields(a, b):
+    a, b = (np.frombuffer(a or b"", dtype=np.uint8), np.frombuffer(b or b"", dtype=np.uint8))
+    if a.size < b.size:
+        a, b = (b, a)
+    c = a.copy()
+    c[:b.size] |= b
+    return bytes(c)
+
+
+def _insert_source_cartons(source_pks, carton_bits, batch_size):
+    """
+    Insert (carton_bit, source_pk) rows into the `SourceCarton` link table, ignoring existing rows.
+    """
+    rows = [(int(bit), pk) for pk, bits in zip(source_pks, carton_bits) for bit in set(bits)]
+    for chunk in chunked(rows, batch_size):
+        (
+            SourceCarton
+            .insert_many(chunk, fields=[SourceCarton.carton_bit, SourceCarton.source])
+            .on_conflict_ignore()
+            .execute()
+        )
+    return len(rows)
+
+
+def _flags_to_bits(flags):
+    if flags is None:
+        return set()
+    return set(np.flatnonzero(np.unpackbits(np.frombuffer(bytes(flags), dtype=np.uint8), bitorder="little")).tolist())
+
+
+def _get_source_cartons(source_pks):
+    """
+    Return a dictionary of the carton bits in the `SourceCarton` link table for each source.
+    """
+    source_cartons = { pk: set() for pk in source_pks }
+    # Keep the number of bound variables per query within the limit of SQLite.
+    for chunk in chunked(source_pks, 900):
+        q = (
+            SourceCarton
+            .select(SourceCarton.source, SourceCarton.carton_bit)
+            .where(SourceCarton.source.in_(list(chunk)))
+            .tuples()
+        )
+        for pk, bit in q:
+            source_cartons[pk].add(bit)
+    return source_cartons
+
+
+def _iter_source_carton_differences(where=None, chunk_size=100_000):
+    """
+    Yield `(source_pk, carton_bits)` tuples for sources where the `SourceCarton` link table does not match
+    the carton bits in `Source.sdss5_target_flags`.
+    """
+    from astra.migrations.utils import iter_column_chunks
+
+    q = Source.select(Source.pk, Source.sdss5_target_flags)
     if where:
         q = q.where(where)
-    
-    q = (
-        q
-        .limit(limit)
-        .iterator()
-    )
 
-    updated = 0
-    total = limit or Source.select().where(where).count()
-    
+    for pks, flags in tqdm(iter_column_chunks(q, Source.pk, chunk_size), desc="Comparing cartons"):
+        source_cartons = _get_source_cartons(pks)
+        for pk, f in zip(pks, flags):
+            bits = _flags_to_bits(f)
+            if bits != source_cartons[pk]:
+                yield (pk, bits)
+
+
+def check_source_cartons(where=None, chunk_size=100_000):
+    """
+    Check that the `SourceCarton` link table agrees with the `Source.sdss5_target_flags` bitfields.
+
+    :param where: [optional]
+        A condition to restrict which sources are checked.
+
+    :param chunk_size: [optional]
+        The number of sources to read at once.
+
+    :returns:
+        A list of primary keys of sources where the two disagree.
+    """
+    source_pks = [pk for pk, bits in _iter_source_carton_differences(where, chunk_size)]
+    if source_pks:
+        log.warning(
+            f"The carton memberships of {len(source_pks)} sources do not match their targeting flags. "
+            f"Use `sync_source_cartons_from_bigbitfield` to update them."
+        )
+    return source_pks
+
+
+def sync_source_cartons_from_bigbitfield(where=None, batch_size=10_000, chunk_size=100_000):
+    """
+    Update the `SourceCarton` link table so that it matches the `Source.sdss5_target_flags` bitfields.
+
+    Link rows are added for bits that are set, and removed for bits that are not set.
+
+    :param where: [optional]
+        A condition to restrict which sources are synchronised.
+
+    :param batch_size: [optional]
+        The number of link rows to insert per statement.
+
+    :param chunk_size: [optional]
+        The number of sources to read at once.
+
+    :returns:
+        The number of sources whose carton memberships were updated.
+    """
+    n = 0
+    for differences in chunked(_iter_source_carton_differences(where, chunk_size), chunk_size):
+        pks, carton_bits = zip(*differences)
+        with SourceCarton._meta.database.atomic():
+            for chunk in chunked(pks, 900):
+                SourceCarton.delete().where(SourceCarton.source.in_(list(chunk))).execute()
+            _insert_source_cartons(pks, carton_bits, batch_size)
+        n += len(pks)
+    return n
+
+
+def _iter_carton_assignments_by_sdss_id(carton_pks=None, chunk_size=100_000, from_cache=False):
+    """
+    Yield chunks of `(sdss_id, carton_pks)` tuples, sorted by `sdss_id`.
+    """
     if from_cache:
         import pickle
         with open(expand_path("~/20230926.pkl"), "rb") as fp:
-            q_cartons = pickle.load(fp)
+            sdss_ids, assigned_carton_pks = map(np.array, zip(*pickle.load(fp)))
+        if carton_pks is not None:
+            keep = np.isin(assigned_carton_pks, carton_pks)
+            sdss_ids, assigned_carton_pks = (sdss_ids[keep], assigned_carton_pks[keep])
+        order = np.lexsort((assigned_carton_pks, sdss_ids))
+        sdss_ids, assigned_carton_pks = (sdss_ids[order], assigned_carton_pks[order])
+        unique_sdss_ids, starts = np.unique(sdss_ids, return_index=True)
+        groups = np.split(assigned_carton_pks, starts[1:])
+        for si in range(0, len(unique_sdss_ids), chunk_size):
+            yield (unique_sdss_ids[si:si + chunk_size].tolist(), groups[si:si + chunk_size])
+        return None
 
-    else:
-        from astra.migrations.sdss5db.targetdb import Target, CartonToTarget, Assignment
-        from astra.migrations.sdss5db.catalogdb import CatalogdbModel
+    from astra.migrations.sdss5db.targetdb import Target, CartonToTarget, Assignment
+    from astra.migrations.sdss5db.catalogdb import CatalogdbModel
+    from astra.migrations.utils import iter_column_chunks
 
-        class SDSS_ID_Flat(CatalogdbModel):
-            class Meta:
-                table_name = "sdss_id_flat"
+    class SDSS_ID_Flat(CatalogdbModel):
+        class Meta:
+            table_name = "sdss_id_flat"
 
-        q_cartons = (
-            SDSS_ID_Flat
-            .select(
-                SDSS_ID_Flat.sdss_id,
-                CartonToTarget.carton_pk,
-            )
-            .join(Target, on=(SDSS_ID_Flat.catalogid == Target.catalogid))
-            .join(CartonToTarget, on=(Target.pk == CartonToTarget.target_pk))
-            .join(Assignment, on=(Assignment.carton_to_target_pk == CartonToTarget.pk))
-            .tuples()
-            .iterator()
+    q = (
+        SDSS_ID_Flat
+        .select(
+            SDSS_ID_Flat.sdss_id,
+            fn.array_agg(CartonToTarget.carton_pk.distinct()),
         )
+        .join(Target, on=(SDSS_ID_Flat.catalogid == Target.catalogid))
+        .join(CartonToTarget, on=(Target.pk == CartonToTarget.target_pk))
+        .join(Assignment, on=(Assignment.carton_to_target_pk == CartonToTarget.pk))
+        .group_by(SDSS_ID_Flat.sdss_id)
+    )
+    if carton_pks is not None:
+        q = q.where(CartonToTarget.carton_pk.in_(list(carton_pks)))
+    yield from iter_column_chunks(q, SDSS_ID_Flat.sdss_id, chunk_size)
 
-    missing, update, sources = (set(), {}, {})
-    for source in tqdm(q, desc="Preparing sources", total=1):
-        sources[source.sdss_id] = source
-
-    n_skipped, n_applied = (0, 0)
-    for sdss_id, carton_pk in tqdm(q_cartons, total=len(q_cartons) if from_cache else 1, desc="Assiging cartons to sources"):
-        try:
-            s = sources[sdss_id]
-        except:
-            missing.add(sdss_id)
-            n_skipped += 1
-        else:
-            s.sdss5_target_flags.set_bit(bit_mapping[carton_pk]["bit"])
-            update[sdss_id] = s
-            n_applied += 1
-    
-    log.info(f"Flagged {n_applied} source-carton assignments, and skipped {n_skipped} ({len(missing)} sources missing)")
 
-    if len(missing) > 0:
-        log.warning(f"There were {len(missing)} sdss_ids with target assignments that are not in Astra's database")
+def migrate_carton_assignments_to_bigbitfield(
+    where=None,
+    batch_size=10_000,
+    limit=None,
+    from_cache=False,
+    carton_pks=None,
+    chunk_size=100_000,
+):
+    """
+    Set the SDSS-V targeting flags (`Source.sdss5_target_flags`) from the carton assignments in the
+    targeting database.
+
+    Assignments are grouped by `sdss_id` on the database side and streamed in chunks. The bitfield for
+    each source is built with `numpy.packbits`, combined (bitwise OR) with the existing flags, and written
+    with a staging-table update. The `SourceCarton` link table is updated with the same assignments.
+
+    :param where: [optional]
+        A condition to restrict which sources are updated.
+
+    :param batch_size: [optional]
+        The number of rows to insert into the staging table per statement.
+
+    :param limit: [optional]
+        Limit the number of sources to update.
+
+    :param from_cache: [optional]
+        Read `(sdss_id, carton_pk)` assignments from a local pickle file instead of the targeting database.
 
-    updated = 0
-    with tqdm(desc="Updating", total=len(update)) as pb:
+    :param carton_pks: [optional]
+        Only set the bits of these cartons (e.g., cartons that were added since the last migration).
 
-        for chunk in chunked(update.values(), batch_size):
-            updated += (
-                Source
-                .bulk_update(
-                    chunk,
-                    fields=[
+    :param chunk_size: [optional]
+        The number of sources to process at once.
+    """
+    from astra.migrations.utils import update_from_staging_table
+
+    mapping = get_carton_to_bit_mapping()
+    bits = -np.ones(1 + np.max(mapping["carton_pk"]), dtype=int)
+    bits[np.array(mapping["carton_pk"])] = mapping["bit"]
+    n_bytes = 1 + np.max(mapping["bit"]) // 8
+
+    n_updated, n_missing, n_unknown = (0, 0, 0)
+    chunks = _iter_carton_assignments_by_sdss_id(carton_pks, chunk_size, from_cache)
+    with tqdm(desc="Updating", unit="sources") as pb:
+        for sdss_ids, assigned_carton_pks in chunks:
+            existing = {}
+            # Keep the number of bound variables per query within the limit of SQLite.
+            for chunk_sdss_ids in chunked(sdss_ids, 900):
+                q = (
+                    Source
+                    .select(
+                        Source.sdss_id,
+                        Source.pk,
                         Source.sdss5_target_flags
-                    ]
+                    )
+                    .where(Source.sdss_id.in_(list(chunk_sdss_ids)))
                 )
+                if where:
+                    q = q.where(where)
+                existing.update({ sdss_id: (pk, flags) for sdss_id, pk, flags in q.tuples() })
+
+            keep = [i for i, sdss_id in enumerate(sdss_ids) if sdss_id in existing]
+            n_missing += len(sdss_ids) - len(keep)
+            if limit is not None:
+                keep = keep[:limit - n_updated]
+
+            known = []
+            for i in keep:
+                cartons = np.array(assigned_carton_pks[i], dtype=int)
+                is_known = (cartons < bits.size)
+                is_known[is_known] = (bits[cartons[is_known]] >= 0)
+                n_unknown += np.sum(~is_known)
+                known.append(cartons[is_known])
+
+            flags = [
+                _or_bitfields(existing[sdss_ids[i]][1], flag)
+                for i, flag in zip(keep, carton_bitfields(known, bits, n_bytes))
+            ]
+            _insert_source_cartons(
+                [existing[sdss_ids[i]][0] for i in keep],
+                [bits[cartons] for cartons in known],
+                batch_size
+            )
+            n_updated += update_from_staging_table(
+                Source,
+                np.array([sdss_ids[i] for i in keep]),
+                batch_size=batch_size,
+                key=Source.sdss_id,
+                sdss5_target_flags=np.array(flags, dtype=object),
             )
-            pb.update(batch_size)
+            pb.update(len(sdss_ids))
+            if limit is not None and n_updated >= limit:
+                break
+
+    if n_unknown > 0:
+        log.warning(f"Skipped {n_unknown} assignments to cartons that have no bit mapping")
+    if n_missing > 0:
+        log.warning(f"There were {n_missing} sdss_ids with target assignments that are not in Astra's database")
 
-    return updated
\ No newline at end of file
+    return n_updated
@@ -1,42 +1,87 @@
-from peewee import chunked
+import numpy as np
+from uuid import uuid4
+from peewee import (
+    chunked, 
+    fn, 
+    Select, 
+    Value, 
+    PostgresqlDatabase,
+    Model,
+    BigIntegerField,
+    BlobField,
+    BooleanField,
+    FloatField,
+    TextField,
+)
 from astra.utils import flatten
 from astra.models.base import database
 from astra.models.spectrum import Spectrum
 from tqdm import tqdm
 
-def generate_new_spectrum_pks(N, batch_size=100):
-    with database.atomic():
-        # Need to chunk this to avoid SQLite limits.
-        with tqdm(desc="Assigning spectrum identifiers", unit="spectra", total=N) as pb:
-            for chunk in chunked([{"spectrum_type_flags": 0}] * N, batch_size):                
-                yield from flatten(
+
+def reserve_spectrum_pks(N):
+    """
+    Create `N` new `Spectrum` rows and return their primary keys.
+
+    On PostgreSQL this is a single `INSERT ... SELECT ... FROM generate_series(1, N) RETURNING pk`
+    statement, so the primary keys are drawn from the sequence in one round-trip. On SQLite the
+    database is locked for writing, a contiguous block of primary keys is reserved after the
+    current maximum, and the rows are inserted with those known primary keys in one statement.
+
+    :param N:
+        The number of primary keys to reserve.
+
+    :returns:
+        A list of `N` primary keys, in increasing order.
+    """
+    if N <= 0:
+        return []
+
+    database = Spectrum._meta.database
+    if isinstance(database, PostgresqlDatabase):
+        with database.atomic():
+            return sorted(
+                flatten(
                     Spectrum
-                    .insert_many(chunk)
+                    .insert_from(
+                        Select(columns=[Value(0)], from_list=[fn.generate_series(1, N)]),
+                        fields=[Spectrum.spectrum_type_flags]
+                    )
                     .returning(Spectrum.pk)
                     .tuples()
                     .execute()
                 )
-                pb.update(min(batch_size, len(chunk)))
-                pb.refresh()
+            )
+    
+    # BEGIN IMMEDIATE holds the write lock until the rows exist.
+    with database.atomic("IMMEDIATE"):
+        start = (Spectrum.select(fn.max(Spectrum.pk)).scalar() or 0) + 1
+        base = Select(columns=(Value(start).alias("pk"), )).cte("reserved", recursive=True)
+        recursive = Select(columns=(base.c.pk + 1, )).from_(base).where(base.c.pk < (start + N - 1))
+        reserved = base.union_all(recursive)
+        (
+            Spectrum
+            .insert_from(
+                reserved.select_from(reserved.c.pk, Value(0)),
+                fields=[Spectrum.pk, Spectrum.spectrum_type_flags]
+            )
+            .execute()
+        )
+    return list(range(start, start + N))
 
 
-def enumerate_new_spectrum_pks(iter, batch_size=100):
-    N = len(iter)
+def generate_new_spectrum_pks(N):
+    with tqdm(desc="Assigning spectrum identifiers", unit="spectra", total=N) as pb:
+        spectrum_pks = reserve_spectrum_pks(N)
+        pb.update(N)
+    yield from spectrum_pks
 
-    with database.atomic():
-        for chunk, batch in zip(chunked(iter, batch_size), chunked([{"spectrum_type_flags": 0}] * len(iter), batch_size)):
-            spectrum_pks = flatten(
-                Spectrum
-                .insert_many(batch)
-                .returning(Spectrum.pk)
-                .tuples()
-                .execute()
-            )
-            for spectrum_pk, item in zip(spectrum_pks, chunk):
-                yield (spectrum_pk, item)
 
+def enumerate_new_spectrum_pks(iter):
+    yield from zip(reserve_spectrum_pks(len(iter)), iter)
 
-def upsert_many(model, returning, data, batch_size, desc="Upserting"):
+
+def upsert_many(model, returning, data, batch_size, desc="Upserting", fields=None):
     returned = []
     with database.atomic():
         with tqdm(desc=desc, total=len(data)) as pb:
@@ -44,7 +89,7 @@ def upsert_many(model, returning, data, batch_size, desc="Upserting"):
                 returned.extend(
                     flatten(
                         model
-                        .insert_many(chunk)
+                        .insert_many(chunk, fields=fields)
                         .on_conflict_ignore()
                         .returning(returning)
                         .tuples()
@@ -54,4 +99,187 @@ def upsert_many(model, returning, data, batch_size, desc="Upserting"):
                 pb.update(min(batch_size, len(chunk)))
                 pb.refresh()
 
-    return tuple(returned)
\ No newline at end of file
+    return tuple(returned)
+
+def _staging_field(values):
+    values = np.asarray(values)
+    if values.dtype.kind == "O":
+        # Columns with nulls are object arrays: use the type of the non-null values.
+        present = [v for v in values.flat if v is not None]
+        if present and isinstance(present[0], (bytes, bytearray)):
+            return BlobField(null=True)
+        if present:
+            values = np.array(present)
+    kind = values.dtype.kind
+    if kind == "S":
+        return BlobField(null=True)
+    if kind == "b":
+        return BooleanField(null=True)
+    if kind in "iu":
+        return BigIntegerField(null=True)
+    if kind == "f":
+        return FloatField(null=True)
+    return TextField(null=True)
+
+
+def _insert_rows(model, fields, rows, batch_size):
+    """
+    Insert pre-built tuples into a table using the database cursor directly.
+    """
+    database = model._meta.database
+    sql, _ = model.insert_many(rows[:1], fields=fields).sql()
+    cursor = database.cursor()
+    if isinstance(database, PostgresqlDatabase):
+        from psycopg2.extras import execute_values
+        execute_values(cursor, sql[:sql.rindex(" VALUES ")] + " VALUES %s", rows, page_size=batch_size)
+    else:
+        for chunk in chunked(rows, batch_size):
+            cursor.executemany(sql, chunk)
+
+
+def update_from_staging_table(model, pks, batch_size=10_000, key=None, **columns):
+    """
+    Update many rows of a model with per-row values, by joining against a temporary staging table.
+
+    The values are inserted into a temporary table as pre-built tuples through the database cursor
+    (bypassing per-row query generation), and then the model
+    table is updated with a single `UPDATE ... FROM staging WHERE model.key = staging.key` statement.
+    This avoids the large `CASE WHEN` statements generated by `Model.bulk_update`.
+
+    :param model:
+        The model to update.
+
+    :param pks:
+        An array of primary keys (or values of `key`) of the rows to update.
+
+    :param batch_size: [optional]
+        The number of rows to insert into the staging table per statement.
+
+    :param key: [optional]
+        A unique field of `model` to match rows on. If `None`, the primary key is used.
+
+    :param \**columns:
+        Keyword arguments of field names and arrays of values (one per primary key).
+
+    :returns:
+        The number of rows updated.
+    """
+    pks = np.asarray(pks)
+    if pks.size == 0:
+        return 0
+    
+    names = list(columns.keys())
+    attrs = { name: _staging_field(columns[name]) for name in names }
+    attrs["staging_pk"] = BigIntegerField(primary_key=True)
+    attrs["Meta"] = type("Meta", (), dict(
+        database=model._meta.database,
+        table_name=f"staging_{model._meta.table_name}_{uuid4().hex[:8]}",
+        schema=None,
+    ))
+    Staging = type("Staging", (Model, ), attrs)
+
+    fields = [Staging.staging_pk] + [getattr(Staging, name) for name in names]
+    rows = list(zip(pks.tolist(), *(np.asarray(columns[name]).tolist() for name in names)))
+
+    database = model._meta.database
+    with database.atomic():
+        Staging.create_table(temporary=True)
+        try:
+            _insert_rows(Staging, fields, rows, batch_size)
+
+            n_updated = (
+                model
+                .update({ model._meta.fields[name]: getattr(Staging, name) for name in names })
+                .from_(Staging)
+                .where((key or model._meta.primary_key) == Staging.staging_pk)
+                .execute()
+            )
+        finally:
+            Staging.drop_table()
+    return n_updated
+
+
+def iter_column_chunks(query, primary_key, chunk_size=100_000, limit=None):
+    """
+    Iterate over the columns of a query in pages of primary key.
+
+    Paging by primary key (rather than holding a cursor open) means that the table can be safely updated
+    between pages, and that rows which no longer match the query after they are updated are not skipped.
+
+    :param query:
+        A select query whose first column is the primary key.
+
+    :param primary_key:
+        The primary key field to page by.
+
+    :param chunk_size: [optional]
+        The number of rows to fetch per page.
+
+    :param limit: [optional]
+        The maximum number of rows to fetch in total.
+
+    :returns:
+        A generator that yields a tuple of columns for each page.
+    """
+    last_pk, n_fetched = (None, 0)
+    while limit is None or n_fetched < limit:
+        page = query if last_pk is None else query.where(primary_key > last_pk)
+        n = chunk_size if limit is None else min(chunk_size, limit - n_fetched)
+        rows = list(page.order_by(primary_key).limit(n).tuples())
+        if not rows:
+            break
+        last_pk = rows[-1][0]
+        n_fetched += len(rows)
+        yield tuple(zip(*rows))
+
+
+def _as_array(values, field):
+    if isinstance(field, FloatField):
+        return np.array(values, dtype=float)
+    return np.array(values)
+
+
+def update_columns(model, fields, function, where=None, limit=None, chunk_size=100_000, batch_size=10_000):
+    """
+    Update columns of a model by applying a vectorized function to other columns.
+
+    Rows are fetched as `(pk, *fields)` tuples in large pages, converted to arrays (with nulls in float
+    fields as NaNs), and the results are written back with a staging-table join update.
+
+    :param model:
+        The model to update.
+
+    :param fields:
+        A list of fields of `model` to give to `function`.
+
+    :param function:
+        A callable that takes one array per field and returns a dictionary of field names and arrays
+        of new values.
+
+    :param where: [optional]
+        A condition to restrict which rows are updated.
+
+    :param limit: [optional]
+        The maximum number of rows to update.
+
+    :param chunk_size: [optional]
+        The number of rows to fetch and compute at once.
+
+    :param batch_size: [optional]
+        The number of rows to insert into the staging table per statement.
+
+    :returns:
+        The number of rows updated.
+    """
+    primary_key = model._meta.primary_key
+    q = model.select(primary_key, *fields)
+    if where is not None:
+        q = q.where(where)
+
+    n_updated = 0
+    with tqdm(total=limit or q.count()) as pb:
+        for pks, *values in iter_column_chunks(q, primary_key, chunk_size, limit):
+            columns = function(*[_as_array(v, f) for v, f in zip(values, fields)])
+            n_updated += update_from_staging_table(model, np.array(pks), batch_size=batch_size, **columns)
+            pb.update(len(pks))
+    return n_updated
@@ -21,7 +21,7 @@ from astra.models.line_forest import LineForest
 from astra.models.mdwarftype import MDwarfType
 from astra.models.slam import Slam
 from astra.models.snow_white import SnowWhite
-from astra.models.source import Source
+from astra.models.source import Source, SourceCarton
 from astra.models.spectrum import Spectrum, SpectrumMixin
 from astra.models.the_payne import ThePayne
 from astra.models.the_cannon import TheCannon
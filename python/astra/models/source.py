@@ -11,6 +11,7 @@ from peewee import (
     SmallIntegerField,
     DateTimeField,
     BooleanField,
+    CompositeKey,
     fn,
 )
 import numpy as np
@@ -533,15 +534,8 @@ class Source(BaseModel):
     @property
     def sdss5_target_bits(self):
         """Return the bit positions of targeting flags that this source is assigned."""
-        i, bits, cur_size = (0, [], len(self.sdss5_target_flags._buffer))
-        while True:
-            byte_num, byte_offset = divmod(i, 8)
-            if byte_num >= cur_size:
-                break
-            if bool(self.sdss5_target_flags._buffer[byte_num] & (1 << byte_offset)):
-                bits.append(i)
-            i += 1
-        return tuple(bits)
+        buffer = np.frombuffer(bytes(self.sdss5_target_flags._buffer), dtype=np.uint8)
+        return tuple(np.flatnonzero(np.unpackbits(buffer, bitorder="little")).tolist())
 
     @hybrid_method
     def assigned_to_carton_attribute(self, name, value):
@@ -638,26 +632,60 @@ class Source(BaseModel):
         :param bit:
             The carton bit position.
         """
-        return (
-            (fn.length(self.sdss5_target_flags) > int(bit / 8))
-        &   (fn.get_bit(self.sdss5_target_flags, int(bit)) > 0)
-        )
+        return self.is_any_sdss5_target_bit_set(bit)
     
     @hybrid_method
     def is_any_sdss5_target_bit_set(self, *bits):
         """
-        An expression to evaluate whether this source is assigned to any carton with the given bit positions.
+        Evaluate whether this source is assigned to any carton with the given bit positions.
         
         :param bits:
             The carton bit positions.
         """
-        expression = self.is_sdss5_target_bit_set(bits[0])
-        if len(bits) > 1:
-            for bit in bits[1:]:
-                expression = expression | self.is_sdss5_target_bit_set(bit)
-        return expression
+        return not set(map(int, bits)).isdisjoint(self.sdss5_target_bits)
+
+    @is_any_sdss5_target_bit_set.expression
+    def is_any_sdss5_target_bit_set(cls, *bits):
+        """
+        An expression to evaluate whether a source is assigned to any carton with the given bit positions.
+
+        This uses the `SourceCarton` link table (and its index on carton bit), rather than testing each
+        bit of `Source.sdss5_target_flags`, so that selections by carton or program are index scans.
+
+        :param bits:
+            The carton bit positions.
+        """
+        return cls.pk.in_(
+            SourceCarton
+            .select(SourceCarton.source)
+            .where(SourceCarton.carton_bit.in_([int(bit) for bit in bits]))
+        )
     
 
+    def save(self, *args, **kwargs):
+        """
+        Save this source, and update its `SourceCarton` link rows to match its targeting flags.
+        """
+        saved = super(Source, self).save(*args, **kwargs)
+        only = kwargs.get("only", None)
+        if "sdss5_target_flags" in self._meta.fields and (only is None or Source.sdss5_target_flags in only):
+            bits = list(self.sdss5_target_bits) if self.sdss5_target_flags is not None else []
+            with self._meta.database.atomic():
+                (
+                    SourceCarton
+                    .delete()
+                    .where((SourceCarton.source == self.pk) & SourceCarton.carton_bit.not_in(bits))
+                    .execute()
+                )
+                if bits:
+                    (
+                        SourceCarton
+                        .insert_many([(bit, self.pk) for bit in bits], fields=[SourceCarton.carton_bit, SourceCarton.source])
+                        .on_conflict_ignore()
+                        .execute()
+                    )
+        return saved
+
     @property
     def spectra(self):
         """A generator that yields all spectra associated with this source."""
@@ -666,6 +694,24 @@ class Source(BaseModel):
                 yield from column.model.select().where(expr)
 
 
+class SourceCarton(BaseModel):
+
+    """ A source assigned to a targeting carton, kept in sync with `Source.sdss5_target_flags`. """
+
+    carton_bit = SmallIntegerField(help_text="Carton bit position")
+    source = ForeignKeyField(
+        Source,
+        column_name="source_pk",
+        on_delete="CASCADE",
+        backref="carton_assignments",
+        help_text=Glossary.source_pk,
+    )
+
+    class Meta:
+        # The primary key index is on (carton_bit, source_pk), for selecting sources by carton.
+        primary_key = CompositeKey("carton_bit", "source")
+
+
 @cache
 def get_carton_to_bit_mapping():
     t = Table.read(expand_path("$MWM_ASTRA/aux/targeting-bits/sdss5_target_1_with_groups.csv"))
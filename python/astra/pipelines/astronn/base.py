@@ -7,7 +7,7 @@ from tqdm import tqdm
 from astra.utils import log
 from astra.models.astronn import AstroNN
 
-from astroNN.apogee import apogee_continuum 
+from astra.pipelines.astronn.continuum import apogee_continuum_batch
 
 
 def _prepare_data(spectrum):
@@ -19,12 +19,8 @@ def _prepare_data(spectrum):
     except:
         return (spectrum.spectrum_pk, spectrum.source_pk, None, None)
 
-    #### continuum normalization
-    P_new = 7514
-    norm_flux = np.zeros((N, P_new))
-    norm_flux_err = np.zeros((N, P_new))
-    for i in range(N):
-        norm_flux[i, :], norm_flux_err[i, :] = apogee_continuum(flux[i, :], e_flux[i, :], bitmask=bitmask[i, :], dr = 17)
+    #### continuum normalization (all visits at once)
+    norm_flux, norm_flux_err = apogee_continuum_batch(flux, e_flux, bitmask=bitmask, dr=17)
 
     return (spectrum.spectrum_pk, spectrum.source_pk, norm_flux, norm_flux_err)
 
@@ -0,0 +1,160 @@
+"""Batched APOGEE continuum normalization, equivalent to `astroNN.apogee.apogee_continuum`."""
+
+import os
+import numpy as np
+from functools import cache
+
+# Start and end pixels of each chip in the full (8575-pixel) APOGEE spectrum.
+APOGEE_CHIPS = {
+    13: ((322, 3243), (3648, 6050), (6412, 8306)),
+    14: ((246, 3274), (3585, 6080), (6344, 8335)),
+    16: ((246, 3274), (3585, 6080), (6344, 8335)),
+    17: ((246, 3274), (3585, 6080), (6344, 8335)),
+}
+
+# The APOGEE_PIXMASK bits that astroNN masks by default.
+DEFAULT_TARGET_BITS = (0, 1, 2, 3, 4, 5, 6, 7, 12)
+
+
+def _load_continuum_mask(dr):
+    import astroNN.data
+    return np.load(os.path.join(astroNN.data.datapath(), f"dr{dr}_contmask.npy"))
+
+
+def _chip_design_matrices(cont_mask, deg, dr):
+    """
+    Pre-compute the shared Chebyshev design matrices for each APOGEE chip.
+
+    :param cont_mask:
+        A boolean array of continuum pixels on the gap-deleted pixel grid.
+
+    :param deg:
+        The degree of the Chebyshev polynomial.
+
+    :param dr:
+        The data release, which sets the pixel ranges of each chip.
+
+    :returns:
+        A list of tuples, one per chip, containing the slice of the full spectrum, the design
+        matrix for all chip pixels, the indices of the continuum pixels within the chip, and the
+        pixel-wise outer products of the design matrix at those continuum pixels (flattened to
+        shape `(n_continuum_pixels, (deg + 1)**2)`).
+    """
+    cont_mask = np.asarray(cont_mask, dtype=bool)
+    K, si, chips = (deg + 1, 0, [])
+    for start, end in APOGEE_CHIPS[dr]:
+        P = end - start
+        A = np.polynomial.chebyshev.chebvander(np.linspace(-1, 1, P), deg)
+        indices = np.where(cont_mask[si:si + P])[0]
+        A_cont = A[indices]
+        outer = (A_cont[:, :, None] * A_cont[:, None, :]).reshape((-1, K * K))
+        chips.append((slice(start, end), A, indices, outer))
+        si += P
+    return chips
+
+
+@cache
+def _default_chip_design_matrices(deg, dr):
+    return _chip_design_matrices(_load_continuum_mask(dr), deg, dr)
+
+
+def apogee_continuum_batch(
+    flux,
+    e_flux,
+    bitmask=None,
+    deg=2,
+    dr=17,
+    cont_mask=None,
+    target_bit=DEFAULT_TARGET_BITS,
+    mask_value=1.0,
+):
+    """
+    Continuum-normalize a stack of APOGEE spectra at once.
+
+    This gives the same result as calling `astroNN.apogee.apogee_continuum` on each spectrum,
+    but the per-chip weighted least-squares fits for all spectra reduce to a few matrix
+    products and one batched solve, using design matrices that are shared by all spectra.
+    As in astroNN, the inverse variances weight the residuals (not the squared residuals),
+    and the output is on the gap-deleted pixel grid.
+
+    :param flux:
+        An array of flux values of shape `(N, 8575)`.
+
+    :param e_flux:
+        An array of flux uncertainties of the same shape as `flux`.
+
+    :param bitmask: [optional]
+        An array of pixel flags of the same shape as `flux`. Pixels with any of `target_bit`
+        set will be given `mask_value` in the normalized flux and uncertainty.
+
+    :param deg: [optional]
+        The degree of the Chebyshev polynomial to fit to each chip (default: 2).
+
+    :param dr: [optional]
+        The data release, which sets the pixel ranges of each chip (default: 17).
+
+    :param cont_mask: [optional]
+        A boolean array of continuum pixels on the gap-deleted pixel grid. If `None`, the
+        continuum mask distributed with astroNN for the given data release is used.
+
+    :param target_bit: [optional]
+        The pixel flag bits to mask.
+
+    :param mask_value: [optional]
+        The value to give to masked or non-finite pixels (default: 1).
+
+    :returns:
+        A two-length tuple containing the normalized flux and normalized uncertainties,
+        each of shape `(N, P)` where `P` is the number of pixels on the gap-deleted grid.
+    """
+    flux = np.atleast_2d(flux).astype(float)
+    e_flux = np.atleast_2d(e_flux).astype(float)
+
+    if cont_mask is None:
+        chips = _default_chip_design_matrices(deg, dr)
+    else:
+        chips = _chip_design_matrices(cont_mask, deg, dr)
+
+    N, K = (flux.shape[0], deg + 1)
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        ivar = 1 / (e_flux**2 + 1e-8)
+
+    norm_flux, norm_e_flux = ([], [])
+    for chip, A, indices, outer in chips:
+        y, w = (flux[:, chip][:, indices], ivar[:, chip][:, indices])
+        bad = ~np.isfinite(y) | ~np.isfinite(w)
+        y[bad], w[bad] = (0, 0)
+
+        # astroNN (via `np.polynomial.Chebyshev.fit`) applies the weights to the residuals.
+        w = w**2
+        ATWA = (w @ outer).reshape((N, K, K))
+        ATWy = (w * y) @ A[indices]
+
+        # Spectra with too few usable pixels would make the batched solve singular.
+        singular = np.sum(w > 0, axis=1) < K
+        ATWA[singular] = np.eye(K)
+        theta = np.linalg.solve(ATWA, ATWy[..., None])[..., 0]
+        continuum = theta @ A.T
+        continuum[singular] = np.nan
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            norm_flux.append(flux[:, chip] / continuum)
+            norm_e_flux.append(e_flux[:, chip] / continuum)
+
+    norm_flux = np.hstack(norm_flux)
+    norm_e_flux = np.hstack(norm_e_flux)
+
+    negative = norm_flux < 0
+    norm_flux[negative] = 0
+    norm_e_flux[negative] = 0
+    norm_flux[~np.isfinite(norm_flux)] = mask_value
+    norm_e_flux[~np.isfinite(norm_e_flux)] = 0
+
+    if bitmask is not None:
+        bitmask = np.atleast_2d(bitmask)
+        bitmask = np.hstack([bitmask[:, chip] for chip, *_ in chips]).astype(int)
+        mask = (bitmask & np.sum(2**np.array(target_bit))) != 0
+        norm_flux[mask] = mask_value
+        norm_e_flux[mask] = mask_value
+
+    return (norm_flux, norm_e_flux)
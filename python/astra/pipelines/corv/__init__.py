@@ -1,14 +1,13 @@
 import concurrent.futures
-import os
-import matplotlib.pyplot as plt
 from peewee import JOIN
 from typing import Iterable, Optional
 from tqdm import tqdm
 from astra import task, __version__
 from astra.models import BossVisitSpectrum, Corv, SnowWhite
-from astra.utils import log, expand_path
+from astra.utils import log
+from astra.utils.plots import save_or_defer_plot
 
-from astra.pipelines.corv import models, fit, utils
+from astra.pipelines.corv import models, fit, utils, koester
 
 
 __all__ = ["corv"]
@@ -26,20 +25,32 @@ def corv(
         &   (SnowWhite.classification == "DA")
         )
     ),
-    max_workers: Optional[int] = 4
+    max_workers: Optional[int] = 4,
+    plot: Optional[bool] = True,
+    defer_plots: Optional[bool] = True,
 ) -> Iterable[Corv]:
     """
     Fit the radial velocity and stellar parameters for white dwarfs.
 
     :param spectra:
         An iterable of DA-type white dwarf spectra.
+
+    :param max_workers: [optional]
+        The number of processes to fit spectra with.
+
+    :param plot: [optional]
+        Make a figure of the fit to each spectrum.
+
+    :param defer_plots: [optional]
+        Write figures to the plot queue, to be rendered later with `astra plots render`, instead of rendering
+        them during the fit.
     """
 
-    corv_model = models.make_koester_model()
+    corv_model = models.make_koester_model(store=koester.get_koester_model_store())
     
     executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
 
-    futures = [executor.submit(_corv, s, corv_model) for s in spectra]
+    futures = [executor.submit(_corv, s, corv_model, plot, defer_plots) for s in spectra]
     
     with tqdm(total=len(futures)) as pb:
         for future in concurrent.futures.as_completed(futures):
@@ -48,7 +59,7 @@ def corv(
             pb.update()
 
 
-def _corv(spectrum, corv_model):
+def _corv(spectrum, corv_model, plot=True, defer_plots=True):
     
     args = (spectrum.wavelength, spectrum.flux, spectrum.ivar, corv_model)
     try:
@@ -57,15 +68,27 @@ def _corv(spectrum, corv_model):
         log.exception(f"Exception when running corv on {spectrum}")
         return None
     
-    try:
-        fig = utils.lineplot(*args, result.params)
-        path = expand_path(f"$MWM_ASTRA/{__version__}/pipelines/corv/{spectrum.spectrum_pk}-{__version__}.png")
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        fig.savefig(path)
-        plt.close("all")
-        del fig
-    except:
-        log.exception(f"Exception trying to make figure for {spectrum}")
+    if plot:
+        try:
+            save_or_defer_plot(
+                utils.lineplot_model_flux,
+                f"$MWM_ASTRA/{__version__}/pipelines/corv/{spectrum.spectrum_pk}-{__version__}.png",
+                defer=defer_plots,
+                wl=spectrum.wavelength,
+                fl=spectrum.flux,
+                ivar=spectrum.ivar,
+                model=corv_model.eval(result.params, x=spectrum.wavelength),
+                centres=[corv_model.centres[line] for line in corv_model.names],
+                windows=[corv_model.windows[line] for line in corv_model.names],
+                edges=[corv_model.edges[line] for line in corv_model.names],
+                teff=result.params["teff"].value,
+                e_teff=result.params["teff"].stderr,
+                logg=result.params["logg"].value,
+                e_logg=result.params["logg"].stderr,
+                n_params=len(result.params),
+            )
+        except:
+            log.exception(f"Exception trying to make figure for {spectrum}")
 
     return Corv(
         source_pk=spectrum.source_pk,
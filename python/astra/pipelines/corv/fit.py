@@ -63,6 +63,96 @@ def normalized_residual(wl, fl, ivar, corvmodel, params, fit_window = None):
     
     return resid
 
+def model_flux_rv_grid(wl, corvmodel, params, rvgrid):
+    """
+    Evaluate a corvmodel at every RV on a grid.
+
+    Koester models are evaluated with `models.get_koester_rv_grid` (or the
+    `get_koester_rv_grid` method of their model store), which interpolates 
+    the template once and shifts it onto all RVs at once. Other models are 
+    evaluated at each RV.
+
+    Parameters
+    ----------
+    wl : array_like
+        wavelengths in Angstroms.
+    corvmodel : LMFIT Model class
+        LMFIT model with normalization instructions.
+    params : LMFIT Parameters class
+        parameters at which to evaluate corvmodel (except RV).
+    rvgrid : array_like
+        grid of radial velocities.
+
+    Returns
+    -------
+    flux : array_like
+        (len(rvgrid), len(wl)) array of model fluxes.
+
+    """
+    func = getattr(corvmodel, "func", None)
+    if func is models.get_koester:
+        func = models.get_koester_rv_grid
+    elif hasattr(getattr(func, "__self__", None), "get_koester_rv_grid"):
+        # A Koester model evaluated from a `koester.KoesterModelStore`.
+        func = func.__self__.get_koester_rv_grid
+    else:
+        func = None
+    
+    if func is not None:
+        return func(wl, 
+                    params['teff'].value, 
+                    params['logg'].value, 
+                    rvgrid, 
+                    params['res'].value)
+    
+    params = params.copy()
+    flux = []
+    for rv in rvgrid:
+        params['RV'].set(value = rv)
+        flux.append(corvmodel.eval(params, x = wl))
+    return np.array(flux)
+
+def xcorr_chi2_grid(wl, fl, ivar, corvmodel, model_flux):
+    """
+    Chi-square statistic of the continuum-normalized lines of a spectrum 
+    against a model evaluated on a grid of RVs.
+
+    Parameters
+    ----------
+    wl : array_like
+        wavelengths in Angstroms.
+    fl : array_like
+        flux array.
+    ivar : array_like
+        inverse-variance.
+    corvmodel : LMFIT Model class
+        LMFIT model with normalization instructions.
+    model_flux : array_like
+        (N_rv, len(wl)) array of model fluxes (see `model_flux_rv_grid`).
+
+    Returns
+    -------
+    cc : array_like
+        chi-square statistic evaluated at each RV.
+    rcc : array_like
+        reduced chi-square statistic evaluated at each RV.
+
+    """
+    nwl, nfl, nivar = utils.cont_norm_lines(wl, fl, ivar,
+                                            corvmodel.names,
+                                            corvmodel.centres,
+                                            corvmodel.windows,
+                                            corvmodel.edges)
+    _, nmodel = utils.cont_norm_lines_many(wl, model_flux,
+                                           corvmodel.names,
+                                           corvmodel.centres,
+                                           corvmodel.windows,
+                                           corvmodel.edges)
+    resid = (nfl - nmodel) * np.sqrt(nivar)
+    cc = np.nansum(resid**2, axis = 1)
+    rcc = cc / (resid.shape[1] - 1)
+    return cc, rcc
+
 def xcorr_rv(wl, fl, ivar, corvmodel, params,
              min_rv = -1500, max_rv = 1500, 
              npoints = 500,
@@ -86,8 +176,8 @@ def xcorr_rv(wl, fl, ivar, corvmodel, params,
         lower end of RV grid. The default is -1500.
     max_rv : float, optional
         upper end of RV grid. The default is 1500.
-    resolution : float, optional
-        resolution of the rv search grid in km/s. Default is 0.5 km/s.
+    npoints : int, optional
+        number of points in the RV grid. The default is 500.
     quad_window : float, optional
         window around minimum to fit quadratic model, 
         in km/s. The default is 300.
@@ -96,29 +186,63 @@ def xcorr_rv(wl, fl, ivar, corvmodel, params,
     -------
     rv : float
         best-fit radial velocity.
+    e_rv : float
+        uncertainty in the radial velocity.
+    redchi : float
+        reduced chi-square at the best-fit radial velocity.
     rvgrid : array_like
         grid of radial velocities.
     cc : array_like
         chi-square statistic evaluated at each RV.
 
     """
-        
+    return xcorr_rv_many([(wl, fl, ivar)], corvmodel, params, 
+                         min_rv = min_rv, max_rv = max_rv, npoints = npoints,
+                         quad_window = quad_window, plot = plot)[0]
+
+def xcorr_rv_many(exposures, corvmodel, params,
+                  min_rv = -1500, max_rv = 1500, 
+                  npoints = 500,
+                  quad_window = 300, plot = False):
+    """
+    Find the best RV of many exposures (e.g., of one source) via 
+    x-correlation on grid and quadratic fitting the peak, as in `xcorr_rv`.
+
+    The model is evaluated on the whole RV grid at once, and only once for
+    all exposures that share the same wavelengths. The chi-square statistic
+    of each exposure is computed for the whole grid in one array operation.
+
+    Parameters
+    ----------
+    exposures : list
+        list of (wl, fl, ivar) tuples.
+    corvmodel : LMFIT Model class
+        LMFIT model with normalization instructions.
+    params : LMFIT Parameters class
+        parameters at which to evaluate corvmodel (except RV).
+
+    See `xcorr_rv` for the other parameters.
+
+    Returns
+    -------
+    results : list
+        list of (rv, e_rv, redchi, rvgrid, cc) tuples, one per exposure.
+
+    """
     rvgrid = np.linspace(min_rv, max_rv, npoints)
-    cc = np.zeros(len(rvgrid))
-    rcc = np.zeros(len(rvgrid))
-    #params = corvmodel.make_params()
     
-    residual = lambda params: normalized_residual(wl, fl, ivar, 
-                                                  corvmodel, params, fit_window = 25)
-    #print(params)
-    for ii,rv in enumerate(rvgrid):
-        params['RV'].set(value = rv)
-        resid = residual(params)
-        chi = np.nansum(resid**2)
-        redchi = np.nansum(resid**2) / (len(resid) - 1)
-        cc[ii] = chi
-        rcc[ii] = redchi
-        
+    model_flux = {}
+    results = []
+    for wl, fl, ivar in exposures:
+        key = np.asarray(wl).tobytes()
+        if key not in model_flux:
+            model_flux[key] = model_flux_rv_grid(wl, corvmodel, params, rvgrid)
+        cc, rcc = xcorr_chi2_grid(wl, fl, ivar, corvmodel, model_flux[key])
+        results.append(_xcorr_minimum(rvgrid, cc, rcc, quad_window, plot))
+    return results
+
+def _xcorr_minimum(rvgrid, cc, rcc, quad_window, plot = False):
+    
     window = int(quad_window / np.diff(rvgrid)[0])
 
     # plt.plot(rvgrid, cc)
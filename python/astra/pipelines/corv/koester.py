@@ -0,0 +1,223 @@
+"""
+A memory-mapped store of pre-convolved Koester (2010) DA models, shared by all
+processes on a machine.
+"""
+
+import os
+import numpy as np
+import scipy.ndimage
+
+from astra.utils import log, expand_path
+from astra.pipelines.corv.models import c_kms, modpath
+
+DEFAULT_KOESTER_STORE_PATH = os.path.join(modpath, "koester_da")
+
+
+def _flux_path(path, res):
+    return os.path.join(path, f"log_flux_res{res:g}.npy")
+
+
+def build_koester_model_store(path=DEFAULT_KOESTER_STORE_PATH, resolutions=(1, ), dlambda=None, interpolator=None):
+    """
+    Build a Koester model store from the pickled Koester interpolator.
+
+    The log fluxes of the interpolator are resampled onto a uniform wavelength grid, convolved with a
+    Gaussian of each resolution, and written to one `.npy` file per resolution.
+
+    :param path: [optional]
+        The directory to write the model store to.
+
+    :param resolutions: [optional]
+        The Gaussian sigmas (in Angstroms) to pre-convolve the models with.
+
+    :param dlambda: [optional]
+        The wavelength step (in Angstroms) of the store. If `None`, the smallest wavelength step of the
+        interpolator is used.
+
+    :param interpolator: [optional]
+        The `RegularGridInterpolator` of log flux with (logg, log10(teff), log10(wavelength)) axes. If
+        `None`, the pickled interpolator is used.
+    """
+    if interpolator is None:
+        from astra.pipelines.corv.models import load_koester_interpolator
+        interpolator = load_koester_interpolator()
+
+    logg, log_teff, log_wavelength = interpolator.grid
+    native_wavelength = 10**np.asarray(log_wavelength)
+    dlambda = dlambda or np.min(np.diff(native_wavelength))
+    wavelength = np.arange(native_wavelength[0], native_wavelength[-1], dlambda)
+
+    path = expand_path(path)
+    os.makedirs(path, exist_ok=True)
+    np.savez(os.path.join(path, "axes.npz"), logg=logg, log_teff=log_teff, wavelength=wavelength)
+
+    values = np.asarray(interpolator.values)
+    for res in resolutions:
+        log_flux = np.lib.format.open_memmap(
+            _flux_path(path, res),
+            mode="w+",
+            dtype=float,
+            shape=(logg.size, log_teff.size, wavelength.size)
+        )
+        for i in range(logg.size):
+            for j in range(log_teff.size):
+                flux = 10**np.interp(wavelength, native_wavelength, values[i, j])
+                log_flux[i, j] = np.log10(scipy.ndimage.gaussian_filter1d(flux, res / dlambda))
+        log_flux.flush()
+        del log_flux
+        log.info(f"Wrote Koester models with resolution {res:g} A to {_flux_path(path, res)}")
+    return path
+
+
+class KoesterModelStore(object):
+
+    def __init__(self, path=DEFAULT_KOESTER_STORE_PATH):
+        """
+        A memory-mapped store of Koester (2010) DA models that are pre-convolved to fixed resolutions.
+
+        The log flux grids are memory-mapped (read-only) when first needed, so every process that uses
+        the same store shares one copy of the grid through the page cache. Pickling the store (e.g., to
+        send a model to a process pool) only pickles the path.
+
+        :param path: [optional]
+            The directory of the model store (see `build_koester_model_store`).
+        """
+        self.path = expand_path(path)
+        with np.load(os.path.join(self.path, "axes.npz")) as axes:
+            self.logg = axes["logg"]
+            self.log_teff = axes["log_teff"]
+            self.wavelength = axes["wavelength"]
+        self._log_flux = {}
+        return None
+
+    def __getstate__(self):
+        return dict(path=self.path)
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    @property
+    def resolutions(self):
+        """The resolutions (Gaussian sigma, in Angstroms) of the pre-convolved models in the store."""
+        return sorted(
+            float(name[len("log_flux_res"):-len(".npy")])
+            for name in os.listdir(self.path) if name.startswith("log_flux_res") and name.endswith(".npy")
+        )
+
+    def log_flux(self, res):
+        """
+        Return the memory-mapped (N_logg, N_teff, N_wavelength) log flux grid for a resolution.
+
+        :param res:
+            The Gaussian sigma (in Angstroms) of the pre-convolved models.
+        """
+        try:
+            return self._log_flux[res]
+        except KeyError:
+            path = _flux_path(self.path, res)
+            if not os.path.exists(path):
+                raise ValueError(f"No models with resolution {res:g} A in {self.path} (available: {self.resolutions})")
+            self._log_flux[res] = np.load(path, mmap_mode="r")
+            return self._log_flux[res]
+
+    @staticmethod
+    def _locate(grid, value, name):
+        if not (grid[0] <= value <= grid[-1]):
+            raise ValueError(f"{name} of {value} is outside the model grid ({grid[0]} to {grid[-1]})")
+        i = min(np.searchsorted(grid, value, side="right") - 1, grid.size - 2)
+        return (i, (value - grid[i]) / (grid[i + 1] - grid[i]))
+
+    def template(self, teff, logg, res):
+        """
+        Bilinearly interpolate the log flux of the pre-convolved models at one effective temperature and
+        surface gravity. Only the grid points with non-zero weight are read, so models on a grid node (or
+        on a grid line) need one (or two) rows of the grid.
+
+        :param teff:
+            The effective temperature (K).
+
+        :param logg:
+            The surface gravity (log cgs).
+
+        :param res:
+            The Gaussian sigma (in Angstroms) of the pre-convolved models.
+
+        :returns:
+            The log flux on the wavelength grid of the store.
+        """
+        log_flux = self.log_flux(res)
+        i, u = self._locate(self.logg, logg, "logg")
+        j, v = self._locate(self.log_teff, np.log10(teff), "log10(teff)")
+        template = np.zeros(self.wavelength.size)
+        for di, dj, weight in ((0, 0, (1 - u) * (1 - v)), (0, 1, (1 - u) * v), (1, 0, u * (1 - v)), (1, 1, u * v)):
+            if weight != 0:
+                template += weight * log_flux[i + di, j + dj]
+        return template
+
+    def get_koester_rv_grid(self, x, teff, logg, RV, res):
+        """
+        Evaluate a pre-convolved model at many radial velocities, as in `models.get_koester_rv_grid`.
+
+        :param x:
+            The wavelengths (in Angstroms).
+
+        :param teff:
+            The effective temperature (K).
+
+        :param logg:
+            The surface gravity (log cgs).
+
+        :param RV:
+            An array of radial velocities (km/s).
+
+        :param res:
+            The Gaussian sigma (in Angstroms) of the pre-convolved models.
+
+        :returns:
+            A (len(RV), len(x)) array of model fluxes, normalised by their medians.
+        """
+        df = np.sqrt((1 - np.atleast_1d(RV) / c_kms) / (1 + np.atleast_1d(RV) / c_kms))
+        x_shifted = np.outer(df, x)
+        flam = np.nan * np.ones(x_shifted.shape)
+        in_bounds = (x_shifted > 3600) & (x_shifted < 9000)
+        flam[in_bounds] = 10**np.interp(x_shifted[in_bounds], self.wavelength, self.template(teff, logg, res))
+        return flam / np.nanmedian(flam, axis=1, keepdims=True)
+
+    def get_koester(self, x, teff, logg, RV, res):
+        """
+        Evaluate a pre-convolved model, as in `models.get_koester`. The models are convolved with a Gaussian
+        of `res` Angstroms on the model wavelength grid, instead of `res / median(diff(x))` pixels on the
+        observed wavelength grid.
+
+        :param x:
+            The wavelengths (in Angstroms).
+
+        :param teff:
+            The effective temperature (K).
+
+        :param logg:
+            The surface gravity (log cgs).
+
+        :param RV:
+            The radial velocity (km/s).
+
+        :param res:
+            The Gaussian sigma (in Angstroms) of the pre-convolved models.
+
+        :returns:
+            The model fluxes, normalised by their median.
+        """
+        return self.get_koester_rv_grid(x, teff, logg, RV, res)[0]
+
+
+def get_koester_model_store(path=DEFAULT_KOESTER_STORE_PATH):
+    """
+    Return the Koester model store at the given path, or `None` if it has not been built.
+
+    :param path: [optional]
+        The directory of the model store.
+    """
+    if not os.path.exists(os.path.join(expand_path(path), "axes.npz")):
+        log.warning(f"No Koester model store at {path}: use `build_koester_model_store` to build it")
+        return None
+    return KoesterModelStore(path)
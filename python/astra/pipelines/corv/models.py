@@ -27,6 +27,7 @@ from lmfit.models import Model, ConstantModel, VoigtModel
 import pickle
 import os
 import scipy 
+from functools import cache
 
 from astra.utils import log, expand_path
 
@@ -122,10 +123,20 @@ def make_balmer_model(nvoigt=1,
 
 # Koester DA Model
 
-try:
-    wd_interp = pickle.load(open(os.path.join(modpath, 'koester_interp_da.pkl'), 'rb'))
-except:
-    log.exception(f"Cannot load koester_interp_da.pkl")
+@cache
+def load_koester_interpolator():
+    """
+    Load (once per process, when first needed) the pickled Koester (2010) DA
+    model interpolator.
+    """
+    with open(os.path.join(modpath, 'koester_interp_da.pkl'), 'rb') as fp:
+        return pickle.load(fp)
+
+def __getattr__(name):
+    # `wd_interp` used to be unpickled on import.
+    if name == "wd_interp":
+        return load_koester_interpolator()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def get_koester(x, teff, logg, RV, res):
     """
@@ -152,6 +163,7 @@ def get_koester(x, teff, logg, RV, res):
     flam = np.zeros_like(x_shifted) * np.nan
 
     in_bounds = (x_shifted > 3600) & (x_shifted < 9000)
+    wd_interp = load_koester_interpolator()
     flam[in_bounds] = 10**wd_interp((logg, np.log10(teff), np.log10(x_shifted[in_bounds])))
 
     flam = flam / np.nanmedian(flam) # bring to order unity
@@ -164,10 +176,68 @@ def get_koester(x, teff, logg, RV, res):
     return flam
 
 
+def get_koester_rv_grid(x, teff, logg, RV, res):
+    """
+    Evaluates `get_koester` at many radial velocities at once.
+    
+    The Koester interpolator is linear in each dimension, so at fixed teff 
+    and logg it is linear in log wavelength between the wavelength nodes 
+    of the grid. The template is interpolated once at those nodes, and then 
+    Doppler-shifted onto every RV with a single interpolation. This gives 
+    the same result as calling `get_koester` for each RV.
+
+    Parameters
+    ----------
+    x : array_like
+        wavelength in Angstrom.
+    teff : float
+        effective temperature in K.
+    logg : float
+        log surface gravity in cgs.
+    RV : array_like
+        radial velocities in km/s.
+    res : float
+        gaussian sigma in AA by which the models are convolved.
+
+    Returns
+    -------
+    flam : array_like
+        (len(RV), len(x)) array of synthetic fluxes.
+
+    """
+    df = np.sqrt((1 - np.atleast_1d(RV)/c_kms)/(1 + np.atleast_1d(RV)/c_kms))
+    x_shifted = np.outer(df, x)
+    
+    flam = np.zeros_like(x_shifted) * np.nan
+    
+    in_bounds = (x_shifted > 3600) & (x_shifted < 9000)
+    log_x = np.log10(x_shifted[in_bounds])
+    
+    wd_interp = load_koester_interpolator()
+    grid_log_x = wd_interp.grid[-1]
+    if (getattr(wd_interp, "method", None) == "linear"
+        and np.all(np.diff(grid_log_x) > 0)
+        and (grid_log_x[0] <= log_x.min()) and (log_x.max() <= grid_log_x[-1])):
+        template = wd_interp((logg, np.log10(teff), grid_log_x))
+        flam[in_bounds] = 10**np.interp(log_x, grid_log_x, template)
+    else:
+        flam[in_bounds] = 10**wd_interp((logg, np.log10(teff), log_x))
+    
+    flam = flam / np.nanmedian(flam, axis = 1, keepdims = True) # bring to order unity
+    
+    dx = np.median(np.diff(x))
+    window = res / dx
+    
+    flam = scipy.ndimage.gaussian_filter1d(flam, window, axis = -1)
+    
+    return flam
+
+
 def make_koester_model(resolution = 1, centres = default_centres, 
                        windows = default_windows, 
                        edges = default_edges,
-                       names = default_names):
+                       names = default_names,
+                       store = None):
     """
     
 
@@ -176,6 +246,10 @@ def make_koester_model(resolution = 1, centres = default_centres,
     resolution : float, optional
         gaussian sigma in AA by which the models are convolved. 
         The default is 1.
+    store : KoesterModelStore, optional
+        evaluate models from this pre-convolved, memory-mapped model store 
+        (see `astra.pipelines.corv.koester`), instead of the pickled 
+        interpolator. The default is None.
     centres : dict, optional
         rest-frame line centres. The default is default_centres.
     windows : dict, optional
@@ -192,7 +266,7 @@ def make_koester_model(resolution = 1, centres = default_centres,
 
     """
     
-    model = Model(get_koester,
+    model = Model(get_koester if store is None else store.get_koester,
                   independent_vars = ['x'],
                   param_names = ['teff', 'logg', 'RV', 'res'])
     
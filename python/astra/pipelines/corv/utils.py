@@ -15,28 +15,42 @@ from astropy import constants as c
 def lineplot(wl, fl, ivar, corvmodel, params, gap = 0.3, printparams = True,
              figsize = (6, 5)):
     
-    model = corvmodel.eval(params, x = wl)
+    return lineplot_model_flux(
+        wl, fl, ivar, 
+        corvmodel.eval(params, x = wl),
+        [corvmodel.centres[line] for line in corvmodel.names],
+        [corvmodel.windows[line] for line in corvmodel.names],
+        [corvmodel.edges[line] for line in corvmodel.names],
+        params['teff'].value, params['teff'].stderr,
+        params['logg'].value, params['logg'].stderr,
+        len(params),
+        gap = gap, printparams = printparams, figsize = figsize
+    )
+
+
+def lineplot_model_flux(wl, fl, ivar, model, centres, windows, edges, teff, 
+                        e_teff, logg, e_logg, n_params, gap = 0.3, 
+                        printparams = True, figsize = (6, 5)):
+    """
+    Same as `lineplot`, but from the evaluated model flux (and the line 
+    centres, windows, and edges in order), so the figure can be deferred
+    with `astra.utils.plots`.
+    """
     
     chi2 = 0
     dof = 0
     
     f = plt.figure(figsize = figsize)
     
-    for ii,line in enumerate(corvmodel.names):
+    for ii, (centre, window, edge) in enumerate(zip(centres, windows, edges)):
         
-        cwl, cfl, civar = cont_norm_line(wl, fl, ivar, 
-                                     corvmodel.centres[line],
-                                     corvmodel.windows[line],
-                                     corvmodel.edges[line])
+        cwl, cfl, civar = cont_norm_line(wl, fl, ivar, centre, window, edge)
         if len(cwl) == 0:
             continue
 
-        _, cmodel, _ = cont_norm_line(wl, model, model, 
-                                     corvmodel.centres[line],
-                                     corvmodel.windows[line],
-                                     corvmodel.edges[line])
+        _, cmodel, _ = cont_norm_line(wl, model, model, centre, window, edge)
         
-        dlam = (cwl - corvmodel.centres[line])
+        dlam = (cwl - centre)
         
         plt.plot(dlam, cfl - ii * gap, 'k')
         plt.plot(dlam, cmodel - ii * gap, 'r')
@@ -44,7 +58,7 @@ def lineplot(wl, fl, ivar, corvmodel, params, gap = 0.3, printparams = True,
         chi2 += np.sum((cfl - cmodel)**2 * civar)
         dof += len(cfl)
         
-    redchi = chi2 / (dof - len(params))
+    redchi = chi2 / (dof - n_params)
         
     plt.xlabel(r'$\mathrm{\Delta \lambda}\ (\mathrm{\AA})$')
     plt.ylabel('Normalized Flux')
@@ -53,12 +67,12 @@ def lineplot(wl, fl, ivar, corvmodel, params, gap = 0.3, printparams = True,
     
         plt.text(0.97, 0.05, 
                  r'$T_{\mathrm{eff}} = %.0f \pm %.0f\ K$' % 
-                 (params['teff'].value, params['teff'].stderr or np.nan),
+                 (teff, e_teff or np.nan),
     			transform = plt.gca().transAxes, fontsize = 14, ha = 'right')
     		
         plt.text(0.97, 0.12, 
                  r'$\log{g} = %.2f \pm %.2f $' % 
-                 (params['logg'].value, params['logg'].stderr or np.nan),
+                 (logg, e_logg or np.nan),
     			transform = plt.gca().transAxes, fontsize = 14, ha = 'right')
     				 
         plt.text(0.97, 0.19, r'$\chi_r^2$ = %.2f' % (redchi),
@@ -136,6 +150,51 @@ def cont_norm_lines(wl, fl, ivar, names, centres, windows, edges):
 
 
 
+def cont_norm_lines_many(wl, fl, names, centres, windows, edges):
+    """
+    Continuum-normalizes the lines of many flux arrays on the same 
+    wavelengths (e.g., a model evaluated at many RVs), as in 
+    `cont_norm_lines`.
+
+    Parameters
+    ----------
+    wl : array_like
+        wavelength.
+    fl : array_like
+        (N, len(wl)) array of fluxes.
+
+    Returns
+    -------
+    nwl : array_like
+        cropped wavelength array.
+    nfl : array_like
+        (N, len(nwl)) array of cropped and normalized fluxes.
+
+    """
+    nwl = []
+    nfl = []
+    
+    for line in names:
+        c1 = bisect_left(wl, centres[line] - windows[line])
+        c2 = bisect_left(wl, centres[line] + windows[line])
+        lwl, lfl = wl[c1:c2], fl[:, c1:c2]
+    
+        mask = np.ones(len(lwl))
+        mask[edges[line]:-edges[line]] = 0
+        mask = mask.astype(bool)
+        if not any(mask):
+            continue
+    
+        p = np.polynomial.polynomial.polyfit(lwl[mask], lfl[:, mask].T, 1)
+        continuum = np.polynomial.polynomial.polyval(lwl, p)
+        nwl.append(lwl)
+        nfl.append(lfl / continuum)
+    
+    if len(nwl) == 0:
+        return np.array([]), np.zeros((len(fl), 0))
+    return np.hstack(nwl), np.hstack(nfl)
+
+
 def crrej(wl, fl, ivar, nsig = 3, medwindow = 11, plot = False):
 
     medfl = scipy.ndimage.median_filter(fl, medwindow)
@@ -9,6 +9,7 @@ from astropy.nddata import StdDevUncertainty
 from astropy import units as u
 from astra import task
 from astra.utils import log, expand_path
+from astra.specutils.resampling import cubic_spline_sparse_matrix
 from tqdm import tqdm
 from specutils import Spectrum1D
 from specutils.manipulation import SplineInterpolatedResampler
@@ -75,7 +76,13 @@ LINES = [
 ]
 
 @task
-def line_forest(spectra: Iterable[BossVisitSpectrum], steps: int = 128, reps: int = 100, max_workers: int = 16) -> Iterable[LineForest]:
+def line_forest(
+    spectra: Iterable[BossVisitSpectrum], 
+    steps: int = 128, 
+    reps: int = 100, 
+    max_workers: int = 4, 
+    batch_size: int = 256
+) -> Iterable[LineForest]:
     """
     Measure spectral line strengths.
 
@@ -90,23 +97,188 @@ def line_forest(spectra: Iterable[BossVisitSpectrum], steps: int = 128, reps: in
     
     :param max_workers:
         Maximum number of workers to use.
+
+    :param batch_size:
+        Number of spectra to send to each worker at once. Each line network is evaluated once per batch.
     """
     
     executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
 
-    futures = []
-    with tqdm(total=0, desc="Chunking") as pb:            
-        for total, spectrum in enumerate(spectra, start=1):
-            futures.append(executor.submit(_line_forest, spectrum, steps, reps))
-            pb.update()
+    futures, total = ([], 0)
+    with tqdm(total=0, desc="Chunking") as pb:
+        for chunk in chunked(spectra, batch_size):
+            futures.append(
+                executor.submit(
+                    _line_forest_batch,
+                    [spectrum.source_pk for spectrum in chunk],
+                    [spectrum.spectrum_pk for spectrum in chunk],
+                    [spectrum.wavelength for spectrum in chunk],
+                    [spectrum.flux for spectrum in chunk],
+                    [spectrum.ivar for spectrum in chunk],
+                    steps,
+                    reps
+                )
+            )
+            total += len(chunk)
+            pb.update(len(chunk))
 
     with tqdm(total=total) as pb:
         for future in concurrent.futures.as_completed(futures):
-            result = future.result()
-            if result is not None:
-                yield result
-            pb.update()
-        
+            results = future.result()
+            for result in results:
+                if result is not None:
+                    yield result
+            pb.update(len(results))
+
+
+def get_line_window_wavelengths(steps):
+    """
+    Return the vacuum wavelengths that each line window is sampled at.
+
+    :param steps:
+        Number of steps to use when sampling the line profile.
+
+    :returns:
+        A (N_lines, steps) array of wavelengths.
+    """
+    return np.array([
+        np.linspace(-minmax, minmax, steps) + airtovac(wavelength_air)
+        for name, model_path, wavelength_air, minmax in LINES
+    ])
+
+
+_line_window_resamplers = {}
+
+def get_line_window_resampler(wavelength, steps):
+    """
+    Return (and cache, per process) a sparse matrix that resamples spectra at the given wavelengths onto
+    all line windows with a cubic spline, as `SplineInterpolatedResampler` would, and a boolean array of
+    line window pixels that are outside the wavelength range of the spectra.
+
+    :param wavelength:
+        The wavelengths of the spectra.
+
+    :param steps:
+        Number of steps to use when sampling the line profile.
+    """
+    key = (np.asarray(wavelength, dtype=float).tobytes(), steps)
+    try:
+        return _line_window_resamplers[key]
+    except KeyError:
+        line_wavelength = get_line_window_wavelengths(steps).flatten()
+        _line_window_resamplers[key] = (
+            cubic_spline_sparse_matrix(wavelength, line_wavelength),
+            (line_wavelength < wavelength[0]) | (line_wavelength > wavelength[-1])
+        )
+        return _line_window_resamplers[key]
+
+
+def _log_flux_and_uncertainty(flux, e_flux):
+    flux, e_flux = (np.copy(flux), np.copy(e_flux))
+    median_e_flux = np.median(e_flux[np.isfinite(e_flux)])
+    if not np.isfinite(median_e_flux):
+        median_e_flux = 1e3
+
+    high_error = (e_flux > (5 * median_e_flux)) | (~np.isfinite(e_flux))
+    bad_pixel = (flux <= 0) | (~np.isfinite(flux))
+    e_flux[high_error] = 5 * median_e_flux
+    flux[bad_pixel] = 1
+    
+    # TODO: increase flux error at bad pixels?
+    uncertainty = e_flux/flux/np.log(10)
+    uncertainty[~np.isfinite(uncertainty)] = 5 * median_e_flux
+    return (np.log10(flux), uncertainty)
+
+
+def _line_forest_batch(source_pks, spectrum_pks, wavelengths, fluxes, ivars, steps, reps, debug=False):
+    """
+    Measure spectral line strengths for a batch of spectra.
+
+    All spectra are resampled onto every line window with one sparse matrix product, and each line network
+    is evaluated once on the stacked (spectra, Monte Carlo draws) windows. The results are the same as
+    `_line_forest`, up to the Monte Carlo draws.
+    """
+    
+    models = {
+        "zlines.model": read_model(os.path.join(f"$MWM_ASTRA/pipelines/lineforest/zlines2.model")),
+        "hlines.model": read_model(os.path.join(f"$MWM_ASTRA/pipelines/lineforest/hlines2.model")),
+    }
+
+    N = len(spectrum_pks)
+    result_kwds = [
+        OrderedDict([("source_pk", source_pk), ("spectrum_pk", spectrum_pk)])
+        for source_pk, spectrum_pk in zip(source_pks, spectrum_pks)
+    ]
+    window_flux = np.nan * np.ones((N, len(LINES) * steps))
+    window_scatter = np.nan * np.ones((N, len(LINES) * steps))
+    
+    # Resample all spectra with the same wavelengths at once.
+    failed = np.zeros(N, dtype=bool)
+    groups = {}
+    for i, wavelength in enumerate(wavelengths):
+        groups.setdefault(np.asarray(wavelength, dtype=float).tobytes(), []).append(i)
+
+    for indices in groups.values():
+        log_flux, uncertainty = ([], [])
+        for i in indices:
+            try:
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    f, u = _log_flux_and_uncertainty(fluxes[i], ivars[i]**-0.5)
+            except:
+                log.warning(f"Exception when running line_forest for spectrum {spectrum_pks[i]}")
+                if debug:
+                    raise
+                failed[i] = True
+                f = u = np.nan * np.ones_like(fluxes[i])
+            log_flux.append(f)
+            uncertainty.append(u)
+
+        K, outside = get_line_window_resampler(wavelengths[indices[0]], steps)
+        window_flux[indices] = np.where(outside, np.nan, np.array(log_flux) @ K)
+        window_scatter[indices] = np.where(outside, np.nan, np.array(uncertainty) @ K)
+
+    for j, (name, model_path, wavelength_air, minmax) in enumerate(LINES):
+        try:
+            model = models[os.path.basename(model_path)]
+
+            si = j * steps
+            window = np.tile(window_flux[:, None, si:si + steps], (1, reps + 1, 1))
+            scatter = window_scatter[:, None, si:si + steps] * np.random.normal(size=(N, reps + 1, steps), loc=0, scale=1)
+            scatter[:, 0] = 0
+            window = (window + scatter).reshape((N * (reps + 1), steps, 1))
+
+            predictions = unnormalize(np.array(model(window))).reshape((N, reps + 1, -1))
+
+            for i in np.flatnonzero(~failed & (np.abs(predictions[:, 0, 2]) > 0.5)):
+                eqw, abs = (predictions[i, 0, 0], predictions[i, 0, 1])
+                detection_stat = predictions[i, 0, 2]
+
+                # As in `_line_forest`, the first Monte Carlo draw is not used.
+                draws = predictions[i, 2:]
+                a = np.where(np.abs(draws[:, 2]) > 0.5)[0]
+                detection_raw = np.round(len(a)/reps,2)
+                
+                if detection_raw>0.3:
+                    result_kwds[i].update({
+                        f"eqw_{name.lower()}": eqw,
+                        f"abs_{name.lower()}": abs,
+                        f"detection_stat_{name.lower()}": detection_stat,
+                        f"detection_raw_{name.lower()}": detection_raw
+                    })
+
+                    if len(a)>2:
+                        result_kwds[i].update({
+                            f"eqw_percentiles_{name.lower()}": np.round(np.percentile(draws[:,0][a],[16,50,84]),4),
+                            f"abs_percentiles_{name.lower()}": np.round(np.percentile(draws[:,1][a],[16,50,84]),4),
+                        }) 
+        except:
+            log.exception(f"Exception when measuring {name} for spectra {spectrum_pks}")
+            if debug:
+                raise
+            continue
+
+    return [None if f else LineForest(**kwds) for f, kwds in zip(failed, result_kwds)]
+
 
 def _line_forest(spectrum, steps, reps, debug=False):
         
@@ -116,24 +288,11 @@ def _line_forest(spectrum, steps, reps, debug=False):
     }
 
     try:    
-        flux = np.copy(spectrum.flux)
-        e_flux = np.copy(spectrum.e_flux)
-        median_e_flux = np.median(e_flux[np.isfinite(e_flux)])
-        if not np.isfinite(median_e_flux):
-            median_e_flux = 1e3
-
-        high_error = (e_flux > (5 * median_e_flux)) | (~np.isfinite(e_flux))
-        bad_pixel = (flux <= 0) | (~np.isfinite(flux))
-        e_flux[high_error] = 5 * median_e_flux
-        flux[bad_pixel] = 1
-        
-        # TODO: increase flux error at bad pixels?
-        uncertainty = e_flux/flux/np.log(10)
-        uncertainty[~np.isfinite(uncertainty)] = 5 * median_e_flux
+        log_flux, uncertainty = _log_flux_and_uncertainty(spectrum.flux, spectrum.e_flux)
         
         specs = Spectrum1D(
             spectral_axis=spectrum.wavelength * u.Angstrom,
-            flux=u.Quantity(np.log10(flux)),
+            flux=u.Quantity(log_flux),
             uncertainty=StdDevUncertainty(uncertainty)
         )
 
@@ -1,7 +1,7 @@
 import concurrent.futures
 import numpy as np
 import os
-from typing import Iterable
+from typing import Iterable, Optional
 from peewee import chunked
 from tqdm import tqdm
 
@@ -9,20 +9,44 @@ from astra import task
 from astra.models.spectrum import SpectrumMixin
 from astra.models.mdwarftype import MDwarfType
 from astra.utils import log, expand_path
+from astra.pipelines.mdwarftype.templates import (
+    get_template_bank, get_template_type, read_and_resample_template
+)
 
 
 @task
 def mdwarftype(
     spectra: Iterable[SpectrumMixin],
     template_list: str = "$MWM_ASTRA/pipelines/MDwarfType/template.list",
+    template_cache_path: Optional[str] = None,
+    fit_scale: bool = False,
     max_workers: int = 4,
     batch_size: int = 10_000
 ) -> Iterable[MDwarfType]:
     """
     Classify a single M dwarf from spectral templates.
+
+    :param spectra:
+        Input spectra on the BOSS wavelength grid.
+
+    :param template_list: [optional]
+        The path of a file that lists the template paths, one per line.
+
+    :param template_cache_path: [optional]
+        The path to cache the resampled templates to. If `None`, this is `templates.npz` next to the template
+        list.
+
+    :param fit_scale: [optional]
+        Scale each template to best match each continuum-normalised spectrum (default: False).
+
+    :param max_workers: [optional]
+        The number of processes to use.
+
+    :param batch_size: [optional]
+        The number of spectra to send to each process at once.
     """
 
-    template_flux, template_type = read_template_fluxes_and_types(template_list)
+    template_bank = get_template_bank(template_list, template_cache_path)
 
     executor = concurrent.futures.ProcessPoolExecutor(max_workers)
 
@@ -35,8 +59,8 @@ def mdwarftype(
         #        continue
         #    checked_chunk.append(spectrum)
         #if len(checked_chunk) > 0:
-        #    futures.append(executor.submit(_mdwarf_type, checked_chunk, template_flux, template_type))
-        futures.append(executor.submit(_mdwarf_type, chunk, template_flux, template_type))
+        #    futures.append(executor.submit(_mdwarf_type, checked_chunk, template_bank, fit_scale))
+        futures.append(executor.submit(_mdwarf_type, chunk, template_bank, fit_scale))
 
     with tqdm(total=len(futures), desc="Collecting futures") as pb:
         for future in concurrent.futures.as_completed(futures):
@@ -45,9 +69,9 @@ def mdwarftype(
 
 
 
-def _mdwarf_type(spectra, template_flux, template_type):
+def _mdwarf_type(spectra, template_bank, fit_scale=False):
 
-    results = []
+    batch, flux, ivar, continuum = ([], [], [], [])
     for spectrum in spectra:
         try:                
             #continuum_method: str = "astra.tools.continuum.Scalar", # --> mean
@@ -55,60 +79,52 @@ def _mdwarf_type(spectra, template_flux, template_type):
             #continuum, continuum_meta = f_continuum.fit(spectrum.flux, spectrum.ivar)
             # TODO: replace this with astra.specutils.continuum.Scalar
             mask = (7495 <= spectrum.wavelength) * (spectrum.wavelength <= 7505)
-            continuum = np.nanmean(spectrum.flux[mask])
-
-            flux = spectrum.flux / continuum
-            ivar = continuum * spectrum.ivar * continuum
-            chi2s = np.nansum((flux - template_flux)**2 * ivar, axis=1)
-            index = np.argmin(chi2s)
-            chi2 = chi2s[index]
-            rchi2 = chi2 / (flux.size - 2)
-            
-            spectral_type, sub_type = template_type[index]
-
-            result_flags = 1 if spectral_type == "K5.0" else 0
-
-            results.append(
-                MDwarfType(
-                    spectrum_pk=spectrum.spectrum_pk,
-                    source_pk=spectrum.source_pk,
-                    spectral_type=spectral_type,
-                    sub_type=sub_type,
-                    continuum=continuum,
-                    rchi2=rchi2,
-                    result_flags=result_flags
-                )
-            )
+            spectrum_continuum = np.nanmean(spectrum.flux[mask])
+
+            spectrum_flux = spectrum.flux / spectrum_continuum
+            spectrum_ivar = spectrum_continuum * spectrum.ivar * spectrum_continuum
+            if spectrum_flux.shape != template_bank.flux.shape[1:]:
+                raise ValueError(f"Spectrum has {spectrum_flux.size} pixels but the templates have {template_bank.flux.shape[1]}")
         except:
             log.exception(f"Exception in MDwarfType for spectrum {spectrum}")
             continue
+        else:
+            batch.append(spectrum)
+            flux.append(spectrum_flux)
+            ivar.append(spectrum_ivar)
+            continuum.append(spectrum_continuum)
 
-    return results
-
-
-def read_template_fluxes_and_types(template_list):
-    with open(expand_path(template_list), "r") as fp:
-        template_list = list(map(str.strip, fp.readlines()))
-
-    template_flux = list(map(read_and_resample_template, template_list))
-    template_type = list(map(get_template_type, template_list))
-    return (template_flux, template_type)
+    if not batch:
+        return []
 
+    chi2s, scales = template_bank.chi2(np.array(flux), np.array(ivar), fit_scale=fit_scale)
+    # Templates with no overlap with a spectrum have an undefined scale.
+    indices = np.argmin(np.where(np.isfinite(chi2s), chi2s, np.inf), axis=1)
 
-def get_template_type(path):
-    _, spectral_type, sub_type = os.path.basename(path).split("_")
-    sub_type = sub_type[:-4]
-    return spectral_type, sub_type
+    results = []
+    for spectrum, spectrum_flux, spectrum_continuum, spectrum_chi2s, index in zip(batch, flux, continuum, chi2s, indices):
+        chi2 = spectrum_chi2s[index]
+        rchi2 = chi2 / (spectrum_flux.size - 2)
+        
+        spectral_type, sub_type = template_bank.types[index]
+
+        result_flags = 1 if spectral_type == "K5.0" else 0
+
+        results.append(
+            MDwarfType(
+                spectrum_pk=spectrum.spectrum_pk,
+                source_pk=spectrum.source_pk,
+                spectral_type=spectral_type,
+                sub_type=sub_type,
+                continuum=spectrum_continuum,
+                rchi2=rchi2,
+                result_flags=result_flags
+            )
+        )
 
+    return results
 
-def read_and_resample_template(path):
-    log_wl, flux = np.loadtxt(
-        expand_path(path), 
-        skiprows=1, 
-        delimiter=",",
-        usecols=(1, 2)
-    ).T
-    common_wavelength = 10**(3.5523 + 0.0001 * np.arange(4648))
-    # Interpolate to the BOSS wavelength grid
-    return np.interp(common_wavelength, 10**log_wl, flux, left=np.nan, right=np.nan)
 
+def read_template_fluxes_and_types(template_list):
+    template_bank = get_template_bank(template_list)
+    return (list(template_bank.flux), template_bank.types)
@@ -0,0 +1,161 @@
+"""A bank of M dwarf spectral templates on the BOSS wavelength grid."""
+
+import os
+import numpy as np
+from functools import cache
+
+from astra.utils import log, expand_path
+
+# The BOSS log-lambda wavelength grid.
+BOSS_WAVELENGTH = 10**(3.5523 + 0.0001 * np.arange(4648))
+
+
+def get_template_type(path):
+    _, spectral_type, sub_type = os.path.basename(path).split("_")
+    sub_type = sub_type[:-4]
+    return spectral_type, sub_type
+
+
+def read_and_resample_template(path):
+    log_wl, flux = np.loadtxt(
+        expand_path(path),
+        skiprows=1,
+        delimiter=",",
+        usecols=(1, 2)
+    ).T
+    # Interpolate to the BOSS wavelength grid
+    return np.interp(BOSS_WAVELENGTH, 10**log_wl, flux, left=np.nan, right=np.nan)
+
+
+def read_template_list(template_list):
+    with open(expand_path(template_list), "r") as fp:
+        return list(map(str.strip, fp.readlines()))
+
+
+@cache
+def get_template_bank(template_list, cache_path=None):
+    """
+    Return the template bank for a template list, loading it (once per process) from the on-disk cache if
+    the cache was built from the same templates, or reading the templates and writing the cache if not.
+
+    :param template_list:
+        The path of a file that lists the template paths, one per line.
+
+    :param cache_path: [optional]
+        The path of the on-disk cache. If `None`, this is `templates.npz` next to the template list.
+    """
+    cache_path = expand_path(cache_path or os.path.join(os.path.dirname(template_list), "templates.npz"))
+    paths = read_template_list(template_list)
+    if os.path.exists(cache_path):
+        bank = TemplateBank.read(cache_path)
+        if bank.paths == paths:
+            return bank
+        log.info(f"Template cache {cache_path} is out of date with {template_list}")
+
+    bank = TemplateBank.from_paths(paths)
+    try:
+        bank.write(cache_path)
+    except OSError:
+        log.exception(f"Could not write template cache to {cache_path}")
+    return bank
+
+
+class TemplateBank(object):
+
+    def __init__(self, flux, types, paths=None):
+        """
+        A bank of spectral templates that are resampled onto a common wavelength grid, so that the
+        chi-squared of every spectrum in a batch against every template can be computed with a few matrix
+        products.
+
+        :param flux:
+            A (N_templates, N_pixels) array of template fluxes, with NaNs where a template has no data.
+
+        :param types:
+            A list of (spectral type, sub type) tuples for each template.
+
+        :param paths: [optional]
+            The paths of the templates.
+        """
+        self.flux = np.atleast_2d(flux)
+        self.types = [tuple(t) for t in types]
+        self.paths = list(paths or [])
+
+        self.mask = np.isfinite(self.flux).astype(float)
+        self._flux = np.where(self.mask > 0, self.flux, 0)
+        self._flux_squared = self._flux**2
+        return None
+
+    @classmethod
+    def from_paths(cls, paths):
+        """
+        Read and resample templates onto the BOSS wavelength grid.
+
+        :param paths:
+            A list of template paths.
+        """
+        flux = np.array(list(map(read_and_resample_template, paths)))
+        types = list(map(get_template_type, paths))
+        return cls(flux, types, paths)
+
+    @classmethod
+    def read(cls, path):
+        """
+        Read a template bank written by `TemplateBank.write`.
+
+        :param path:
+            The path of the template bank.
+        """
+        with np.load(expand_path(path), allow_pickle=False) as data:
+            return cls(data["flux"], data["types"].tolist(), data["paths"].tolist())
+
+    def write(self, path):
+        """
+        Write the template bank to disk.
+
+        :param path:
+            The path to write the template bank to.
+        """
+        path = expand_path(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as fp:
+            np.savez(fp, flux=self.flux, types=np.array(self.types), paths=np.array(self.paths))
+        os.replace(temp_path, path)
+        return path
+
+    def chi2(self, flux, ivar, fit_scale=False):
+        """
+        Compute the chi-squared of every spectrum against every template. Pixels where the spectrum, its
+        inverse variance, or the template are not finite are ignored, as with `np.nansum`.
+
+        With `fit_scale`, each template is scaled to best match each spectrum, and the scale is
+        a = sum(w * f * t) / sum(w * t**2), so that chi2 = sum(w * f**2) - sum(w * f * t)**2 / sum(w * t**2).
+
+        :param flux:
+            A (N_spectra, N_pixels) array of fluxes.
+
+        :param ivar:
+            A (N_spectra, N_pixels) array of inverse variances.
+
+        :param fit_scale: [optional]
+            Scale each template to best match each spectrum (default: False).
+
+        :returns:
+            A two-length tuple containing the (N_spectra, N_templates) chi-squared values, and the
+            (N_spectra, N_templates) template scales.
+        """
+        flux, ivar = (np.atleast_2d(flux), np.atleast_2d(ivar))
+        valid = np.isfinite(flux) & np.isfinite(ivar)
+        weight = np.where(valid, ivar, 0)
+        weighted_flux = weight * np.where(valid, flux, 0)
+
+        # chi2 = sum(w * (f - a * t)**2) = A - 2 * a * B + a**2 * C, over pixels where the template is finite.
+        A = (weighted_flux * np.where(valid, flux, 0)) @ self.mask.T
+        B = weighted_flux @ self._flux.T
+        C = weight @ self._flux_squared.T
+        if fit_scale:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                scale = B / C
+            return (A - scale * B, scale)
+        return (A - 2 * B + C, np.ones_like(A))
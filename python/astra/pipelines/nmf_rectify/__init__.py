@@ -3,6 +3,7 @@ import numpy as np
 import os
 from typing import Iterable, Optional
 import concurrent.futures
+import multiprocessing
 from astra.models import Source, BossVisitSpectrum, ApogeeCoaddedSpectrumInApStar
 from astra.models.nmf_rectify import NMFRectify
 from astra.specutils.continuum.nmf.apogee import ApogeeNMFContinuum
@@ -29,8 +30,23 @@ def rectify_boss_spectra_by_source(
         )
     ),
     page: Optional[int] = None,
-    limit: Optional[int] = None        
+    limit: Optional[int] = None,
+    max_workers: Optional[int] = 1,
+    shard_size: Optional[int] = 1000
 ) -> Iterable[NMFRectify]:
+    """
+    Rectify the BOSS visit spectra of each source with a NMF continuum model.
+
+    :param sources:
+        An iterable of sources.
+
+    :param max_workers: [optional]
+        The number of worker processes to use. If greater than 1, the sources are sharded into
+        contiguous `Source.pk` ranges and each shard is rectified by a worker process.
+
+    :param shard_size: [optional]
+        The number of sources per shard when running with multiple workers.
+    """
 
     # TODO: Should consider this logic to be executed somewhere else, either in the astra CLI call, or in the task wrapper, etc
     if isinstance(sources, ModelSelect):
@@ -38,21 +54,20 @@ def rectify_boss_spectra_by_source(
             sources = sources.paginate(page, limit)
         elif limit is not None:
             sources = sources.limit(limit)    
-    
-    model = BossNMFContinuum()    
-    for source in tqdm(sources, total=0, desc="Rectifying"):
-        yield from _rectify_boss_spectra_by_source([source], model)
-        
-    '''
-    futures = []
-    for chunk in tqdm(chunked(sources, batch_size), total=0, desc="Chunking"):
-        futures.append(executor.submit(_rectify_boss_spectra_by_source, chunk, model))
-    
-    with tqdm(total=len(futures) * batch_size, desc="Rectifying") as pb:
-        for future in concurrent.futures.as_completed(futures):
-            yield from future.result()
-            pb.update(batch_size)
-    '''
+
+    if max_workers is not None and max_workers > 1:
+        yield from _parallel_rectify(
+            sources,
+            lambda source: source.pk,
+            _rectify_boss_spectra_by_source_shard,
+            BossNMFContinuum,
+            max_workers,
+            shard_size
+        )
+    else:
+        model = BossNMFContinuum()    
+        for source in tqdm(sources, total=0, desc="Rectifying"):
+            yield from _rectify_boss_spectra_by_source([source], model)
 
 
 @task
@@ -64,8 +79,27 @@ def rectify_apogee_coadded_spectra_in_apstar(
         .where(NMFRectify.spectrum_pk.is_null())
     ),
     page: Optional[int] = None,
-    limit: Optional[int] = None    
+    limit: Optional[int] = None,
+    max_workers: Optional[int] = 1,
+    shard_size: Optional[int] = 1000,
+    block_size: Optional[int] = 100
 ) -> Iterable[NMFRectify]:
+    """
+    Rectify co-added APOGEE spectra with a NMF continuum model.
+
+    :param spectra:
+        An iterable of co-added APOGEE spectra.
+
+    :param max_workers: [optional]
+        The number of worker processes to use. If greater than 1, the spectra are sharded into
+        contiguous `spectrum_pk` ranges and each shard is rectified by a worker process.
+
+    :param shard_size: [optional]
+        The number of spectra per shard when running with multiple workers.
+
+    :param block_size: [optional]
+        The number of spectra to compute initial guesses for at once.
+    """
     
     # TODO: Should consider this logic to be executed somewhere else, either in the astra CLI call, or in the task wrapper, etc
     if isinstance(spectra, ModelSelect):
@@ -73,59 +107,204 @@ def rectify_apogee_coadded_spectra_in_apstar(
             spectra = spectra.paginate(page, limit)
         elif limit is not None:
             spectra = spectra.limit(limit)
-            
-    model = ApogeeNMFContinuum()
-        
+
+    if max_workers is not None and max_workers > 1:
+        yield from _parallel_rectify(
+            spectra,
+            lambda spectrum: spectrum.spectrum_pk,
+            _rectify_apogee_coadded_spectra_shard,
+            ApogeeNMFContinuum,
+            max_workers,
+            shard_size
+        )
+    else:
+        model = ApogeeNMFContinuum()
+        yield from _rectify_apogee_coadded_spectra(tqdm(spectra, total=0), model, block_size)
+
+
+def _rectify_apogee_coadded_spectra(spectra, model, block_size=100):
+    """
+    Rectify co-added APOGEE spectra, using initial guesses that are computed for a block of
+    spectra at once.
+
+    :param spectra:
+        An iterable of co-added APOGEE spectra.
+
+    :param model:
+        The APOGEE NMF continuum model.
+
+    :param block_size: [optional]
+        The number of spectra to compute initial guesses for at once.
+    """
+    for block in chunked(spectra, block_size):
+        data = {}
+        for spectrum in block:
+            try:
+                data[spectrum.spectrum_pk] = (spectrum.flux, spectrum.ivar)
+            except:
+                continue
+
+        x0s = {}
+        if data:
+            try:
+                flux, ivar = zip(*data.values())
+                x0s = dict(zip(data.keys(), model.get_initial_guesses_by_iteration(flux, ivar, block_size=block_size)))
+            except:
+                log.exception(f"Exception computing initial guesses for {len(data)} spectra")
+
+        for spectrum in block:
+            yield _rectify_apogee_coadded_spectrum(
+                spectrum,
+                model,
+                x0s.get(spectrum.spectrum_pk, None),
+                data.get(spectrum.spectrum_pk, None)
+            )
+
+
+def _rectify_apogee_coadded_spectrum(spectrum, model, x0=None, flux_ivar=None):
+
     initial_flags = [
         ("flag_initialised_from_small_w", model.get_initial_guess_with_small_W),
         #("flag_initialised_from_llsqb", model.get_initial_guess_by_linear_least_squares_with_bounds),
     ]
-    results = []
-    for spectrum in tqdm(spectra, total=0):
-        
-        kwds = dict(
-            spectrum_pk=spectrum.spectrum_pk,
-            source_pk=spectrum.source_pk,
-            L=model.L,
-            deg=model.deg,
-            log_W=[],
-            continuum_theta=[],
-        )
+    if x0 is not None:
+        initial_flags.insert(0, ("flag_initialised_from_iteration", lambda *_: x0))
+    kwds = dict(
+        spectrum_pk=spectrum.spectrum_pk,
+        source_pk=spectrum.source_pk,
+        L=model.L,
+        deg=model.deg,
+        log_W=[],
+        continuum_theta=[],
+    )
+    
+    try:
+        args = list(map(np.atleast_2d, flux_ivar or (spectrum.flux, spectrum.ivar)))
+    except:
+        return NMFRectify(flag_could_not_read_spectrum=True, **kwds)
         
+    for flag_name, f in initial_flags:        
         try:
-            args = list(map(np.atleast_2d, (spectrum.flux, spectrum.ivar)))
+            x0 = f(*args)        
+            continuum, result = model.fit(*args, x0=x0, full_output=True)                
         except:
-            yield NMFRectify(flag_could_not_read_spectrum=True, **kwds)
+            log.exception(f"Exception fitting {flag_name} x0 with spectrum {spectrum}")
+            continue
         else:
-            
-            for flag_name, f in initial_flags:        
-                try:
-                    x0 = f(*args)        
-                    continuum, result = model.fit(*args, x0=x0, full_output=True)                
-                except:
-                    log.exception(f"Exception fitting {flag_name} x0 with spectrum {spectrum}")
-                    continue
-                else:
-                    break
-            else:
-                yield NMFRectify(flag_runtime_exception=True, **kwds)
+            break
+    else:
+        return NMFRectify(flag_runtime_exception=True, **kwds)
 
-            
-            dof = result["W"].size + result["theta"].size
-            pixel_chi2 = result["pixel_chi2"].reshape((1, -1))
-            thetas = result["theta"].reshape((1, -1))
-            rchi2s = np.nansum(pixel_chi2, axis=1) / (np.sum(np.isfinite(pixel_chi2), axis=1) - dof - 1)
-            
-            kwds.update(
-                log10_W=np.log10(result["W"]),
-                L=model.L,
-                deg=model.deg,
-                joint_rchi2=result["rchi2"],
-                continuum_theta=thetas[0],
-                rchi2=rchi2s[0]
+    dof = result["W"].size + result["theta"].size
+    pixel_chi2 = result["pixel_chi2"].reshape((1, -1))
+    thetas = result["theta"].reshape((1, -1))
+    rchi2s = np.nansum(pixel_chi2, axis=1) / (np.sum(np.isfinite(pixel_chi2), axis=1) - dof - 1)
+    
+    kwds.update(
+        log10_W=np.log10(result["W"]),
+        L=model.L,
+        deg=model.deg,
+        joint_rchi2=result["rchi2"],
+        continuum_theta=thetas[0],
+        rchi2=rchi2s[0]
+    )
+    kwds[flag_name] = True
+    return NMFRectify(**kwds)
+
+
+def _parallel_rectify(items, get_pk, shard_worker, model_class, max_workers, shard_size):
+    """
+    Rectify items across worker processes, sharded by contiguous primary key ranges.
+
+    Only the primary keys are read in this process. Each worker has its own database connection
+    and a memory-mapped (shared) copy of the NMF components, and it skips any rows that already
+    have results. Results are yielded as each shard completes, in no particular order.
+
+    :param items:
+        An iterable of sources or spectra.
+
+    :param get_pk:
+        A callable that returns the primary key to shard by, given an item.
+
+    :param shard_worker:
+        The function that each worker executes, given a sorted list of primary keys.
+
+    :param model_class:
+        The NMF continuum model class.
+
+    :param max_workers:
+        The number of worker processes.
+
+    :param shard_size:
+        The number of primary keys per shard.
+    """
+    if isinstance(items, ModelSelect):
+        items = items.iterator()
+    pks = sorted(set(map(get_pk, items)))
+    if not pks:
+        return None
+
+    # Write the shared copy of the components before any worker needs it.
+    model_class(shared=True)
+    yield ...
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_initialize_worker,
+        initargs=(model_class, )
+    ) as executor:
+        futures = [executor.submit(shard_worker, shard) for shard in chunked(pks, shard_size)]
+        try:
+            with tqdm(total=len(pks), desc="Rectifying") as pb:
+                for future in concurrent.futures.as_completed(futures):
+                    results = future.result()
+                    yield from results
+                    pb.update(len(results))
+        finally:
+            # Don't wait for shards that have not started if we stopped early.
+            for future in futures:
+                future.cancel()
+
+
+_worker_model = None
+
+def _initialize_worker(model_class):
+    global _worker_model
+    from astra.models.base import database
+    database.connect(reuse_if_open=True)
+    _worker_model = model_class(shared=True)
+
+
+def _rectify_apogee_coadded_spectra_shard(spectrum_pks):
+    spectra = (
+        ApogeeCoaddedSpectrumInApStar
+        .select()
+        .join(NMFRectify, JOIN.LEFT_OUTER, on=(ApogeeCoaddedSpectrumInApStar.spectrum_pk == NMFRectify.spectrum_pk))
+        .where(
+            ApogeeCoaddedSpectrumInApStar.spectrum_pk.between(spectrum_pks[0], spectrum_pks[-1])
+        &   ApogeeCoaddedSpectrumInApStar.spectrum_pk.in_(spectrum_pks)
+        &   NMFRectify.spectrum_pk.is_null()
+        )
+    )
+    return list(_rectify_apogee_coadded_spectra(spectra, _worker_model))
+
+
+def _rectify_boss_spectra_by_source_shard(source_pks):
+    sources = (
+        Source
+        .select()
+        .where(
+            Source.pk.between(source_pks[0], source_pks[-1])
+        &   Source.pk.in_(source_pks)
+        &   Source.pk.not_in(
+                NMFRectify
+                .select(NMFRectify.source_pk)
+                .where(NMFRectify.source_pk.between(source_pks[0], source_pks[-1]))
             )
-            kwds[flag_name] = True
-            yield NMFRectify(**kwds)
+        )
+    )
+    return _rectify_boss_spectra_by_source(sources, _worker_model)
 
 
 
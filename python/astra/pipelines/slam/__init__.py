@@ -2,7 +2,7 @@ import numpy as np
 from scipy.interpolate import interp1d
 from functools import cache
 from typing import Iterable, Optional
-from peewee import JOIN
+from peewee import JOIN, chunked
 from joblib import load
 import pickle
 import os
@@ -12,6 +12,7 @@ from tqdm import tqdm
 
 from astra import task, __version__
 from astra.utils import log, expand_path
+from astra.specutils.resampling import cubic_spline_sparse_matrix
 from astra.pipelines.slam.slam.normalization import normalize_spectra_block
 from astra.models.slam import Slam
 from astra.models.spectrum import SpectrumMixin
@@ -50,25 +51,67 @@ def slam(
         )
     ),
     model_path: str = "$MWM_ASTRA/pipelines/slam/ASPCAP_DR16_astra_wbinaryValid.dump",
-    max_workers: Optional[int] = None
+    max_workers: Optional[int] = None,
+    batch_size: Optional[int] = 128,
 ) -> Iterable[Slam]:
     """
     Run the Stellar Labels Machine (SLAM) on the given spectra.
-    """
-    
-    model = load_model(model_path)
 
-    executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+    :param spectra: [optional]
+        The spectra to analyze.
+
+    :param model_path: [optional]
+        The path of the SLAM model.
+
+    :param max_workers: [optional]
+        The number of processes to use.
 
-    futures = []
-    for spectrum in tqdm(spectra, total=0, desc="Distributing"):
-        futures.append(executor.submit(_slam, spectrum, model))
+    :param batch_size: [optional]
+        The number of spectra to analyze together in each process. If `None`, each spectrum is sent
+        (with the model) to the process pool separately.
+    """
+
+    if batch_size is None:
+        model = load_model(model_path)
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+
+        futures = []
+        for spectrum in tqdm(spectra, total=0, desc="Distributing"):
+            futures.append(executor.submit(_slam, spectrum, model))
+
+        with tqdm(total=len(futures), desc="Slamming") as pb:
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+                pb.update()
+        return
+
+    # Each worker loads the model once, and is sent only the pixel arrays of a batch of spectra.
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=load_model,
+        initargs=(model_path, )
+    )
+    futures, total = ([], 0)
+    for chunk in tqdm(chunked(spectra, batch_size), total=0, desc="Distributing"):
+        futures.append(
+            executor.submit(
+                _slam_batch,
+                model_path,
+                [spectrum.source_pk for spectrum in chunk],
+                [spectrum.spectrum_pk for spectrum in chunk],
+                [spectrum.wavelength for spectrum in chunk],
+                [spectrum.flux for spectrum in chunk],
+                [spectrum.ivar for spectrum in chunk],
+            )
+        )
+        total += len(chunk)
 
-    with tqdm(total=len(futures), desc="Slamming") as pb:
+    with tqdm(total=total, desc="Slamming") as pb:
         for future in concurrent.futures.as_completed(futures):
-            yield future.result()
-            pb.update()
-            
+            results = future.result()
+            yield from results
+            pb.update(len(results))
+
 
 
 @cache
@@ -138,14 +181,140 @@ def _slam(
     results_pred = model.predict_labels_multi(
         label_init, flux_norm, ivar_norm
     )
-    label_names = ("teff", "fe_h")
     labels = np.array([label["x"] for label in results_pred])
+    prediction = model.predict_spectra(labels)
+
+    return _slam_result(
+        spectrum.source_pk,
+        spectrum.spectrum_pk,
+        wave,
+        model,
+        flux_resamp[0],
+        flux_norm[0],
+        ivar_norm[0],
+        label_init[0],
+        results_pred[0],
+        prediction[0],
+    )
+
+
+def _slam_batch(
+    model_path,
+    source_pks,
+    spectrum_pks,
+    wavelengths,
+    fluxes,
+    ivars,
+    dwave: float = 10.0,
+    p_min: float = 1e-8,
+    p_max: float = 1e-7,
+    q: float = 0.7,
+    eps: float = 1e-19,
+    rsv_frac: float = 2,
+    verbose: int = 0,
+):
+    """
+    Run SLAM on a batch of spectra in one process.
+
+    The spectra are resampled onto the model wavelengths with one sparse matrix product, and the
+    initial chi-squared search, label optimization, and model predictions are done for the whole batch
+    at once. The results are the same as `_slam` for each spectrum.
+    """
+
+    model = load_model(model_path)
+    N, R = (len(spectrum_pks), model.wave.size)
+
+    flux_resamp = np.empty((N, R))
+    ivar_resamp = np.empty((N, R))
+    groups = {}
+    for i, wave in enumerate(wavelengths):
+        groups.setdefault(np.asarray(wave, dtype=float).tobytes(), []).append(i)
+
+    for indices in groups.values():
+        fluxs = np.array([fluxes[i] for i in indices])
+        ivars_ = np.array([ivars[i] for i in indices])
+        # As in `_slam`, non-finite pixels are set to zero before resampling.
+        non_finite = ~np.isfinite(fluxs) + ~np.isfinite(ivars_)
+        fluxs[non_finite] = 0.0
+        ivars_[non_finite] = 0.0
+
+        K, outside = get_model_resampler(wavelengths[indices[0]], model.wave)
+        flux_resamp[indices] = np.where(outside, np.nan, fluxs @ K)
+        ivar_resamp[indices] = np.where(outside, 0, ivars_ @ K)
+
+    flux_norm, flux_cont = normalize_spectra_block(
+        model.wave,
+        flux_resamp,
+        (6147.0, 8910.0),
+        dwave=dwave,
+        p=(p_min, p_max),
+        q=q,
+        ivar_block=ivar_resamp,
+        eps=eps,
+        rsv_frac=rsv_frac,
+        n_jobs=1,
+        verbose=verbose,
+    )
+    ivar_norm = flux_cont**2 * ivar_resamp
+
+    label_init = model.predict_labels_quick_stacked(flux_norm, ivar_norm)
+    results_pred = model.predict_labels_multi_stacked(label_init, flux_norm, ivar_norm)
+    labels = np.array([label["x"] for label in results_pred])
+    prediction = model.predict_spectra_stacked(labels)
+
+    return [
+        _slam_result(*args, model, *arrays)
+        for args, arrays in zip(
+            zip(source_pks, spectrum_pks, wavelengths),
+            zip(flux_resamp, flux_norm, ivar_norm, label_init, results_pred, prediction)
+        )
+    ]
+
+
+_model_resamplers = {}
+
+def get_model_resampler(wavelength, model_wavelength):
+    """
+    Return (and cache, per process) a sparse matrix that resamples spectra at the given wavelengths onto
+    the model wavelengths with a cubic spline, as `interp1d(..., kind="cubic")` would, and a boolean array
+    of model pixels that are outside the wavelength range of the spectra.
+
+    :param wavelength:
+        The wavelengths of the spectra.
+
+    :param model_wavelength:
+        The wavelengths of the SLAM model.
+    """
+    wavelength, model_wavelength = (np.asarray(wavelength, dtype=float), np.asarray(model_wavelength, dtype=float))
+    key = (wavelength.tobytes(), model_wavelength.tobytes())
+    try:
+        return _model_resamplers[key]
+    except KeyError:
+        _model_resamplers[key] = (
+            cubic_spline_sparse_matrix(wavelength, model_wavelength),
+            (model_wavelength < wavelength[0]) | (model_wavelength > wavelength[-1])
+        )
+        return _model_resamplers[key]
 
-    kwargs = (dict(zip(label_names, labels[0])))
+
+def _slam_result(
+    source_pk,
+    spectrum_pk,
+    wave,
+    model,
+    flux_resamp,
+    flux_norm,
+    ivar_norm,
+    label_init,
+    result_pred,
+    prediction
+):
+    label_names = ("teff", "fe_h")
+    kwargs = dict(zip(label_names, result_pred["x"]))
     kwargs.update(
         dict(zip(
             [f"e_{ln}" for ln in label_names],
-            np.array([label["pstd"] for label in results_pred])[0]
+            result_pred["pstd"]
         ))
     )
 
@@ -154,7 +323,7 @@ def _slam(
         dict(
             zip(
                 [f"initial_{ln}" for ln in label_names],
-                label_init[0]
+                label_init
             )
         )
     )
@@ -162,12 +331,12 @@ def _slam(
     # Add correlation coefficients.
     L = len(label_names)
     j, k = np.triu_indices(L, 1)
-    rho = np.array([np.corrcoef(label["pcov"]) for label in results_pred])
+    rho = np.corrcoef(result_pred["pcov"])
     kwargs.update(
         dict(
             zip(
                 [f"rho_{label_names[j]}_{label_names[k]}" for j, k in zip(j, k)],
-                rho[0, j, k]
+                rho[j, k]
             )
         )
     )
@@ -175,10 +344,9 @@ def _slam(
     # Add optimisation keywords
     opt_keys = ("status", "success", "optimality")
     for key in opt_keys:
-        kwargs[key] = results_pred[0][key]
+        kwargs[key] = result_pred[key]
 
     # Add statistics.
-    prediction = model.predict_spectra(labels)
     chi2 = np.sum((prediction - flux_norm) ** 2 * ivar_norm)
     R_finite = np.sum(ivar_norm > 0)
     rchi2 = chi2 / (R_finite - L - 1)
@@ -202,44 +370,42 @@ def _slam(
     # Prepare model spectrum for final product.
     model_continuum = flux_resamp / flux_norm
 
-    resampled_continuum = np.nan * np.ones((N, P))
-    resampled_rectified_model_flux = np.nan * np.ones((N, P))
+    resampled_continuum = np.nan * np.ones((1, wave.size))
+    resampled_rectified_model_flux = np.nan * np.ones((1, wave.size))
     if not np.all(np.isfinite(prediction)):
         log.warning(f"Prediction values not all finite!")
-    if not np.all(np.isfinite(model_continuum[i])):
+    if not np.all(np.isfinite(model_continuum)):
         log.warning(f"Not all model continuum values finite!")
 
-    i = 0
-
-    finite_prediction = np.isfinite(prediction[i])
-    finite_model_continuum = np.isfinite(model_continuum[i])
+    finite_prediction = np.isfinite(prediction)
+    finite_model_continuum = np.isfinite(model_continuum)
     if any(finite_prediction):
 
         f = interp1d(
             model.wave[finite_prediction], 
-            prediction[i][finite_prediction], 
+            prediction[finite_prediction], 
             kind="cubic", 
             bounds_error=False, 
             fill_value=np.nan
         )
-        resampled_rectified_model_flux[i] = f(wave)
+        resampled_rectified_model_flux[0] = f(wave)
 
     if any(finite_model_continuum): 
         c = interp1d(
             model.wave[finite_model_continuum], 
-            model_continuum[i][finite_model_continuum], 
+            model_continuum[finite_model_continuum], 
             kind="cubic", 
             bounds_error=False, 
             fill_value=np.nan
         )
 
         # Re-sample the predicted spectra back to the observed frame.
-        resampled_continuum[i] = c(wave)
+        resampled_continuum[0] = c(wave)
 
 
     result = Slam(
-        spectrum_pk=spectrum.spectrum_pk,
-        source_pk=spectrum.source_pk,
+        spectrum_pk=spectrum_pk,
+        source_pk=source_pk,
         **kwargs
     )
     path = expand_path(result.intermediate_output_path)
@@ -248,3 +414,43 @@ def _slam(
         pickle.dump((resampled_continuum, resampled_rectified_model_flux), fp)
         
     return result
+
+
+if __name__ == "__main__":
+
+    import sys
+    import time
+
+    # Benchmark the batched mode against running `_slam` on each spectrum, using spectra that already
+    # have SLAM results.
+    n_spectra = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    model_path = "$MWM_ASTRA/pipelines/slam/ASPCAP_DR16_astra_wbinaryValid.dump"
+    model = load_model(model_path)
+
+    spectra = list(
+        BossVisitSpectrum
+        .select()
+        .join(Slam, on=(Slam.spectrum_pk == BossVisitSpectrum.spectrum_pk))
+        .limit(n_spectra)
+    )
+    args = (
+        [spectrum.source_pk for spectrum in spectra],
+        [spectrum.spectrum_pk for spectrum in spectra],
+        [spectrum.wavelength for spectrum in spectra],
+        [spectrum.flux for spectrum in spectra],
+        [spectrum.ivar for spectrum in spectra],
+    )
+
+    t_init = time.time()
+    one_by_one = [_slam(spectrum, model) for spectrum in spectra]
+    t_one_by_one = time.time() - t_init
+
+    t_init = time.time()
+    batched = _slam_batch(model_path, *args)
+    t_batched = time.time() - t_init
+
+    print(f"One by one: {len(spectra) / t_one_by_one:.2f} spectra/s")
+    print(f"Batched:    {len(spectra) / t_batched:.2f} spectra/s ({t_one_by_one / t_batched:.1f}x)")
+    for key in ("teff", "fe_h"):
+        diff = np.array([getattr(a, key) - getattr(b, key) for a, b in zip(one_by_one, batched)])
+        print(f"Max |delta {key}|: {np.max(np.abs(diff)):.3g}")
@@ -0,0 +1,178 @@
+"""
+Aims
+----
+- predict spectra and labels for many test spectra at once
+
+"""
+import threading
+import concurrent.futures
+
+import numpy as np
+from scipy.optimize import least_squares
+
+from .postprocessing import do_post
+
+
+def predict_spectra_stacked(svrs, X_, mask=None):
+    """predict many spectra, evaluating each pixel model once
+
+    Parameters
+    ----------
+    svrs : list
+        a list of svr objects
+    X_ : ndarray (n_test, n_dim)
+        the (scaled) labels of predicted spectra
+    mask : None | bool array (n_test, n_pix)
+        predict the pixels where mask==True, others are NaN
+
+    Returns
+    -------
+    ys : ndarray (n_test, n_pix)
+        predicted spectra
+
+    """
+    X_ = np.atleast_2d(X_)
+    ys = np.array([svr.predict(X_) for svr in svrs], dtype=float).T
+    if mask is not None:
+        ys[~np.asarray(mask, dtype=bool)] = np.nan
+    return ys
+
+
+def predict_labels_chi2_stacked(tplt_flux, tplt_ivar, tplt_labels, test_flux, test_ivar):
+    """a quick search for initial values of test_labels for many test_flux
+
+    This is the same as predict.predict_labels_chi2, but the mean chi2 of
+    every test spectrum against every template is computed with three
+    matrix products. Test flux and ivar must be finite (healed).
+
+    Returns
+    -------
+    X_quick : ndarray (n_test, n_dim)
+        the labels of the best-matching template for each test spectrum
+
+    """
+    test_flux, test_ivar = np.atleast_2d(test_flux), np.atleast_2d(test_ivar)
+    tplt_mask = (tplt_ivar > 0).astype(float)
+    tplt_flux = np.where(tplt_ivar > 0, tplt_flux, 0.0)
+
+    # mean((t - f)**2 * w) over pixels where the template ivar is positive
+    chi2 = (
+        (test_flux**2 * test_ivar) @ tplt_mask.T
+        - 2 * (test_flux * test_ivar) @ tplt_flux.T
+        + test_ivar @ (tplt_flux**2).T
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        chi2 /= np.sum(tplt_mask, axis=1)
+    chi2[~np.isfinite(chi2)] = np.inf
+    return tplt_labels[np.argmin(chi2, axis=1), :]
+
+
+class StackedPredictor(object):
+    """evaluate pixel models for many concurrent label optimizations
+
+    Each client (one optimization per test spectrum, in its own thread)
+    asks for the spectrum at one set of labels and waits. When every
+    active client is waiting, the labels of all clients are stacked and
+    each pixel model is evaluated once.
+
+    """
+
+    def __init__(self, svrs, n_clients):
+        self.svrs = svrs
+        self._n_clients = n_clients
+        self._requests = dict()
+        self._results = dict()
+        self._condition = threading.Condition()
+
+    def predict(self, client, X_):
+        with self._condition:
+            self._requests[client] = np.atleast_2d(X_)
+            self._flush()
+            while client not in self._results:
+                self._condition.wait()
+            result = self._results.pop(client)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def release(self, client):
+        """the client will not make any more requests"""
+        with self._condition:
+            self._n_clients -= 1
+            self._flush()
+
+    def _flush(self):
+        if len(self._requests) == 0 or len(self._requests) < self._n_clients:
+            return
+        clients = list(self._requests.keys())
+        try:
+            ys = predict_spectra_stacked(
+                self.svrs, np.vstack([self._requests[c] for c in clients])
+            )
+        except Exception as e:
+            ys = [e] * len(clients)
+        for client, y in zip(clients, ys):
+            self._results[client] = y
+        self._requests.clear()
+        self._condition.notify_all()
+
+
+def costfun_for_label_stacked(X_, predictor, client, test_flux, test_ivar, mask):
+    """same as predict.costfun_for_label, but the spectrum is predicted by a StackedPredictor"""
+    pred_flux = predictor.predict(client, X_.reshape(1, -1))
+    pred_flux = np.where(mask, pred_flux, np.nan).flatten()
+    res = (test_flux - pred_flux) * np.sqrt(test_ivar)
+    res[np.isnan(res)] = 0.0
+    return res
+
+
+def predict_labels_stacked(
+    X0, svrs, test_flux, test_ivar, mask, labels_scaler=None, **kwargs
+):
+    """predict scaled labels for many test_flux
+
+    Every test spectrum is optimized as in predict.predict_labels3, but the
+    optimizations run concurrently and share one StackedPredictor, so each
+    pixel model is evaluated once per round for all test spectra.
+
+    Parameters
+    ----------
+    X0 : ndarray (n_test, n_dim)
+        initial guess (scaled)
+    svrs: list
+        a list of svr objects
+    test_flux: ndarray (n_test, n_pix)
+        test flux (scaled)
+    test_ivar: ndarray (n_test, n_pix)
+        test ivar (scaled)
+    mask: bool array (n_test, n_pix)
+        predict the pixels where mask==True
+    labels_scaler: scaler object
+        if not None, scale predicted labels back to normal scale
+
+    Returns
+    -------
+    r_pred: list
+        post-processed results, as predict.predict_labels3
+
+    """
+    n_test = test_flux.shape[0]
+    predictor = StackedPredictor(svrs, n_test)
+    test_ivar = np.where(test_ivar < 0, 0.0, test_ivar)
+
+    def optimize(i):
+        try:
+            ls_r = least_squares(
+                costfun_for_label_stacked,
+                X0[i],
+                method="trf",
+                loss="soft_l1",
+                args=(predictor, i, test_flux[i], test_ivar[i], mask[i]),
+                **kwargs
+            )
+        finally:
+            predictor.release(i)
+        return do_post(ls_r, labels_scaler)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(n_test, 1)) as executor:
+        return list(executor.map(optimize, range(n_test)))
@@ -42,6 +42,11 @@ try:
     from .mcmc import predict_label_mcmc
 except ImportError:
     print(f"Import error for Slam MCMC functionality, ignoring")
+from .batch import (
+    predict_labels_chi2_stacked,
+    predict_labels_stacked,
+    predict_spectra_stacked,
+)
 from .predict import (
     predict_labels3,
     predict_labels_chi2,
@@ -1080,7 +1085,7 @@ class Slam3(object):
         return r_pred
 
     # in this method, do not use scaler defined in predict_labels()
-    def predict_labels_multi(
+    def _prepare_predict_labels(
         self,
         X0,
         test_flux,
@@ -1092,52 +1097,17 @@ class Slam3(object):
         flux_scaler=True,
         ivar_scaler=True,
         labels_scaler=True,
-        n_jobs=1,
-        verbose=False,
-        **kwargs
     ):
-        """predict labels for a given test spectrum (multiple)
+        """heal, scale and mask test spectra for predict_labels_multi
 
-        Parameters
-        ----------
-        X0 : ndarray (1 x n_dim)
-            the initial guess of predicted label
-        test_flux : ndarray (n_test, n_pix)
-            test flux array
-        test_ivar : ndarray (n_test, n_pix)
-            test ivar array
-        mask : bool ndarray (n_test, n_pix)
-            manual mask, False pixels are not evaluated for speed up
-        model_ivar: ndarray (n_pix,), default None
-            the model error in scaled space.
-            if None, 0 would be adopted.
-            usually 1/(-NMSE) could be used.
-        flux_scaler : scaler object
-            flux scaler. if False, it doesn't perform scaling
-        ivar_scaler : scaler object
-            ivar scaler. if False, it doesn't perform scaling
-        labels_scaler : scaler object
-            labels scaler. if False, it doesn't perform scaling
-        n_jobs: int
-            number of processes launched by joblib
-        verbose: int
-            verbose level
-
-        kwargs :
-            extra parameters passed to *minimize()*
-            **tol** should be specified by user according to n_pix
-
-        NOTE
-        ----
-        ** all input should be 2D array or sequential **
+        Returns
+        -------
+        X0, test_flux, test_ivar, mask, labels_scaler
+            the scaled initial guesses (n_test, n_dim), the scaled test
+            flux and total ivar (n_test, n_pix), the mask of pixels to
+            evaluate (n_test, n_pix), and the labels scaler (or None)
 
         """
-        if "profile" in kwargs.keys():
-            if kwargs["profile"] is None:
-                kwargs.pop("profile")
-            else:
-                raise AssertionError("@Slam: use Slam.predict_labels_ipc instead!")
-
         test_flux, test_ivar = self.heal_the_world(
             test_flux, test_ivar, **self.heal_kwargs
         )
@@ -1251,6 +1221,80 @@ class Slam3(object):
         if labels_scaler is not None:
             X0 = labels_scaler.transform(X0)
 
+        return X0, test_flux, test_ivar, mask, labels_scaler
+
+    def predict_labels_multi(
+        self,
+        X0,
+        test_flux,
+        test_ivar=None,
+        mask=None,
+        model_ivar=None,
+        flux_eps=None,
+        ivar_eps=1e0,
+        flux_scaler=True,
+        ivar_scaler=True,
+        labels_scaler=True,
+        n_jobs=1,
+        verbose=False,
+        **kwargs
+    ):
+        """predict labels for a given test spectrum (multiple)
+
+        Parameters
+        ----------
+        X0 : ndarray (1 x n_dim)
+            the initial guess of predicted label
+        test_flux : ndarray (n_test, n_pix)
+            test flux array
+        test_ivar : ndarray (n_test, n_pix)
+            test ivar array
+        mask : bool ndarray (n_test, n_pix)
+            manual mask, False pixels are not evaluated for speed up
+        model_ivar: ndarray (n_pix,), default None
+            the model error in scaled space.
+            if None, 0 would be adopted.
+            usually 1/(-NMSE) could be used.
+        flux_scaler : scaler object
+            flux scaler. if False, it doesn't perform scaling
+        ivar_scaler : scaler object
+            ivar scaler. if False, it doesn't perform scaling
+        labels_scaler : scaler object
+            labels scaler. if False, it doesn't perform scaling
+        n_jobs: int
+            number of processes launched by joblib
+        verbose: int
+            verbose level
+
+        kwargs :
+            extra parameters passed to *minimize()*
+            **tol** should be specified by user according to n_pix
+
+        NOTE
+        ----
+        ** all input should be 2D array or sequential **
+
+        """
+        if "profile" in kwargs.keys():
+            if kwargs["profile"] is None:
+                kwargs.pop("profile")
+            else:
+                raise AssertionError("@Slam: use Slam.predict_labels_ipc instead!")
+
+        X0, test_flux, test_ivar, mask, labels_scaler = self._prepare_predict_labels(
+            X0,
+            test_flux,
+            test_ivar=test_ivar,
+            mask=mask,
+            model_ivar=model_ivar,
+            flux_eps=flux_eps,
+            ivar_eps=ivar_eps,
+            flux_scaler=flux_scaler,
+            ivar_scaler=ivar_scaler,
+            labels_scaler=labels_scaler,
+        )
+        n_test = test_flux.shape[0]
+
         # 9. loop predictions
         r_pred = Parallel(n_jobs=n_jobs, verbose=verbose)(
             delayed(predict_labels3)(
@@ -1274,6 +1318,83 @@ class Slam3(object):
 
         return r_pred
 
+    def predict_labels_quick_stacked(self, test_flux, test_ivar, n_sparse=1):
+        """a quick chi2 search for labels, for all test spectra at once
+
+        This is the same as predict_labels_quick with the default templates,
+        but the chi2 of all test spectra against all templates is computed
+        with a few matrix products.
+
+        """
+        test_flux, test_ivar = self.heal_the_world(
+            test_flux, test_ivar, **self.heal_kwargs
+        )
+        return predict_labels_chi2_stacked(
+            self.tr_flux[::n_sparse, :],
+            self.tr_ivar[::n_sparse, :],
+            self.tr_labels[::n_sparse, :],
+            test_flux,
+            test_ivar,
+        )
+
+    def predict_labels_multi_stacked(
+        self,
+        X0,
+        test_flux,
+        test_ivar=None,
+        mask=None,
+        model_ivar=None,
+        flux_eps=None,
+        ivar_eps=1e0,
+        flux_scaler=True,
+        ivar_scaler=True,
+        labels_scaler=True,
+        **kwargs
+    ):
+        """predict labels for many test spectra at once
+
+        The arguments and results are the same as predict_labels_multi, but
+        the optimizations of all test spectra run concurrently (in threads),
+        and each pixel model is evaluated once per round for all of them.
+
+        """
+        X0, test_flux, test_ivar, mask, labels_scaler = self._prepare_predict_labels(
+            X0,
+            test_flux,
+            test_ivar=test_ivar,
+            mask=mask,
+            model_ivar=model_ivar,
+            flux_eps=flux_eps,
+            ivar_eps=ivar_eps,
+            flux_scaler=flux_scaler,
+            ivar_scaler=ivar_scaler,
+            labels_scaler=labels_scaler,
+        )
+        return predict_labels_stacked(
+            X0,
+            self.sms,
+            test_flux,
+            test_ivar,
+            mask,
+            labels_scaler=self.tr_labels_scaler,
+            **kwargs
+        )
+
+    def predict_spectra_stacked(self, X_pred, labels_scaler=True, flux_scaler=True):
+        """predict spectra, evaluating each pixel model once for all labels
+
+        This is the same as predict_spectra.
+
+        """
+        X_pred = np.atleast_2d(X_pred)
+        if labels_scaler:
+            X_pred = self.tr_labels_scaler.transform(X_pred)
+
+        flux_pred = predict_spectra_stacked(self.sms, X_pred)
+        if flux_scaler:
+            return self.tr_flux_scaler.inverse_transform(flux_pred)
+        return flux_pred
+
     # in this method, do not use scaler defined in predict_labels()
     def predict_labels_mcmc(
         self,
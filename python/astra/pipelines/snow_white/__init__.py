@@ -4,7 +4,6 @@ import os
 import pickle
 import sys
 import numpy as np
-import matplotlib.pyplot as plt
 from astropy.io import fits
 from typing import Iterable, Optional
 
@@ -34,16 +33,28 @@ def snow_white(
         &   SnowWhite.spectrum_pk.is_null()
         )        
     ), 
-    plot=True
+    plot: Optional[bool] = True,
+    defer_plots: Optional[bool] = True,
 ) -> Iterable[SnowWhite]:
     """
     Classify white dwarf types based on their spectra, and fit stellar parameters to DA-type white dwarfs.
 
     :param spectra:
         Input spectra.
+
+    :param plot: [optional]
+        Make a figure of the fit to each DA-type white dwarf.
+
+    :param defer_plots: [optional]
+        Write figures to the plot queue, to be rendered later with `astra plots render`, instead of rendering
+        them during the fit.
     """
     
     from astra.pipelines.snow_white import get_line_info_v3, fitting_scripts
+    from astra.pipelines.snow_white.model_grid import load_line_crop
+    from astra.pipelines.snow_white.objective import DALineObjective, ModelNormaliser
+    from astra.pipelines.snow_white.plotting import plot_da_fit
+    from astra.utils.plots import save_or_defer_plot
 
     with open(os.path.join(PIPELINE_DATA_DIR, 'training_file_LL'), 'rb') as f:
         kf = pickle._load(f, fix_imports=True)
@@ -55,6 +66,8 @@ def snow_white(
     with open(os.path.join(PIPELINE_DATA_DIR, "emu_file"), 'rb') as pickle_file:
         emu = pickle.load(pickle_file)
 
+    normalise = ModelNormaliser(wref)
+
     for spectrum in spectra:
         try:                
             labels = get_line_info_v3.line_info(spectrum.wavelength, spectrum.flux, spectrum.e_flux)
@@ -93,7 +106,7 @@ def snow_white(
                 #normilize spectrum
                 spec_n, cont_flux = fitting_scripts.norm_spectra(spectra,model=False)
                 #load lines to fit and crops them
-                line_crop = np.loadtxt(os.path.join(PIPELINE_DATA_DIR, 'line_crop.dat'))
+                line_crop = load_line_crop('line_crop.dat')
                 l_crop = line_crop[(line_crop[:,0]>spec_w.min()) & (line_crop[:,1]<spec_w.max())]
 
                 #fit entire grid to find good starting point
@@ -102,16 +115,16 @@ def snow_white(
                 first_T=grid_param[grid_chi==np.min(grid_chi)][0][0]
                 first_g=grid_param[grid_chi==np.min(grid_chi)][0][1]
                 if first_T>=16000 and first_T<=40000:
-                    line_crop = np.loadtxt(os.path.join(PIPELINE_DATA_DIR, 'line_crop.dat'))
+                    line_crop = load_line_crop('line_crop.dat')
                     l_crop = line_crop[(line_crop[:,0]>spec_w.min()) & (line_crop[:,1]<spec_w.max())]
                 elif first_T>=8000 and first_T<16000:
-                    line_crop = np.loadtxt(os.path.join(PIPELINE_DATA_DIR, 'line_crop_cool.dat'))
+                    line_crop = load_line_crop('line_crop_cool.dat')
                     l_crop = line_crop[(line_crop[:,0]>spec_w.min()) & (line_crop[:,1]<spec_w.max())]
                 elif first_T<8000:
-                    line_crop = np.loadtxt(os.path.join(PIPELINE_DATA_DIR, 'line_crop_vcool.dat'))
+                    line_crop = load_line_crop('line_crop_vcool.dat')
                     l_crop = line_crop[(line_crop[:,0]>spec_w.min()) & (line_crop[:,1]<spec_w.max())]
                 elif first_T>40000:
-                    line_crop = np.loadtxt(os.path.join(PIPELINE_DATA_DIR, 'line_crop_hot.dat'))
+                    line_crop = load_line_crop('line_crop_hot.dat')
                     l_crop = line_crop[(line_crop[:,0]>spec_w.min()) & (line_crop[:,1]<spec_w.max())]
 
                 #-----------------------load PCA files------------------------------------------------------
@@ -119,11 +132,12 @@ def snow_white(
 
 
                 #this calls the scripts in fitting_scipts and does the actual fitting
+                objective = DALineObjective(spec_n,l_crop,emu,wref,normalise)
                 new_best= op.minimize(
-                    fitting_scripts.fit_func,
+                    objective,
                     (first_T,first_g,30.),
                     bounds=((3000,80000),(705,949),(-300,300)),
-                    args=(spec_n,l_crop,emu,wref,0,),method="Nelder-Mead")
+                    method="Nelder-Mead")
 
                 best_T, best_g, best_rv = new_best.x[0], new_best.x[1], new_best.x[2]
 
@@ -144,7 +158,8 @@ def snow_white(
                     g_min=701
 
                 #repeat fit using best solution and least square to find errors
-                err_best= op.least_squares(fitting_scripts.fit_func,(first_T, best_g, best_rv),bounds=([3000,701,best_rv-10],[80000,949,best_rv+10]),args=(spec_n,l_crop,emu,wref,2),method="trf")
+                err_bounds=([3000,701,best_rv-10],[80000,949,best_rv+10])
+                err_best= op.least_squares(objective.residuals,(first_T, best_g, best_rv),jac=lambda x: objective.jacobian(x,err_bounds),bounds=err_bounds,method="trf")
                 U, s, Vh = linalg.svd(err_best.jac, full_matrices=False)
                 tol = np.finfo(float).eps*s[0]*max(err_best.jac.shape)
                 w = s > tol
@@ -163,26 +178,27 @@ def snow_white(
 
 
                 if second_T>=16000 and second_T<=40000:
-                    line_crop = np.loadtxt(os.path.join(PIPELINE_DATA_DIR, 'line_crop.dat'))
+                    line_crop = load_line_crop('line_crop.dat')
                     l_crop = line_crop[(line_crop[:,0]>spec_w.min()) & (line_crop[:,1]<spec_w.max())]
                 elif second_T>=8000 and second_T<16000:
-                    line_crop = np.loadtxt(os.path.join(PIPELINE_DATA_DIR, 'line_crop_cool.dat'))
+                    line_crop = load_line_crop('line_crop_cool.dat')
                     l_crop = line_crop[(line_crop[:,0]>spec_w.min()) & (line_crop[:,1]<spec_w.max())]
                 elif second_T<8000:
-                    line_crop = np.loadtxt(os.path.join(PIPELINE_DATA_DIR, 'line_crop_vcool.dat'))
+                    line_crop = load_line_crop('line_crop_vcool.dat')
                     l_crop = line_crop[(line_crop[:,0]>spec_w.min()) & (line_crop[:,1]<spec_w.max())]
                 elif second_T>40000:
-                    line_crop = np.loadtxt(os.path.join(PIPELINE_DATA_DIR, 'line_crop_hot.dat'))
+                    line_crop = load_line_crop('line_crop_hot.dat')
                     l_crop = line_crop[(line_crop[:,0]>spec_w.min()) & (line_crop[:,1]<spec_w.max())]
 
+                objective = DALineObjective(spec_n,l_crop,emu,wref,normalise)
                 if best_T>=13000:
-                    new_best2= op.minimize(fitting_scripts.fit_func,(8000,750,best_rv),
+                    new_best2= op.minimize(objective,(8000,750,best_rv),
                                             bounds=((3000,13000),(701,949),(-300,300))
-                                                    ,args=(spec_n,l_crop,emu,wref,0),method="Nelder-Mead")
+                                                    ,method="Nelder-Mead")
                 elif best_T<13000:
-                    new_best2= op.minimize(fitting_scripts.fit_func,(second_T,second_g,best_rv),
+                    new_best2= op.minimize(objective,(second_T,second_g,best_rv),
                                             bounds=((13000,80000),(705,949),(-300,300))
-                                                    ,args=(spec_n,l_crop,emu,wref,0),method="Nelder-Mead")
+                                                    ,method="Nelder-Mead")
 
                 best_T2, best_g2, best_rv2 = new_best2.x[0], new_best2.x[1], new_best2.x[2]
 
@@ -203,7 +219,8 @@ def snow_white(
                     g_min2=651
 
                 #err_best2= optimize.least_squares(fitting_scripts.fit_func,(best_T2, best_g2, best_rv2),bounds=([T_min2,g_min2,best_rv2-10],[T_max2,g_max2,best_rv2+10]),args=(spec_n,l_crop,emu,wref,2),method="trf")
-                err_best2= op.least_squares(fitting_scripts.fit_func,(second_T, best_g2, best_rv2),bounds=([3000,701,best_rv2-10],[80000,949,best_rv2+10]),args=(spec_n,l_crop,emu,wref,2),method="trf")
+                err_bounds2=([3000,701,best_rv2-10],[80000,949,best_rv2+10])
+                err_best2= op.least_squares(objective.residuals,(second_T, best_g2, best_rv2),jac=lambda x: objective.jacobian(x,err_bounds2),bounds=err_bounds2,method="trf")
 
                 U, s, Vh = linalg.svd(err_best2.jac, full_matrices=False)
                 tol = np.finfo(float).eps*s[0]*max(err_best2.jac.shape)
@@ -241,8 +258,7 @@ def snow_white(
                 c = 299792.458 # Speed of light in km/s=
 
                 # Get and save the 2 best lines from the spec and model, and the full models
-                lines_s,lines_m,mod_n=fitting_scripts.fit_func((best_T,best_g,best_rv),
-                                                        spec_n,l_crop,emu,wref,mode=1)
+                lines_s,lines_m,mod_n=objective.lines((best_T,best_g,best_rv))
 
                 full_spec=np.stack((spectrum.wavelength,spectrum.flux,spectrum.e_flux),axis=-1)
                 full_spec = full_spec[(np.isnan(full_spec[:,1])==False) & (full_spec[:,0]>3500)& (full_spec[:,0]<7900)]
@@ -264,66 +280,21 @@ def snow_white(
                     ]
                 ).writeto(result.absolute_path, overwrite=True)
                     
-                if plot:                
-                
-                    lines_s_o,lines_m_o,mod_n_o=fitting_scripts.fit_func((best_T2,best_g2,best_rv),
-                                                                    spec_n,l_crop,emu,wref,mode=1)                
-
-                    fig=plt.figure(figsize=(8,5))
-                    ax1 = plt.subplot2grid((1,4), (0, 3),rowspan=3)
-                    step = 0
-                    for i in range(0,len(lines_s)): # plots Halpha (i=0) to H6 (i=5)
-                        min_p   = lines_s[i][:,0][lines_s[i][:,1]==np.min(lines_s[i][:,1])][0]
-                        min_p_o = lines_s_o[i][:,0][lines_s_o[i][:,1]==np.min(lines_s_o[i][:,1])][0]
-                        ax1.plot(lines_s[i][:,0]-min_p,lines_s[i][:,1]+step,color='k')
-                        ax1.plot(lines_s[i][:,0]-min_p,lines_m[i]+step,color='r')
-                        ax1.plot(lines_s_o[i][:,0]-min_p_o,lines_m_o[i]+step,color='g')
-                        step+=0.5
-                    xticks = ax1.xaxis.get_major_ticks()
-                    ax1.set_xticklabels([])
-                    ax1.set_yticklabels([])
-
-                    ax2 = plt.subplot2grid((3,4), (0, 0),colspan=3,rowspan=2)
-                    #try:
-                    #    full_spec=np.loadtxt(sys.argv[1],usecols=(0,1),delimiter=",",unpack=True).transpose()
-                    #except:
-                    #    full_spec=np.loadtxt(sys.argv[1],usecols=(0,1),unpack=True).transpose()
-                    
-                    ax2.plot(full_spec[:,0],full_spec[:,1],color='k')
-                    ax2.plot(mod_n[:,0]*(best_rv+c)/c,(mod_n[:,1]/adjust),color='r')
-                
-                    check_f_model_o=mod_n_o[:,1][(mod_n_o[:,0]>4500.) & (mod_n_o[:,0]<4550.)]
-                    adjust_o=np.average(check_f_model_o)/np.average(check_f_spec)
-                    ax2.plot(mod_n_o[:,0]*(best_rv+c)/c,mod_n_o[:,1]/adjust_o,color='g')
-
-                    ax2.set_ylabel(r'F$_{\lambda}$ [erg cm$^{-2}$ s$^{-1} \AA^{-1}$]',fontsize=12)
-                    ax2.set_xlabel(r'Wavelength $(\AA)$',fontsize=12)
-                    ax2.set_xlim([3400,5600])
-                    ax2.set_ylim(0, 2 * np.nanmax(mod_n_o[:,1]/adjust_o))
-                    ax3 = plt.subplot2grid((3,4), (2, 0),colspan=3,rowspan=1,sharex=ax2)
-
-                    flux_i = interpolate.interp1d(mod_n[:,0]*(best_rv+c)/c,mod_n[:,1]/adjust,kind='linear')(full_spec[:,0])
-                    wave3=full_spec[:,0]
-                    flux3=full_spec[:,1]/flux_i
-                    binsize=1
-                    xdata3=[]
-                    ydata3=[]
-                    for i in range(0,(np.size(wave3)-binsize),binsize):
-                        xdata3.append(np.average(wave3[i:i+binsize]))
-                        ydata3.append(np.average(flux3[i:i+binsize]))
-                    plt.plot(xdata3,ydata3)
-
-                    plt.hlines(1.02, 3400,5600,colors="r")
-                    plt.hlines(1.01, 3400,5600,colors="0.5",ls="--")
-                    plt.hlines(0.98, 3400,5600,colors="r")
-                    plt.hlines(0.99, 3400,5600,colors="0.5",ls="--")
-                    ax3.set_xlim([3400,5600])
-                    ax3.set_ylim([0.95,1.04])
-                    
-                    figure_path = expand_path(f"$MWM_ASTRA/{__version__}/pipelines/snow_white/{spectrum.source.sdss_id}-{spectrum.spectrum_pk}.png")
-                    os.makedirs(os.path.dirname(figure_path), exist_ok=True)
-                    fig.savefig(figure_path)
-                    plt.close("all")
+                if plot:
+                    lines_s_o,lines_m_o,mod_n_o=objective.lines((best_T2,best_g2,best_rv))
+                    save_or_defer_plot(
+                        plot_da_fit,
+                        f"$MWM_ASTRA/{__version__}/pipelines/snow_white/{spectrum.source.sdss_id}-{spectrum.spectrum_pk}.png",
+                        defer=defer_plots,
+                        full_spec=full_spec,
+                        lines_s=lines_s,
+                        lines_m=lines_m,
+                        lines_s_o=lines_s_o,
+                        lines_m_o=lines_m_o,
+                        mod_n=mod_n,
+                        mod_n_o=mod_n_o,
+                        best_rv=best_rv,
+                    )
 
             # No chi2, statistics, or flagging information..
             yield result
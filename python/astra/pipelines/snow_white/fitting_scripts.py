@@ -11,6 +11,13 @@ from astra.utils import expand_path
 
 PIPELINE_DATA_DIR = expand_path(f"$MWM_ASTRA/pipelines/snow_white")
 
+# Continuum regions used by `norm_spectra`, and whether each is fitted for a peak ('P') or mean'd ('M').
+NORM_START=np.array([3805,3835.,3895.,3995.,4180,4490.,4620.,5070.,5200.,
+                     5600.,6000.,7000.,7400.,7700.])
+NORM_END=np.array([3830,3885.,3960.,4075.,4240,4570.,4670.,5100.,5300.,
+                   5800.,6100.,7150.,7500.,7800.])
+NORM_RANGE=np.array(['P','P','P','P','P','M','M','M','M','M','M','M','M','M','M','M','M'])
+
 
 def norm_spectra(spectra,model=True,add_infinity=False):
     """
@@ -36,11 +43,7 @@ def norm_spectra(spectra,model=True,add_infinity=False):
         #n_range_s=np.array(['P','P','P','P','P','P','M','M','M','M','M','M','M','M','M','M','M'])
         #n_range_s=np.array(['M','M','M','M','M','M','M','M','M','M','M','M','M','M','M','M','M'])
     #else:
-    start_n=np.array([3805,3835.,3895.,3995.,4180,4490.,4620.,5070.,5200.,
-                      5600.,6000.,7000.,7400.,7700.])
-    end_n=np.array([3830,3885.,3960.,4075.,4240,4570.,4670.,5100.,5300.,
-                    5800.,6100.,7150.,7500.,7800.])
-    n_range_s=np.array(['P','P','P','P','P','M','M','M','M','M','M','M','M','M','M','M','M'])
+    start_n, end_n, n_range_s = NORM_START, NORM_END, NORM_RANGE
     if len(spectra[0])>2:
         snr = np.zeros([len(start_n),3])
         spectra[:,2][spectra[:,2]==0.] = spectra[:,2].max()
@@ -73,7 +76,7 @@ def norm_spectra(spectra,model=True,add_infinity=False):
                         if model==False:
                             snr[j,0]= np.mean(l)
                         else:
-                            snr[j,0]= l[f==np.max(f)]
+                            snr[j,0]= l[f==np.max(f)][0]
                     n=int(np.size(_s[:,1])/3.)
                     f_sort=np.sort(_s[:,1])
                     #errs=[np.where(f==i) for i in f_sort]
@@ -129,30 +132,12 @@ def norm_spectra(spectra,model=True,add_infinity=False):
 #======================================================================
     return spectra_ret, cont_flux
 
-def fit_grid(specn,l_crop):
-    #load normalised models and linearly interp models onto spectrum wave
-    specn = specn[(specn[:,0]>3500)& (specn[:,0]<7500)]
-    m_wave=np.arange(3000,8000,0.5)
-    m_flux_n=np.load(os.path.join(PIPELINE_DATA_DIR, "da_flux_cube.npy"))
-    m_param=np.load(os.path.join(PIPELINE_DATA_DIR, "da_param_cube.npy"))
-    sn_w = specn[:,0]
-    m_flux_n_i = interpolate.interp1d(m_wave,m_flux_n,kind='linear')(sn_w)
-    #Crops models and spectra in a line region, renorms models, calculates chi2
-    tmp_lines_m, lines_s, l_chi2 = [],[],[]
-    for i in range(len(l_crop)):
-        l_c0,l_c1 = l_crop[i,0],l_crop[i,1]
-        l_m = m_flux_n_i.transpose()[(sn_w>=l_c0)&(sn_w<=l_c1)].transpose()
-        l_s = specn[(sn_w>=l_c0)&(sn_w<=l_c1)]
-        l_m = l_m*np.sum(l_s[:,1])/np.sum(l_m,axis=1).reshape([len(l_m),1])
-        l_chi2.append( np.sum(((l_s[:,1]-l_m)/l_s[:,2])**2,axis=1) )
-        tmp_lines_m.append(l_m)
-        lines_s.append(l_s)
-    #mean chi2 over lines and stores best model lines for output
-    lines_chi2, lines_m = np.sum(np.array(l_chi2),axis=0), []
-    is_best = lines_chi2==lines_chi2.min()
-    for i in range(len(l_crop)): lines_m.append(tmp_lines_m[i][is_best][0])
-    best_TL = m_param[is_best][0]
-    return  lines_s,lines_m,best_TL,m_param,lines_chi2
+def fit_grid(specn,l_crop,grid=None):
+    """Fit the entire (normalised) DA model grid to find a good starting point.
+       Returns lines_s, lines_m, best_TL, m_param, lines_chi2
+       The grid is loaded once per process and resampled onto the BOSS wavelength grid (see `model_grid`)."""
+    from astra.pipelines.snow_white.model_grid import get_da_model_grid
+    return (grid or get_da_model_grid()).fit(specn,l_crop)
 
 def fit_func(x,specn,lcrop,emu,wref,mode=0):
     """Requires: x - initial guess of T, g, and rv
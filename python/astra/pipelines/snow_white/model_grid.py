@@ -0,0 +1,207 @@
+"""A process-resident grid of normalised DA models for the Snow White grid search."""
+
+import os
+import numpy as np
+from functools import cache
+from scipy import interpolate
+
+from astra.utils import expand_path
+
+PIPELINE_DATA_DIR = expand_path(f"$MWM_ASTRA/pipelines/snow_white")
+
+# Wavelength grid of `da_flux_cube.npy`.
+MODEL_WAVELENGTH = np.arange(3000, 8000, 0.5)
+
+# The BOSS log-lambda wavelength grid.
+BOSS_WAVELENGTH = 10**(3.5523 + 1e-4 * np.arange(4648))
+
+
+@cache
+def load_line_crop(name="line_crop.dat"):
+    """
+    Load (once per process) the wavelength windows of the lines to fit.
+
+    :param name: [optional]
+        The name of the line crop file in the pipeline data directory.
+    """
+    line_crop = np.loadtxt(os.path.join(PIPELINE_DATA_DIR, name))
+    line_crop.flags.writeable = False
+    return line_crop
+
+
+@cache
+def get_da_model_grid():
+    """Return the DA model grid, loading it (once per process) from the pipeline data directory."""
+    return DAModelGrid.from_data_dir()
+
+
+class DAModelGrid(object):
+
+    def __init__(
+        self,
+        flux,
+        param,
+        model_wavelength=MODEL_WAVELENGTH,
+        wavelength=BOSS_WAVELENGTH,
+        wavelength_range=(3500, 7500),
+    ):
+        """
+        A grid of normalised DA models that are resampled once onto a fixed wavelength grid, so that the
+        chi-squared of every model in every line window can be computed with a few matrix products.
+
+        :param flux:
+            A (N_models, N_model_pixels) array of normalised model fluxes.
+
+        :param param:
+            A (N_models, 2) array of model parameters (effective temperature, surface gravity).
+
+        :param model_wavelength: [optional]
+            The wavelength grid of `flux`.
+
+        :param wavelength: [optional]
+            The wavelength grid to resample the models onto (default: the BOSS log-lambda grid).
+
+        :param wavelength_range: [optional]
+            The exclusive wavelength range of pixels to use in the fit.
+        """
+        self.model_flux = flux
+        self.model_wavelength = model_wavelength
+        self.param = param
+        self.wavelength_range = wavelength_range
+
+        lower, upper = wavelength_range
+        self.wavelength = wavelength[(wavelength > lower) & (wavelength < upper)]
+        self.flux = interpolate.interp1d(self.model_wavelength, flux, kind="linear")(self.wavelength)
+        self._line_windows = {}
+        return None
+
+    @classmethod
+    def from_data_dir(cls, path=PIPELINE_DATA_DIR, **kwargs):
+        """
+        Memory-map the model flux and parameter cubes from the pipeline data directory.
+
+        :param path: [optional]
+            The directory that contains `da_flux_cube.npy` and `da_param_cube.npy`.
+        """
+        flux = np.load(os.path.join(path, "da_flux_cube.npy"), mmap_mode="r")
+        param = np.load(os.path.join(path, "da_param_cube.npy"), mmap_mode="r")
+        return cls(flux, param, **kwargs)
+
+    def line_windows(self, l_crop):
+        """
+        Return the resampled pixels that are in any line window, an array indicating which of those pixels
+        are in each line window, and the model fluxes (and squared fluxes) at those pixels.
+
+        :param l_crop:
+            A (N_lines, 2) array of line window edges.
+
+        :returns:
+            A four-length tuple containing the (N_line_pixels, ) array of pixel indices, the
+            (N_lines, N_line_pixels) line window array, and two (N_models, N_line_pixels) arrays of model
+            fluxes and squared model fluxes.
+        """
+        key = np.asarray(l_crop, dtype=float).tobytes()
+        try:
+            return self._line_windows[key]
+        except KeyError:
+            windows = (
+                (self.wavelength >= l_crop[:, [0]])
+            &   (self.wavelength <= l_crop[:, [1]])
+            )
+            pixels = np.flatnonzero(np.any(windows, axis=0))
+            self._line_windows[key] = (
+                pixels,
+                windows[:, pixels].astype(float),
+                self.flux[:, pixels],
+                self.flux[:, pixels]**2
+            )
+            return self._line_windows[key]
+
+    def _resampled_pixels(self, wavelength):
+        """Return the indices of the resampled pixels at these wavelengths, or `None` if they are not on the grid."""
+        indices = np.clip(np.searchsorted(self.wavelength, wavelength), 0, self.wavelength.size - 1)
+        if np.allclose(self.wavelength[indices], wavelength, rtol=1e-12, atol=0):
+            return indices
+        return None
+
+    def line_chi2(self, specn, l_crop):
+        """
+        Compute the chi-squared of every model in every line window, with each model scaled to match the
+        total spectrum flux in each line window.
+
+        :param specn:
+            A (N_pixels, 3) array of the normalised spectrum wavelength, flux, and flux error.
+
+        :param l_crop:
+            A (N_lines, 2) array of line window edges.
+
+        :returns:
+            A two-length tuple containing the (N_models, N_lines) model scales, and the (N_models, N_lines)
+            chi-squared values.
+        """
+        lower, upper = self.wavelength_range
+        specn = specn[(specn[:, 0] > lower) & (specn[:, 0] < upper)]
+        wavelength, flux, e_flux = specn.T
+        ivar = e_flux**-2
+
+        indices = self._resampled_pixels(wavelength)
+        if indices is None:
+            # The spectrum is not on the resampled grid, so interpolate the models directly.
+            model_flux = interpolate.interp1d(self.model_wavelength, self.model_flux, kind="linear")(wavelength)
+            model_flux_squared = model_flux**2
+            windows = ((wavelength >= l_crop[:, [0]]) & (wavelength <= l_crop[:, [1]])).astype(float)
+        else:
+            # Place the spectrum on the line pixels of the resampled grid, with zero weight where it has no data.
+            pixels, windows, model_flux, model_flux_squared = self.line_windows(l_crop)
+            position = np.clip(np.searchsorted(pixels, indices), 0, pixels.size - 1)
+            on_line = (pixels[position] == indices)
+            present = np.zeros(pixels.size)
+            present[position[on_line]] = 1
+            windows = windows * present
+            flux, ivar = (np.zeros(pixels.size), np.zeros(pixels.size))
+            flux[position[on_line]] = specn[on_line, 1]
+            ivar[position[on_line]] = e_flux[on_line]**-2
+
+        # chi2 = sum((f - a * m)**2 / e**2) over each window, with a = sum(f) / sum(m) in that window.
+        scale = (windows @ flux) / (model_flux @ windows.T)
+        chi2 = (
+            (windows @ (flux**2 * ivar))
+        -   2 * scale * (model_flux @ (windows * flux * ivar).T)
+        +   scale**2 * (model_flux_squared @ (windows * ivar).T)
+        )
+        return (scale, chi2)
+
+    def fit(self, specn, l_crop):
+        """
+        Find the best-fitting model in the grid.
+
+        :param specn:
+            A (N_pixels, 3) array of the normalised spectrum wavelength, flux, and flux error.
+
+        :param l_crop:
+            A (N_lines, 2) array of line window edges.
+
+        :returns:
+            A five-length tuple containing the spectrum in each line, the best-fitting model in each line,
+            the best-fitting model parameters, the parameters of all models, and the chi-squared of all
+            models (summed over lines). This is the same as `fitting_scripts.fit_grid`.
+        """
+        scale, chi2 = self.line_chi2(specn, l_crop)
+        lines_chi2 = np.sum(chi2, axis=1)
+        best = np.nanargmin(lines_chi2)
+
+        lower, upper = self.wavelength_range
+        specn = specn[(specn[:, 0] > lower) & (specn[:, 0] < upper)]
+        wavelength = specn[:, 0]
+        indices = self._resampled_pixels(wavelength)
+        if indices is None:
+            best_model_flux = np.interp(wavelength, self.model_wavelength, self.model_flux[best])
+        else:
+            best_model_flux = self.flux[best, indices]
+
+        lines_s, lines_m = ([], [])
+        for i, (l_c0, l_c1) in enumerate(l_crop):
+            in_line = (wavelength >= l_c0) & (wavelength <= l_c1)
+            lines_s.append(specn[in_line])
+            lines_m.append(scale[best, i] * best_model_flux[in_line])
+        return (lines_s, lines_m, self.param[best], self.param, lines_chi2)
@@ -0,0 +1,326 @@
+"""A vectorised line-fitting objective for emulated DA models in Snow White."""
+
+import numpy as np
+from scipy import interpolate
+
+from astra.pipelines.snow_white.fitting_scripts import NORM_START, NORM_END, NORM_RANGE
+
+SPEED_OF_LIGHT = 299792.458 # km/s
+
+
+class ModelNormaliser(object):
+
+    def __init__(self, wavelength):
+        """
+        Normalise many models on a fixed wavelength grid, in the same way as `fitting_scripts.norm_spectra`
+        (with `model=True`).
+
+        In each continuum region, `norm_spectra` evaluates an interpolating spline of the model on a finer
+        grid. For a fixed wavelength grid that spline is linear in the model flux, so it is computed here once
+        as a matrix, and the continuum points of many models are found with a few matrix products. Only the
+        final continuum spline (whose knots depend on the model) is fitted per model.
+
+        :param wavelength:
+            The wavelength grid of the models.
+        """
+        self.wavelength = wavelength
+        self.regions = []
+        for start, end, kind in zip(NORM_START, NORM_END, NORM_RANGE):
+            if (start >= wavelength.max()) or (end <= wavelength.min()):
+                continue
+            region = np.flatnonzero((wavelength >= start) & (wavelength <= end))
+            if region.size <= 3:
+                continue
+            w = wavelength[region]
+            l = np.linspace(w.min(), w.max(), (w.size - 1)*10 + 1)
+            basis = np.array([interpolate.splev(l, interpolate.splrep(w, y, s=0.0)) for y in np.eye(w.size)])
+            if kind == "P":
+                # The peak of the spline on the fine grid, and the mean of the brightest third of the pixels.
+                self.regions.append((region, kind, l, basis))
+            else:
+                # The mean of the spline on the fine grid.
+                self.regions.append((region, kind, np.mean(l), np.mean(basis, axis=1)))
+        return None
+
+    def continuum_points(self, flux):
+        """
+        Return the continuum points of many models.
+
+        :param flux:
+            A (N, N_pixels) array of model fluxes.
+
+        :returns:
+            A two-length tuple containing the (N, N_regions) wavelengths and fluxes of the continuum points.
+        """
+        x, y = (np.empty((len(flux), len(self.regions))), np.empty((len(flux), len(self.regions))))
+        for j, (region, kind, l, basis) in enumerate(self.regions):
+            region_flux = flux[:, region[0]:region[-1] + 1]
+            if kind == "P":
+                x[:, j] = l[np.argmax(region_flux @ basis, axis=1)]
+                n = int(region.size/3.)
+                y[:, j] = np.mean(np.sort(region_flux, axis=1)[:, -n:], axis=1)
+            else:
+                x[:, j] = l
+                y[:, j] = region_flux @ basis
+        return (x, y)
+
+    def __call__(self, flux):
+        """
+        Normalise many models.
+
+        :param flux:
+            A (N, N_pixels) array of model fluxes.
+
+        :returns:
+            A (N, N_pixels) array of normalised model fluxes. Models with non-finite fluxes are all NaN.
+        """
+        flux = np.atleast_2d(flux)
+        normalised = np.nan * np.ones(flux.shape)
+        finite = np.all(np.isfinite(flux), axis=1)
+        for i, x, y in zip(np.flatnonzero(finite), *self.continuum_points(flux[finite])):
+            normalised[i] = flux[i] / interpolate.splev(self.wavelength, interpolate.splrep(x, y, k=3))
+        return normalised
+
+
+class DALineObjective(object):
+
+    def __init__(self, specn, l_crop, emu, wref, normalise=None):
+        """
+        The chi-squared of an emulated, normalised DA model in the line windows of a normalised spectrum,
+        as a function of effective temperature, surface gravity (log g x 100), and radial velocity.
+
+        This is equivalent to `fitting_scripts.tmp_func_rv`, except the model is shifted and interpolated
+        once per evaluation (not once per line), the line windows are gathered with index arrays, and
+        many parameter vectors can be evaluated at once through the emulator.
+
+        :param specn:
+            A (N_pixels, 3) array of the normalised spectrum wavelength, flux, and flux error, sorted by
+            wavelength.
+
+        :param l_crop:
+            A (N_lines, 2) array of line window edges (in the rest frame).
+
+        :param emu:
+            The PCA emulator (`emulator_DA.Emulator_DA`) of DA model spectra.
+
+        :param wref:
+            The wavelength grid of the emulated spectra.
+
+        :param normalise: [optional]
+            A `ModelNormaliser` for `wref`, to share between objectives.
+        """
+        self.specn = np.asarray(specn)
+        self.wavelength, self.flux, self.e_flux = self.specn[:, :3].T
+        if np.any(np.diff(self.wavelength) < 0):
+            raise ValueError("spectrum wavelengths must be sorted")
+        self.l_crop = np.atleast_2d(l_crop)
+        self.emu = emu
+        self.wref = wref
+        self.normalise = normalise or ModelNormaliser(wref)
+        # Radial velocity is ignored in mode=2, so those windows never change.
+        self._rest_frame_indices = self.line_indices(0)
+        return None
+
+    def line_indices(self, rv):
+        """
+        Return the indices of the spectrum pixels in each line window, after shifting the line windows
+        by a radial velocity.
+
+        :param rv:
+            The radial velocity (in km/s).
+
+        :returns:
+            A two-length tuple containing the concatenated pixel indices of all line windows, and the
+            (N_lines + 1, ) offsets of each line in those indices.
+        """
+        l_crop = self.l_crop*(rv + SPEED_OF_LIGHT)/SPEED_OF_LIGHT
+        si = np.searchsorted(self.wavelength, l_crop[:, 0], side="left")
+        ei = np.maximum(si, np.searchsorted(self.wavelength, l_crop[:, 1], side="right"))
+        offsets = np.hstack([0, np.cumsum(ei - si)])
+        indices = np.repeat(si - offsets[:-1], ei - si) + np.arange(offsets[-1])
+        return (indices, offsets)
+
+    def normalised_model_flux(self, teff, logg):
+        """
+        Emulate and normalise DA models.
+
+        :param teff:
+            An array of N effective temperatures.
+
+        :param logg:
+            An array of N surface gravities (log g x 100).
+
+        :returns:
+            A two-length tuple containing the (N, N_wref) emulated model fluxes, and the (N, N_wref)
+            normalised model fluxes.
+        """
+        teff, logg = np.broadcast_arrays(np.atleast_1d(teff), np.atleast_1d(logg))
+        recovered = np.atleast_2d(self.emu(np.vstack([np.log10(teff), logg]).T))
+        return (recovered, self.normalise(recovered))
+
+    def _chi(self, model_flux, rv, mode):
+        if mode == 2:
+            indices, offsets = self._rest_frame_indices
+            wavelength = self.wref
+        else:
+            indices, offsets = self.line_indices(rv)
+            wavelength = self.wref*(rv + SPEED_OF_LIGHT)/SPEED_OF_LIGHT
+        line_model_flux = np.interp(self.wavelength[indices], wavelength, model_flux)
+        return (indices, offsets, line_model_flux, (self.flux[indices] - line_model_flux)/self.e_flux[indices])
+
+    def chi_many(self, x, mode=0):
+        """
+        Compute the normalised residuals in the line windows for many parameter vectors.
+
+        :param x:
+            A (N, 3) array of effective temperature, surface gravity (log g x 100), and radial velocity.
+
+        :param mode: [optional]
+            If `mode=2`, the radial velocity is ignored (as in `fitting_scripts.tmp_func_rv`).
+
+        :returns:
+            A list of N arrays of residuals. These have the same length if `mode=2`.
+        """
+        teff, logg, rv = np.atleast_2d(x).T
+        recovered, normalised = self.normalised_model_flux(teff, logg)
+        return [self._chi(model_flux, v, mode)[-1] for model_flux, v in zip(normalised, rv)]
+
+    def chi2_many(self, x, mode=0):
+        """
+        Compute the reduced chi-squared in the line windows for many parameter vectors.
+
+        :param x:
+            A (N, 3) array of effective temperature, surface gravity (log g x 100), and radial velocity.
+
+        :param mode: [optional]
+            If `mode=2`, the radial velocity is ignored (as in `fitting_scripts.tmp_func_rv`).
+
+        :returns:
+            An array of N reduced chi-squared values.
+        """
+        return np.array([np.sum(chi**2)/chi.size for chi in self.chi_many(x, mode)])
+
+    def __call__(self, x, mode=0):
+        """The reduced chi-squared for one parameter vector (the quantity that is minimised)."""
+        return self.chi2_many(x, mode)[0]
+
+    def residuals(self, x, mode=2):
+        """The normalised residuals in the line windows for one parameter vector."""
+        return self.chi_many(x, mode)[0]
+
+    def jacobian(self, x, bounds=(-np.inf, np.inf), mode=2):
+        """
+        Compute the forward-difference Jacobian of the residuals, evaluating all steps through the
+        emulator at once. The steps are the same as the `2-point` scheme of `scipy.optimize.least_squares`.
+
+        :param x:
+            A parameter vector of effective temperature, surface gravity (log g x 100), and radial velocity.
+
+        :param bounds: [optional]
+            The lower and upper bounds of the parameters. Steps that would leave the bounds are reversed.
+
+        :param mode: [optional]
+            If `mode=2`, the radial velocity is ignored (as in `fitting_scripts.tmp_func_rv`).
+
+        :returns:
+            A (N_residuals, 3) array of the Jacobian.
+        """
+        x = np.asarray(x, dtype=float)
+        lower, upper = (np.broadcast_to(b, x.shape) for b in bounds)
+        h = np.finfo(float).eps**0.5 * np.where(x >= 0, 1, -1) * np.maximum(1, np.abs(x))
+        h = np.where(((x + h) > upper) | ((x + h) < lower), -h, h)
+        h = (x + h) - x
+
+        chis = self.chi_many(np.vstack([x, x + np.diag(h)]), mode)
+        return np.array([(chi - chis[0])/dx for chi, dx in zip(chis[1:], h)]).T
+
+    def lines(self, x, mode=1):
+        """
+        Return the spectrum and the (shifted) normalised model in each line window.
+
+        :param x:
+            A parameter vector of effective temperature, surface gravity (log g x 100), and radial velocity.
+
+        :returns:
+            A three-length tuple containing the spectrum in each line, the model in each line, and the
+            (N_wref, 2) array of the emulated (not normalised) model.
+        """
+        teff, logg, rv = x
+        recovered, normalised = self.normalised_model_flux(teff, logg)
+        indices, offsets, line_model_flux, chi = self._chi(normalised[0], rv, mode)
+        lines_s, lines_m = ([], [])
+        for si, ei in zip(offsets[:-1], offsets[1:]):
+            lines_s.append(self.specn[indices[si:ei]])
+            lines_m.append(line_model_flux[si:ei])
+        return (lines_s, lines_m, np.stack((self.wref, recovered[0]), axis=-1))
+
+
+if __name__ == "__main__":
+
+    # Benchmark the objective against `tmp_func_rv` with a synthetic emulator.
+    import scipy.optimize as op
+    from time import time
+    from astra.pipelines.snow_white.emulator_DA import Emulator_DA
+    from astra.pipelines.snow_white.fitting_scripts import norm_spectra, tmp_func_rv
+
+    rng = np.random.default_rng(0)
+    wref = np.arange(3600, 8000, 1.0)
+    teffs, gravities = (np.linspace(6000, 40000, 30), np.linspace(700, 950, 11))
+    centers = np.array([3970.1, 4101.7, 4340.5, 4861.3, 6562.8])
+    width = 5 + 50 * np.log10(teffs / 5000)[:, None, None] * (gravities / 800)[None, :, None]
+    spectra = 1e3 * (1 - np.sum([0.5 * np.exp(-0.5 * ((wref - c) / width)**2) for c in centers], axis=0))
+    emu = Emulator_DA(wref, teffs, gravities, spectra)
+    emu.run_pca()
+
+    l_crop = np.vstack([centers - 50, centers + 50]).T
+    wavelength = 10**(3.5523 + 1e-4 * np.arange(4648))
+    wavelength = wavelength[(wavelength > 3800) & (wavelength < 7900)]
+    flux = np.interp(wavelength, wref * (1 + 25 / SPEED_OF_LIGHT), emu([np.log10(15000), 810]))
+    e_flux = 0.02 * np.median(flux) * np.ones_like(flux)
+    specn, _ = norm_spectra(np.vstack([wavelength, flux + rng.normal(0, e_flux), e_flux]).T, model=False)
+
+    objective = DALineObjective(specn, l_crop, emu, wref)
+    x0 = (14000., 800., 30.)
+    for mode in (0, 2):
+        a = tmp_func_rv(*x0, specn, l_crop, emu, wref, mode)
+        b = objective.chi_many(x0, mode)[0]
+        print(f"mode={mode}: max |chi - chi_ref| = {np.max(np.abs(a[4] - b)):.2e}")
+
+    recovered = emu(np.vstack([np.log10(np.linspace(7000, 30000, 32)), np.linspace(750, 900, 32)]).T)
+    t_init = time()
+    a = np.array([norm_spectra(np.stack((wref, flux), axis=-1))[0][:, 1] for flux in recovered])
+    t_ref = time() - t_init
+    t_init = time()
+    b = objective.normalise(recovered)
+    t_new = time() - t_init
+    print(f"normalise 32 models: {t_ref:.3f} s with norm_spectra, {t_new:.3f} s batched, max relative difference {np.max(np.abs(a/b - 1)):.2e}")
+
+    bounds = ((3000, 80000), (705, 949), (-300, 300))
+    t_init = time()
+    ref = op.minimize(lambda x: tmp_func_rv(*x, specn, l_crop, emu, wref, 0)[3], x0, bounds=bounds, method="Nelder-Mead")
+    t_ref = time() - t_init
+
+    t_init = time()
+    new = op.minimize(objective, x0, bounds=bounds, method="Nelder-Mead")
+    t_new = time() - t_init
+    print(f"tmp_func_rv: {ref.nfev} evaluations, {ref.nfev / t_ref:.0f} evaluations/s, {1 / t_ref:.2f} fits/s, x={ref.x}")
+    print(f"DALineObjective: {new.nfev} evaluations, {new.nfev / t_new:.0f} evaluations/s, {1 / t_new:.2f} fits/s, x={new.x}")
+
+    x = np.vstack([new.x] * 64) + rng.normal(0, [100, 5, 5], size=(64, 3))
+    t_init = time()
+    [objective(xi) for xi in x]
+    t_loop = time() - t_init
+    t_init = time()
+    objective.chi2_many(x)
+    t_batch = time() - t_init
+    print(f"64 parameter vectors: {64 / t_loop:.0f} evaluations/s one at a time, {64 / t_batch:.0f} evaluations/s batched")
+
+    ls_bounds = ([3000, 701, new.x[2] - 10], [80000, 949, new.x[2] + 10])
+    t_init = time()
+    ref = op.least_squares(lambda x: tmp_func_rv(*x, specn, l_crop, emu, wref, 2)[4], x0, bounds=ls_bounds, method="trf")
+    t_ref = time() - t_init
+    t_init = time()
+    new = op.least_squares(objective.residuals, x0, jac=lambda x: objective.jacobian(x, ls_bounds), bounds=ls_bounds, method="trf")
+    t_new = time() - t_init
+    print(f"least_squares: {1 / t_ref:.2f} fits/s with tmp_func_rv, {1 / t_new:.2f} fits/s with DALineObjective")
+    print(f"max |J - J_ref| / max |J_ref| = {np.max(np.abs(new.jac - ref.jac)) / np.max(np.abs(ref.jac)):.2e}")
@@ -0,0 +1,93 @@
+"""Diagnostic figures for Snow White."""
+
+import numpy as np
+import matplotlib.pyplot as plt
+from scipy import interpolate
+
+SPEED_OF_LIGHT = 299792.458 # km/s
+
+
+def plot_da_fit(full_spec, lines_s, lines_m, lines_s_o, lines_m_o, mod_n, mod_n_o, best_rv):
+    """
+    Plot the two solutions (red: best, green: other) of a DA-type white dwarf fit.
+
+    :param full_spec:
+        A (N_pixels, 3) array of the spectrum wavelength, flux, and flux error.
+
+    :param lines_s:
+        A list of (N_line_pixels, 3) arrays of the normalised spectrum in each line.
+
+    :param lines_m:
+        A list of the normalised best-fitting model in each line.
+
+    :param lines_s_o:
+        A list of (N_line_pixels, 3) arrays of the normalised spectrum in each line, for the other solution.
+
+    :param lines_m_o:
+        A list of the normalised model of the other solution in each line.
+
+    :param mod_n:
+        A (N_model_pixels, 2) array of the best-fitting model wavelength and flux.
+
+    :param mod_n_o:
+        A (N_model_pixels, 2) array of the other solution's model wavelength and flux.
+
+    :param best_rv:
+        The best-fitting radial velocity (in km/s).
+
+    :returns:
+        The figure.
+    """
+    c = SPEED_OF_LIGHT
+
+    # Adjust the flux of models to match the spectrum
+    check_f_spec=full_spec[:,1][(full_spec[:,0]>4500.) & (full_spec[:,0]<4550.)]
+    check_f_model=mod_n[:,1][(mod_n[:,0]>4500.) & (mod_n[:,0]<4550.)]
+    adjust=np.average(check_f_model)/np.average(check_f_spec)
+
+    fig=plt.figure(figsize=(8,5))
+    ax1 = plt.subplot2grid((1,4), (0, 3),rowspan=3)
+    step = 0
+    for i in range(0,len(lines_s)): # plots Halpha (i=0) to H6 (i=5)
+        min_p   = lines_s[i][:,0][lines_s[i][:,1]==np.min(lines_s[i][:,1])][0]
+        min_p_o = lines_s_o[i][:,0][lines_s_o[i][:,1]==np.min(lines_s_o[i][:,1])][0]
+        ax1.plot(lines_s[i][:,0]-min_p,lines_s[i][:,1]+step,color='k')
+        ax1.plot(lines_s[i][:,0]-min_p,lines_m[i]+step,color='r')
+        ax1.plot(lines_s_o[i][:,0]-min_p_o,lines_m_o[i]+step,color='g')
+        step+=0.5
+    xticks = ax1.xaxis.get_major_ticks()
+    ax1.set_xticklabels([])
+    ax1.set_yticklabels([])
+
+    ax2 = plt.subplot2grid((3,4), (0, 0),colspan=3,rowspan=2)
+    ax2.plot(full_spec[:,0],full_spec[:,1],color='k')
+    ax2.plot(mod_n[:,0]*(best_rv+c)/c,(mod_n[:,1]/adjust),color='r')
+
+    check_f_model_o=mod_n_o[:,1][(mod_n_o[:,0]>4500.) & (mod_n_o[:,0]<4550.)]
+    adjust_o=np.average(check_f_model_o)/np.average(check_f_spec)
+    ax2.plot(mod_n_o[:,0]*(best_rv+c)/c,mod_n_o[:,1]/adjust_o,color='g')
+
+    ax2.set_ylabel(r'F$_{\lambda}$ [erg cm$^{-2}$ s$^{-1} \AA^{-1}$]',fontsize=12)
+    ax2.set_xlabel(r'Wavelength $(\AA)$',fontsize=12)
+    ax2.set_xlim([3400,5600])
+    ax2.set_ylim(0, 2 * np.nanmax(mod_n_o[:,1]/adjust_o))
+    ax3 = plt.subplot2grid((3,4), (2, 0),colspan=3,rowspan=1,sharex=ax2)
+
+    flux_i = interpolate.interp1d(mod_n[:,0]*(best_rv+c)/c,mod_n[:,1]/adjust,kind='linear')(full_spec[:,0])
+    wave3=full_spec[:,0]
+    flux3=full_spec[:,1]/flux_i
+    binsize=1
+    xdata3=[]
+    ydata3=[]
+    for i in range(0,(np.size(wave3)-binsize),binsize):
+        xdata3.append(np.average(wave3[i:i+binsize]))
+        ydata3.append(np.average(flux3[i:i+binsize]))
+    plt.plot(xdata3,ydata3)
+
+    plt.hlines(1.02, 3400,5600,colors="r")
+    plt.hlines(1.01, 3400,5600,colors="0.5",ls="--")
+    plt.hlines(0.98, 3400,5600,colors="r")
+    plt.hlines(0.99, 3400,5600,colors="0.5",ls="--")
+    ax3.set_xlim([3400,5600])
+    ax3.set_ylim([0.95,1.04])
+    return fig
@@ -0,0 +1,122 @@
+import numpy as np
+from scipy.spatial import Delaunay
+
+
+class PhotosphereGridIndex:
+
+    def __init__(self, points):
+        """
+        A prebuilt index of a grid of photospheres, for finding the interpolation weights of many points
+        at once.
+
+        The sorted node values along each dimension are stored, along with a lookup from each cell of the
+        (possibly incomplete) regular grid to the index of the grid point. Points inside a complete cell are
+        interpolated multilinearly from the corners of that cell. Points inside a cell with missing corners
+        (or any point, if the grid is not a regular grid with holes) are interpolated linearly from the
+        vertices of the enclosing simplex of a Delaunay triangulation of the grid, which is only built if it
+        is needed.
+
+        :param points:
+            An `N x D` array of grid points.
+        """
+        self.points = np.atleast_2d(np.array(points, dtype=float))
+        N, D = self.points.shape
+        self.lower, self.upper = (np.min(self.points, axis=0), np.max(self.points, axis=0))
+
+        self.nodes = tuple(np.unique(column) for column in self.points.T)
+        if any(nodes.size < 2 for nodes in self.nodes):
+            raise ValueError("Every grid dimension needs at least two distinct values.")
+
+        # A lookup of the grid point index at each node of the regular grid, or -1 if there is no point.
+        self.cube = -np.ones([nodes.size for nodes in self.nodes], dtype=int)
+        self.cube[tuple(np.searchsorted(nodes, column) for nodes, column in zip(self.nodes, self.points.T))] = np.arange(N)
+        return None
+
+    @property
+    def is_regular(self):
+        """Whether there is a grid point at every node of the regular grid."""
+        return bool(np.all(self.cube >= 0))
+
+    @property
+    def triangulation(self):
+        """A Delaunay triangulation of the grid points, rescaled to the unit cube."""
+        try:
+            return self._triangulation
+        except AttributeError:
+            self._triangulation = Delaunay(self._rescale(self.points))
+            return self._triangulation
+
+    def _rescale(self, xi):
+        return (xi - self.lower) / (self.upper - self.lower)
+
+    def check_points(self, xi):
+        """
+        Check that points are within the grid boundaries.
+
+        :param xi:
+            An `M x D` array of points.
+        """
+        xi = np.atleast_2d(np.array(xi, dtype=float))
+        if xi.shape[1] != self.points.shape[1]:
+            raise ValueError(f"Expected points with {self.points.shape[1]} dimensions, not {xi.shape[1]}")
+
+        is_bad = ~np.all((self.lower <= xi) & (xi <= self.upper), axis=1)
+        if np.any(is_bad):
+            indices = np.where(is_bad)[0]
+            raise ValueError(
+                f"{indices.size} points are outside the grid boundaries (lower: {self.lower}, upper: {self.upper}). "
+                f"For example, index {indices[0]}: {xi[indices[0]]}"
+            )
+        return xi
+
+    def weights(self, xi):
+        """
+        Return the grid point indices and weights to linearly interpolate at many points.
+
+        :param xi:
+            An `M x D` array of points.
+
+        :returns:
+            A two-length tuple containing an `M x 2**D` array of grid point indices and an `M x 2**D` array of
+            weights. The weights of each point sum to one. Unused entries have zero weight.
+        """
+        xi = self.check_points(xi)
+        M, D = xi.shape
+
+        # Locate the cell of each point, and the fractional position within that cell.
+        cell, fraction = ([], [])
+        for nodes, x in zip(self.nodes, xi.T):
+            i = np.clip(np.searchsorted(nodes, x, side="right") - 1, 0, nodes.size - 2)
+            cell.append(i)
+            fraction.append((x - nodes[i]) / (nodes[i + 1] - nodes[i]))
+        cell, fraction = (np.array(cell).T, np.array(fraction).T)
+
+        corners = (np.arange(2**D)[:, None] >> np.arange(D)) & 1
+        indices = self.cube[tuple((cell[:, None, :] + corners).T)].T
+        weights = np.prod(np.where(corners, fraction[:, None, :], 1 - fraction[:, None, :]), axis=2)
+
+        # Corners that are missing (with non-zero weight) need the triangulation.
+        incomplete = np.any((indices < 0) & (weights > 0), axis=1)
+        if np.any(incomplete):
+            indices[incomplete], weights[incomplete] = (0, 0)
+            simplex_indices, simplex_weights = self._simplex_weights(xi[incomplete])
+            indices[incomplete, :D + 1] = simplex_indices
+            weights[incomplete, :D + 1] = simplex_weights
+
+        indices[weights == 0] = 0
+        return (indices, weights)
+
+    def _simplex_weights(self, xi):
+        triangulation = self.triangulation
+        xi = self._rescale(xi)
+        simplex = triangulation.find_simplex(xi)
+        if np.any(simplex < 0):
+            raise ValueError(f"{np.sum(simplex < 0)} points are not within the triangulation of the grid")
+
+        # Barycentric coordinates (see `scipy.spatial.Delaunay.transform`).
+        transform = triangulation.transform[simplex]
+        D = xi.shape[1]
+        b = np.einsum("mij,mj->mi", transform[:, :D], xi - transform[:, D])
+        weights = np.hstack([b, 1 - b.sum(axis=1, keepdims=True)])
+        weights[np.abs(weights) < 1e-12] = 0
+        return (triangulation.simplices[simplex], weights)
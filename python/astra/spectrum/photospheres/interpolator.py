@@ -2,12 +2,14 @@
 import logging as logger
 from astropy.utils.misc import dtype_bytes_or_chars
 import numpy as np
+import os
 import pickle
 from scipy import interpolate
 from tqdm import tqdm
 import warnings
 
 from .photosphere import Photosphere
+from .grid import PhotosphereGridIndex
 
 class NewPhotosphereInterpolator:
 
@@ -52,7 +54,8 @@ class NewPhotosphereInterpolator:
             self._offsets[column_name] = np.min([np.min(p[column_name]) for p in self.photospheres]) - 1                
             for photosphere in self.photospheres:
                 photosphere[f"__{column_name}"] = photosphere[column_name]
-                
+
+        self._splines = {}
         return None
 
     '''
@@ -144,6 +147,37 @@ class NewPhotosphereInterpolator:
         return self._grid_points
 
 
+    @property
+    def grid_index(self):
+        """
+        A prebuilt :class:`PhotosphereGridIndex` of the grid points.
+        """
+        try:
+            return self._grid_index
+        except AttributeError:
+            self._grid_index = PhotosphereGridIndex(self.grid_points)
+            return self._grid_index
+
+
+    def _spline(self, index, column_name):
+        """
+        Return the (cached) spline representation of a column with respect to the basis column, for the
+        photosphere at the given index.
+        """
+        try:
+            return self._splines[(index, column_name)]
+        except KeyError:
+            v = self.photospheres[index][column_name]
+            if column_name.startswith("__"):
+                v = np.log10(v - self._offsets[column_name[2:]])
+                assert np.all(np.isfinite(v))
+            tk = self._splines[(index, column_name)] = interpolate.splrep(
+                self.photospheres[index][self.basis_column_name],
+                v
+            )
+            return tk
+
+
     def neighbour_indices(self, x, exclusion_mask=None, allow_exact_match=None):
         """
         Return the neighbouring indices to the point `x`.
@@ -189,12 +223,16 @@ class NewPhotosphereInterpolator:
             allow_exact_match = exclusion_mask is None
 
         if exclusion_mask is None:
+            # Use the sorted node values of the prebuilt grid index.
             exclusion_mask = np.zeros(self.grid_points.shape[0], dtype=bool)
+            nodes = self.grid_index.nodes
+            limits = np.vstack([self.grid_index.lower, self.grid_index.upper])
+        else:
+            nodes = None
+            limits = np.vstack([f(self.grid_points[~exclusion_mask], axis=0) for f in (np.min, np.max)])
 
         grid_points = self.grid_points[~exclusion_mask]
 
-        limits = np.vstack([f(grid_points, axis=0) for f in (np.min, np.max)])
-
         N, D = grid_points.shape
         mask = np.ones(N, dtype=bool)
         exact = np.any(grid_points == x, axis=0)
@@ -205,7 +243,10 @@ class NewPhotosphereInterpolator:
                 continue
 
             # Find the nearest above and below.
-            unique_diffs = np.sort(np.unique(grid_slice - xj))
+            if nodes is None:
+                unique_diffs = np.sort(np.unique(grid_slice - xj))
+            else:
+                unique_diffs = nodes[j] - xj
             index = unique_diffs.searchsorted(0)
 
             lower, upper = limits.T[j]
@@ -313,7 +354,6 @@ class NewPhotosphereInterpolator:
             `PhotosphereInterpolator.grid_keywords`.
         """
 
-        print(f"in __call__")
         xi = self.check_point(point)
 
         # Check for an exact match.
@@ -321,7 +361,10 @@ class NewPhotosphereInterpolator:
             return self.photospheres[np.where(grid_index)[0][0]]
 
         common_basis, column_names, interpolated_quantities, meta = self.interpolate_columns(xi, exclusion_mask=exclusion_mask)
+        return self._photosphere(point, common_basis, column_names, interpolated_quantities, meta)
+
 
+    def _photosphere(self, point, common_basis, column_names, interpolated_quantities, meta):
         # create a photosphere from these data.
         photosphere = Photosphere(
             data=interpolated_quantities.T,
@@ -350,6 +393,179 @@ class NewPhotosphereInterpolator:
 
         return photosphere
 
+
+    def interpolate_many(self, points):
+        """
+        Interpolate photospheric structures at many stellar parameters at once.
+
+        The interpolation weights of all points are found with the prebuilt `grid_index`, and each
+        neighbouring photosphere is resampled onto the common basis of every point that uses it in one
+        pass. Points that are in a complete cell of the grid are interpolated multilinearly, so the
+        results can differ slightly from calling the interpolator for each point, which triangulates the
+        neighbouring points each time.
+
+        :param points:
+            An iterable of points, where each point is a dictionary with keys corresponding to the
+            `grid_keywords`, or an array with `D` values in the order of the `grid_keywords`.
+
+        :returns:
+            A list of :class:`Photosphere` objects, one per point. Points that are in the grid return the
+            photosphere at that grid point.
+        """
+        xi = np.array([self._point_to_array(point) for point in points], dtype=float)
+        indices, weights = self.grid_index.weights(xi)
+        common_basis, column_names, interpolated_quantities, meta = self._interpolate_columns_many(indices, weights)
+
+        photospheres = []
+        for i, (x, basis, quantities, m) in enumerate(zip(xi, common_basis, interpolated_quantities, meta)):
+            if np.any(is_exact := (weights[i] == 1)):
+                photospheres.append(self.photospheres[indices[i][is_exact][0]])
+                continue
+
+            # Models with fewer depth points leave missing values at the bottom of the photosphere.
+            keep = np.isfinite(basis)
+            photospheres.append(
+                self._photosphere(dict(zip(self.grid_keywords, x)), basis[keep], column_names, quantities[:, keep], m)
+            )
+        return photospheres
+
+
+    def interpolate_columns_many(self, xi, column_names=None):
+        """
+        Interpolate columns of photospheric quantities at many points at once.
+
+        :param xi:
+            An `M x D` array of points, in the order of the `grid_keywords`.
+
+        :param column_names: [optional]
+            The column names to interpolate. If `None` is given then this will default to all columns.
+
+        :returns:
+            A four-length tuple containing the `M x L` common basis, the column names, the `M x C x L`
+            interpolated quantities, and a list of the meta of the nearest neighbour of each point.
+        """
+        return self._interpolate_columns_many(*self.grid_index.weights(xi), column_names=column_names)
+
+
+    def _interpolate_columns_many(self, indices, weights, column_names=None):
+
+        column_names = column_names or list(self.photospheres[0].dtype.names)
+
+        # The basis of every photosphere, padded with NaNs if some have fewer depth points.
+        basis = [self.photospheres[n][self.basis_column_name] for n in range(len(self.photospheres))]
+        L = max(map(len, basis))
+        if all(len(b) == L for b in basis) and np.all(np.array(basis) == basis[0]):
+            common_basis = np.tile(basis[0], (indices.shape[0], 1))
+        else:
+            padded_basis = np.nan * np.ones((len(basis), L))
+            for n, b in enumerate(basis):
+                padded_basis[n, :len(b)] = b
+
+            used = (weights > 0)[:, :, None]
+            common_basis = np.sum(np.where(used, weights[:, :, None] * padded_basis[indices], 0), axis=1)
+            common_basis[np.any(used & np.isnan(padded_basis[indices]), axis=1)] = np.nan
+
+        # Resample each neighbour onto the common basis of every point that uses it.
+        M, C = (indices.shape[0], len(column_names))
+        interpolated_quantities = np.zeros((M, C, L))
+        for n in np.unique(indices[weights > 0]):
+            m, k = np.where((indices == n) & (weights > 0))
+            x = common_basis[m]
+            for i, column_name in enumerate(column_names):
+                z = interpolate.splev(x.flatten(), self._spline(n, column_name)).reshape(x.shape)
+                interpolated_quantities[m, i] += weights[m, k, None] * z
+
+        for i, column_name in enumerate(column_names):
+            if column_name.startswith("__"):
+                cn = column_name[2:]
+                interpolated_quantities[:, i] = 10**interpolated_quantities[:, i] + self._offsets[cn]
+
+        nearest = indices[np.arange(M), np.argmax(weights, axis=1)]
+        meta = [self.photospheres[n].meta.copy() for n in nearest]
+        return (common_basis, column_names, interpolated_quantities, meta)
+
+
+    def write(self, path):
+        """
+        Write this photosphere interpolator to disk. This will store all models, their metadata, and the
+        prebuilt grid index (including the triangulation, if the grid has holes).
+
+        :param path:
+            The path to store the interpolator.
+        """
+        column_names = [n for n in self.photospheres[0].dtype.names if not n.startswith("__")]
+
+        N = len(self.photospheres)
+        C = len(column_names)
+        lengths = [len(p) for p in self.photospheres]
+
+        structure = np.nan * np.ones((N, C, max(lengths)))
+        for i, photosphere in enumerate(self.photospheres):
+            for j, column_name in enumerate(column_names):
+                # In rare circumstances, a model can have one fewer depth points than it's neighbours.
+                structure[i, j, :lengths[i]] = photosphere[column_name]
+
+        if not self.grid_index.is_regular:
+            self.grid_index.triangulation
+
+        contents = {
+            "points": self.grid_points,
+            "grid_keywords": self.grid_keywords,
+            "column_names": column_names,
+            "dtypes": [self.photospheres[0][column_name].dtype for column_name in column_names],
+            "lengths": lengths,
+            "structure": structure,
+            "meta": [p.meta for p in self.photospheres],
+            "grid_index": self.grid_index,
+            "basis_column_name": self.basis_column_name,
+            "decimals": self.decimals,
+            "method": self.method,
+            "rescale": self.rescale,
+            "interpolate_log_quantities": self.interpolate_log_quantities,
+        }
+
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as fp:
+            pickle.dump(contents, fp)
+        os.replace(temp_path, path)
+        return None
+
+
+    @classmethod
+    def read(cls, path):
+        """
+        Read a photosphere interpolator written by `NewPhotosphereInterpolator.write`.
+
+        :param path:
+            The path where the interpolator is stored.
+        """
+        with open(path, "rb") as fp:
+            contents = pickle.load(fp)
+
+        photospheres = []
+        for structure, length, meta in zip(contents["structure"], contents["lengths"], contents["meta"]):
+            photospheres.append(
+                Photosphere(
+                    [column[:length].astype(dtype) for column, dtype in zip(structure, contents["dtypes"])],
+                    names=contents["column_names"],
+                    meta=meta
+                )
+            )
+
+        interpolator = cls(
+            photospheres,
+            grid_keywords=contents["grid_keywords"],
+            decimals=contents["decimals"],
+            method=contents["method"],
+            rescale=contents["rescale"],
+            basis_column_name=contents["basis_column_name"],
+            interpolate_log_quantities=contents["interpolate_log_quantities"]
+        )
+        interpolator._grid_points = contents["points"]
+        interpolator._grid_index = contents["grid_index"]
+        return interpolator
+
+
     def _point_to_array(self, point):
         N, D = self.grid_points.shape
         if isinstance(point, dict):
@@ -456,14 +672,7 @@ class NewPhotosphereInterpolator:
         resampled_neighbour_quantities = np.empty((N, C, D))
         for i, column_name in enumerate(column_names):
             for j, ni in enumerate(neighbour_indices):
-                v = self.photospheres[ni][column_name]
-                if column_name.startswith("__"):
-                    v = np.log10(v - self._offsets[column_name[2:]])
-                    assert np.all(np.isfinite(v))
-                tk = interpolate.splrep(
-                    self.photospheres[ni][self.basis_column_name],
-                    v,
-                )
+                tk = self._spline(ni, column_name)
                 resampled_neighbour_quantities[j, i] = interpolate.splev(common_basis.flatten(), tk)
     
         interpolated_quantities = np.zeros((C, D))
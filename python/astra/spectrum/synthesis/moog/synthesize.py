@@ -7,7 +7,7 @@ from tempfile import mkdtemp
 from time import time
 from astropy import units as u
 
-from grok.transitions import Transitions
+from grok.transitions import Transitions, TransitionTable
 from grok.synthesis.moog.io import (
     parse_summary_synth_output,
     parse_standard_synth_output,
@@ -75,6 +75,12 @@ def moog_synthesize(
                 key=lambda t: t.lambda_air,
             )
         )
+    elif isinstance(transitions, TransitionTable):
+        use_transitions = (
+            transitions
+            .window(lambda_min - opacity_contribution, lambda_max + opacity_contribution, air=True)
+            .sort("lambda_air")
+        )
     else:
         # You're living dangerously!
         use_transitions = transitions
@@ -170,17 +176,28 @@ def moog_synthesize(
                 summary_out=f"synth.sum.out.{chunk}",
             )
 
-            chunk_transitions = Transitions(
-                sorted(
-                    filter(
-                        lambda t: (chunk_lambda_max + opacity_contribution)
-                        >= t.lambda_air.value
-                        >= (chunk_lambda_min - opacity_contribution),
-                        use_transitions,
-                    ),
-                    key=lambda t: t.lambda_air,
+            if isinstance(use_transitions, TransitionTable):
+                chunk_transitions = (
+                    use_transitions
+                    .window(
+                        chunk_lambda_min - opacity_contribution,
+                        chunk_lambda_max + opacity_contribution,
+                        air=True
+                    )
+                    .sort("lambda_air")
+                )
+            else:
+                chunk_transitions = Transitions(
+                    sorted(
+                        filter(
+                            lambda t: (chunk_lambda_max + opacity_contribution)
+                            >= t.lambda_air.value
+                            >= (chunk_lambda_min - opacity_contribution),
+                            use_transitions,
+                        ),
+                        key=lambda t: t.lambda_air,
+                    )
                 )
-            )
             assert len(chunk_transitions) > 0, "No transitions in this chunk"
 
             copy_or_write(
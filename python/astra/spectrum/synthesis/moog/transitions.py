@@ -1,9 +1,10 @@
 import numpy as np
+from math import isfinite
 from astropy.io import registry
 from collections import OrderedDict
 from astropy import units as u
 
-from grok.transitions import Transition, Transitions
+from grok.transitions import Transition, Transitions, TransitionTable
 from grok.utils import periodic_table
 
 
@@ -155,6 +156,39 @@ _moog_amu = [
 ]
 
 
+def _moog_species_code(species):
+    """
+    Return the (right-aligned) MOOG representation of a species.
+    """
+
+    # Sort the molecules the right way.
+    code = "".join([f"{Z:0>2.0f}" for Z in sorted(species.Zs) if Z > 0])
+    if len(code) == 2:
+        code = code.lstrip("0")
+    code += f".{species.charge:.0f}"
+
+    if sum(species.isotopes) > 0:
+
+        for Z, isotope in zip(species.Zs, species.isotopes):
+            if Z == 0:
+                continue
+            if isotope == 0:
+                # If we don't have isotopes for one thing, MOOG will die.
+                # So here we give it the default mass from MOOG.
+                isotope = int(np.round(_moog_amu[Z - 1]))
+            code += f"{isotope:0>2.0f}"
+
+            if isotope > 100:
+                raise ValueError(
+                    f"From the MOOG documentation: MOOG cannot handle a molecular isotope "
+                    f"in which one of the atomic constitutents has a mass greater than two digits! "
+                    f"The species {species} breaks this fundamental limit"
+                )
+    # left-pad and strip
+    code = code.lstrip("0")
+    return f"{code: >10}"
+
+
 def write_moog(transitions, path, include_header=True):
     """
     Write a list of atomic and molecular transitions to disk in a format that
@@ -181,38 +215,10 @@ def write_moog(transitions, path, include_header=True):
                 else space
             )
 
-            # Sort the molecules the right way.
-
-            species = "".join([f"{Z:0>2.0f}" for Z in sorted(line.species.Zs) if Z > 0])
-            if len(species) == 2:
-                species = species.lstrip("0")
-            species += f".{line.species.charge:.0f}"
-
-            if sum(line.species.isotopes) > 0:
-
-                for Z, isotope in zip(line.species.Zs, line.species.isotopes):
-                    if Z == 0:
-                        continue
-                    if isotope == 0:
-                        # If we don't have isotopes for one thing, MOOG will die.
-                        # So here we give it the default mass from MOOG.
-                        isotope = int(np.round(_moog_amu[Z - 1]))
-                    species += f"{isotope:0>2.0f}"
-
-                    if isotope > 100:
-                        raise ValueError(
-                            f"From the MOOG documentation: MOOG cannot handle a molecular isotope "
-                            f"in which one of the atomic constitutents has a mass greater than two digits! "
-                            f"The line {line} breaks this fundamental limit"
-                        )
-            # left-pad and strip
-            species = species.lstrip("0")
-            species = f"{species: >10}"
-
             f.write(
                 fmt.format(
                     line.lambda_air.to("Angstrom").value,
-                    species,
+                    _moog_species_code(line.species),
                     line.E_lower.to("eV").value,
                     line.log_gf,
                     C6,
@@ -226,5 +232,45 @@ def write_moog(transitions, path, include_header=True):
     return None
 
 
+def write_moog_table(table, path, include_header=True):
+    """
+    Write a :class:`TransitionTable` to disk in a format that is friendly to MOOG.
+
+    :param table:
+        The atomic and molecular transitions to write.
+
+    :param path:
+        The path to store the transitions.
+    """
+
+    table = table.sort("lambda_air")
+    species, inverse = table.unique_species()
+    codes = np.array([_moog_species_code(s) for s in species])[inverse]
+
+    space = " " * 10
+    C6, D0 = (
+        ["%10.3f" % v if isfinite(v) else space for v in table[name].tolist()]
+        for name in ("vdW", "E_dissociation")
+    )
+
+    rows = zip(
+        table["lambda_air"].tolist(),
+        codes.tolist(),
+        table["E_lower"].tolist(),
+        table["log_gf"].tolist(),
+        C6,
+        D0,
+        table.strings("comment")
+    )
+    fmt = "%10.3f%10s%10.3f%10.3f%s%s" + space + "%s\n"
+    with open(path, "w") as f:
+        if include_header:
+            f.write("\n")
+        f.writelines([fmt % row for row in rows])
+
+    return None
+
+
 registry.register_reader("moog", Transitions, read_moog, force=True)
 registry.register_writer("moog", Transitions, write_moog, force=True)
+registry.register_writer("moog", TransitionTable, write_moog_table, force=True)
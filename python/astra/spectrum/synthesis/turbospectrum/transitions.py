@@ -3,7 +3,7 @@ import numpy as np
 from astropy.io import registry
 from astropy import units as u
 
-from grok.transitions import (Species, Transition, Transitions)
+from grok.transitions import (Species, Transition, Transitions, TransitionTable)
 from grok.utils import safe_open
 
 _header_pattern = "'\s*(?P<turbospectrum_species_as_float>[\d\.]+)\s*'\s*(?P<ionisation>\d+)\s+(?P<num>\d+)"
@@ -13,6 +13,8 @@ _line_pattern_short = "\s*(?P<lambda_air>[\d\.]+)\s*(?P<E_lower>[\-\d\.]+)\s*(?P
 # Amazingly, there does not seem to be a python string formatting that does the following:
 _format_log_gf = lambda log_gf: "{0:< #6.3f}".format(log_gf)[:6]
 # You might think that "{0:< #6.4g}" would work, but try it for -0.002 :head_exploding:
+# The same as _line_template, but the log(gf) is formatted as _format_log_gf with "%.6s" % ("%- #6.3f" % log_gf).
+_table_line_template = "%10.3f %6.3f %.6s %8.3f %6.1f %9.2E '%s' '%s' %5.1f %6.1f '%s'"
 _line_template = "{line.lambda_air.value:10.3f} {line.E_lower.value:6.3f} {formatted_log_gf:s} {line.vdW_compact:8.3f} {line.g_upper:6.1f} {line.gamma_rad.value:9.2E} '{line.lower_orbital_type:s}' '{line.upper_orbital_type:s}' {line.equivalent_width:5.1f} {line.equivalent_width_error:6.1f} '{line.comment}'"
 
 
@@ -70,6 +72,27 @@ def should_keep(transition, consider_reasons=(0, ), return_reason=False):
     return reason if return_reason else reason is None
 
 
+def should_keep_mask(table, consider_reasons=(0, )):
+    """
+    Returns a boolean array whether each transition in a :class:`TransitionTable` should be excluded
+    (False) or included (True) from Turbospectrum, as per `should_keep`.
+    """
+    charge, Z = (table["charge"], table["Zs"][:, -1])
+    is_atom = ~table.is_molecule
+    ip1, ip2 = (np.array(_ionization_potential_p1)[Z - 1], np.array(_ionization_potential_p2)[Z - 1])
+    reasons = (
+        ~np.isin(charge, (0, 1)),
+        table["E_lower"] >= 15,
+        is_atom & np.isin(Z, (1, 2)),
+        is_atom & (charge == 1) & (table["E_upper"] > ip1),
+        is_atom & (charge == 2) & (table["E_upper"] > ip2),
+    )
+    keep = np.ones(len(table), dtype=bool)
+    for reason in consider_reasons:
+        keep &= ~reasons[reason]
+    return keep
+
+
 def update_missing_transition_data(transition):
     """
     Validate (and update) transition data. This is done by the script that converts VALD line lists
@@ -90,6 +113,30 @@ def update_missing_transition_data(transition):
     return t
 
 
+def update_missing_transition_data_table(table):
+    """
+    Validate (and update) transition data in a :class:`TransitionTable`, as per
+    `update_missing_transition_data`.
+
+    This returns a copy of the table, with the updated data.
+    """
+    data = table.data.copy()
+
+    missing_vdW = np.isclose(data["vdW"], 0, atol=1e-10)
+    if np.any(missing_vdW):
+        species, inverse = table.unique_species()
+        approximate_vdW = np.array([_lookup_approximate_vdW(s) for s in species])[inverse]
+        data["vdW"][missing_vdW] = approximate_vdW[missing_vdW]
+
+    with np.errstate(over="ignore", invalid="ignore"):
+        data["gamma_rad"] = np.where(data["gamma_rad"] > 3, 10**data["gamma_rad"], 1e5)
+    for name, default in (("equivalent_width", 0), ("equivalent_width_error", 1.0)):
+        data[name][~np.isfinite(data[name]) | (data[name] == 0)] = default
+    for name in ("lower_orbital_type", "upper_orbital_type"):
+        data[name][data[name] == b""] = b"X"
+    return TransitionTable(data, meta=table.meta)
+
+
 def parse_gamma_rad(transition):
     #https://github.com/bertrandplez/Turbospectrum2019/blob/master/Utilities/vald3line-BPz-freeformat.f#L420-428
     if transition.gamma_rad.value > 3:
@@ -98,6 +145,10 @@ def parse_gamma_rad(transition):
 
 
 def lookup_approximate_vdW(transition):
+    return _lookup_approximate_vdW(transition.species)
+
+
+def _lookup_approximate_vdW(species):
 
     default_value = 2.5 # Mackle et al. 1975 A&A 38, 239
 
@@ -112,16 +163,16 @@ def lookup_approximate_vdW(transition):
         "Sr": 1.8, # from fit of Sr II 4077.724 in the HM model to the fts intensity spectrum
         "Ba": 3.0 # Holweger & Muller 1974 Solar Physics 39, 19
     }
-    is_molecule = (len([Z for Z in transition.species.Zs if Z > 0]) > 1)
+    is_molecule = (len([Z for Z in species.Zs if Z > 0]) > 1)
     if not is_molecule:
-        if transition.species.charge == 0:
+        if species.charge == 0:
             try:
-                return neutral_damping[transition.species.atoms[0]]
+                return neutral_damping[species.atoms[0]]
             except KeyError:
                 return default_value
-        elif transition.species.charge == 1:
+        elif species.charge == 1:
             try:
-                return ionized_damping[transition.species.atoms[0]]
+                return ionized_damping[species.atoms[0]]
             except KeyError:
                 return default_value
         else:
@@ -284,6 +335,93 @@ def write_transitions(
 
 
 
+def write_transitions_table(
+        table,
+        path,
+        skip_irrelevant_transitions=False,
+        update_missing_data=False,
+    ):
+    """
+    Write a :class:`TransitionTable` to disk in a format that Turbospectrum accepts.
+
+    :param table:
+        The atomic and molecular transitions.
+
+    :param path:
+        The path to store the transitions on disk.
+
+    :param skip_irrelevant_transitions: [optional]
+        Skip over transitions that Bertrand Plez considers irrelevant, based on Plez's script for
+        translating VALD-formatted line lists to Turbospectrum format (default: False).
+
+    :param update_missing_data: [optional]
+        Update the transitions with missing data values from a lookup table using the
+        `update_missing_transition_data_table` function (default: False).
+    """
+
+    if skip_irrelevant_transitions:
+        table = table[should_keep_mask(table)]
+
+    if update_missing_data:
+        table = update_missing_transition_data_table(table)
+    else:
+        missing = ~np.isfinite(
+            np.vstack([table[name] for name in ("j_upper", "gamma_rad", "equivalent_width", "equivalent_width_error")])
+        )
+        if np.any(missing) or np.any(table["lower_orbital_type"] == b"") or np.any(table["upper_orbital_type"] == b""):
+            raise TypeError("Missing transition data. Update it or set `update_missing_data` to True.")
+
+    # Sort the right way: by species, then by wavelength within each species.
+    species, inverse = table.unique_species()
+    group_keys = np.array([float(s.compact) for s in species])
+    order = np.lexsort((table["lambda_vacuum"], group_keys[inverse]))
+    table, inverse = (table[order], inverse[order])
+    keys = group_keys[inverse]
+    starts = np.hstack([0, 1 + np.flatnonzero(np.diff(keys)), len(table)])
+
+    rows = zip(
+        table["lambda_air"].tolist(),
+        table["E_lower"].tolist(),
+        ["%- #6.3f" % log_gf for log_gf in table["log_gf"].tolist()],
+        table.vdW_compact.tolist(),
+        (2 * table["j_upper"] + 1).tolist(),
+        table["gamma_rad"].tolist(),
+        table.strings("lower_orbital_type"),
+        table.strings("upper_orbital_type"),
+        table["equivalent_width"].tolist(),
+        table["equivalent_width_error"].tolist(),
+        table.strings("comment"),
+    )
+    lines = [_table_line_template % row for row in rows]
+
+    contents = []
+    for si, ei in zip(starts[:-1], starts[1:]):
+        # Add header information.
+        group_species = species[inverse[si]]
+
+        # Sort so we represent TiO as 822, etc.
+        indices = [index for index in np.argsort(group_species.Zs) if group_species.Zs[index] > 0]
+        formula = "".join([f"{group_species.Zs[index]:0>2.0f}" for index in indices])
+        isotope = "".join([f"{group_species.isotopes[index]:0>3.0f}" for index in indices])
+
+        # Left-pad and strip formula.
+        formula = formula.lstrip("0")
+        formula = f"{formula: >4}"
+
+        compact = f"{formula}.{isotope}"
+
+        contents.extend([
+            f"'{compact: <20}' {group_species.charge + 1: >4.0f} {ei - si: >9.0f}",
+            f"'{str(group_species):7s}'"
+        ])
+        contents.extend(lines[si:ei])
+
+    with open(path, "w") as fp:
+        fp.write("\n".join(contents))
+
+    return None
+
+
 def identify_turbospectrum(origin, *args, **kwargs):
     """
     Identify a line list being in Turbospectrum format.
@@ -306,3 +444,4 @@ def identify_turbospectrum(origin, *args, **kwargs):
 registry.register_reader("turbospectrum", Transitions, read_transitions, force=True)
 registry.register_writer("turbospectrum", Transitions, write_transitions, force=True)
 registry.register_identifier("turbospectrum", Transitions, identify_turbospectrum, force=True)
+registry.register_writer("turbospectrum", TransitionTable, write_transitions_table, force=True)
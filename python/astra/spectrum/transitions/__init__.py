@@ -1,4 +1,5 @@
 from .transition import (Transition, Transitions)
 from .species import Species
 from .formula import Formula
-from . import (vald, ges)
\ No newline at end of file
+from .table import TransitionTable
+from . import (vald, ges)
@@ -4,7 +4,8 @@ from astropy.io import registry
 from astropy import units as u
 from typing import OrderedDict
 
-from grok.transitions import (Species, Transition, Transitions)
+from grok.transitions import (Species, Transition, Transitions, TransitionTable)
+from grok.transitions.table import get_species_columns
 from grok.transitions.vald import parse_levels
 from grok.utils import safe_open
 
@@ -72,4 +73,60 @@ def read_ges(path):
 
     return Transitions(transitions)
 
-registry.register_reader("cds.ges", Transitions, read_ges)
\ No newline at end of file
+
+def read_ges_table(path):
+    """
+    Read transitions from the Gaia-ESO Survey that are stored on CDS into a :class:`TransitionTable`.
+
+    https://cdsarc.u-strasbg.fr/viz-bin/cat/J/A+A/645/A106#/browse
+    """
+
+    path, content, content_stream = safe_open(path)
+    lines = content.split("\n")
+
+    header_rows = 10
+    values = np.array([line.split("|") for line in lines[header_rows:] if "|" in line])
+
+    element, ion, isotope, lambda_air, _ref_lambda_air, \
+    log_gf, _e_log_gf, *_ref_log_gf, _gfflag, _synflag, lower_level_desc, \
+    j_lower, E_lower, _ref_E_lower, upper_level_desc, j_upper, E_upper, _ref_E_upper, \
+    rad_damp, _ref_rad_damp, stark_damp, _ref_stark_damp, vdw_damp, \
+    _ref_vdw_damp = values.T
+
+    representations = np.char.add(np.char.add(np.char.strip(element), " "), (ion.astype(int) - 1).astype(str))
+    columns = get_species_columns(representations)
+    # assumes atoms only!
+    assert np.all(np.sum(columns["Zs"] > 0, axis=1) == 1)
+    columns["isotopes"][:, 2] = isotope.astype(int)
+
+    species_names = {}
+    for representation in np.unique(representations):
+        species_names[representation] = str(Species(representation))
+
+    orbital_types = {}
+    for pair in set(zip(lower_level_desc, upper_level_desc)):
+        orbital_types[pair] = parse_levels(*pair)
+
+    columns.update(
+        lambda_air=lambda_air.astype(float),
+        log_gf=log_gf.astype(float),
+        j_lower=j_lower.astype(float),
+        E_lower=E_lower.astype(float),
+        j_upper=j_upper.astype(float),
+        E_upper=E_upper.astype(float),
+        gamma_rad=rad_damp.astype(float),
+        gamma_stark=stark_damp.astype(float),
+        vdW=vdw_damp.astype(float),
+        comment=[
+            f"{species_names[r]} {lower} {upper}"
+            for r, lower, upper in zip(representations, lower_level_desc, upper_level_desc)
+        ]
+    )
+    columns["lower_orbital_type"], columns["upper_orbital_type"] = np.array(
+        [orbital_types[pair] for pair in zip(lower_level_desc, upper_level_desc)]
+    ).T
+    return TransitionTable.from_columns(**columns)
+
+
+registry.register_reader("cds.ges", Transitions, read_ges)
+registry.register_reader("cds.ges", TransitionTable, read_ges_table)
\ No newline at end of file
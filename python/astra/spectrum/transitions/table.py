@@ -0,0 +1,425 @@
+import os
+import numpy as np
+from astropy import units as u
+from astropy.io import registry
+
+from grok.transitions.species import Species
+from grok.transitions.formula import Formula
+from grok.transitions.transition import (Transition, Transitions)
+from grok.transitions.connect import TransitionsRead, TransitionsWrite
+from grok.transitions.utils import (air_to_vacuum, vacuum_to_air)
+
+# Columns are stored without units: wavelengths are in Angstroms, energies are in eV, and damping constants
+# (except van der Waals) are in inverse seconds. Missing values are NaN.
+_units = {
+    "lambda_vacuum": u.Angstrom,
+    "lambda_air": u.Angstrom,
+    "E_lower": u.eV,
+    "E_upper": u.eV,
+    "E_dissociation": u.eV,
+    "gamma_rad": (1/u.s),
+    "gamma_stark": (1/u.s),
+}
+
+float_columns = (
+    "lambda_vacuum",
+    "lambda_air",
+    "log_gf",
+    "E_lower",
+    "E_upper",
+    "j_lower",
+    "j_upper",
+    "gamma_rad",
+    "gamma_stark",
+    "vdW",
+    "lande_factor_lower",
+    "lande_factor_upper",
+    "lande_factor_mean",
+    "lande_factor",
+    "lande_depth",
+    "equivalent_width",
+    "equivalent_width_error",
+    "E_dissociation",
+)
+# Strings are stored as UTF-8 bytes, as wide as the longest value.
+string_columns = (
+    "lower_orbital_type",
+    "upper_orbital_type",
+    "reference",
+    "comment",
+)
+# Species are stored as the (up to three) atomic numbers, isotopes, and the charge.
+species_columns = ("Zs", "isotopes", "charge")
+
+
+def as_species(Zs, isotopes, charge):
+    """
+    Create a :class:`Species` from atomic numbers, isotopes, and charge, without parsing a representation.
+    """
+    species = Species.__new__(Species)
+    species.formula = Formula(list(map(int, Zs)))
+    species.isotopes = tuple(map(int, isotopes))
+    species.charge = int(charge)
+    return species
+
+
+def get_species_columns(representations, parse=Species):
+    """
+    Parse species representations into the `Zs`, `isotopes`, and `charge` columns. Each unique
+    representation is only parsed once.
+
+    :param representations:
+        An iterable of species representations (e.g., 'Fe 1').
+
+    :param parse: [optional]
+        A callable that returns a :class:`Species` for a representation.
+    """
+    unique, inverse = np.unique(np.asarray(representations, dtype=str), return_inverse=True)
+    species = list(map(parse, unique))
+    inverse = inverse.flatten()
+    return dict(
+        Zs=np.array([s.formula.Zs for s in species], dtype=np.int16).reshape((-1, 3))[inverse],
+        isotopes=np.array([s.isotopes for s in species], dtype=np.int16).reshape((-1, 3))[inverse],
+        charge=np.array([s.charge for s in species], dtype=np.int8)[inverse],
+    )
+
+
+class TransitionTable(object):
+
+    """
+    A columnar representation of atomic and molecular transitions, backed by a numpy structured array.
+    """
+
+    read = registry.UnifiedReadWriteMethod(TransitionsRead)
+    write = registry.UnifiedReadWriteMethod(TransitionsWrite)
+
+    def __init__(self, data, meta=None):
+        """
+        :param data:
+            A numpy structured array with the `float_columns`, `string_columns`, and `species_columns`.
+
+        :param meta: [optional]
+            A dictionary of metadata.
+        """
+        self.data = data
+        self.meta = meta or {}
+        return None
+
+    @classmethod
+    def from_columns(cls, meta=None, **columns):
+        """
+        Create a table of transitions from column arrays. Missing float columns are filled with NaN, and
+        missing string columns are empty. At least one of `lambda_vacuum` or `lambda_air` must be given,
+        and the other is calculated where it is missing.
+
+        :param meta: [optional]
+            A dictionary of metadata.
+
+        :param **columns:
+            The column arrays, in the units described in this module. The species must be given as `Zs`
+            (an `N x 3` array), `charge`, and optionally `isotopes` (an `N x 3` array). See
+            `get_species_columns`.
+        """
+        if "lambda_vacuum" not in columns and "lambda_air" not in columns:
+            raise ValueError("Wavelength (lambda) must be given as lambda_vacuum or lambda_air.")
+        unknown = set(columns).difference(float_columns + string_columns + species_columns)
+        if unknown:
+            raise ValueError(f"Unknown columns: {', '.join(unknown)}")
+
+        N = len(columns["Zs"])
+        strings = {}
+        for name in string_columns:
+            values = columns.get(name, None)
+            if values is None:
+                strings[name] = np.zeros(N, dtype="S1")
+            else:
+                values = np.asarray(values, dtype=str)
+                try:
+                    strings[name] = values.astype(bytes)
+                except UnicodeEncodeError:
+                    strings[name] = np.char.encode(values, "utf-8")
+
+        dtype = [(name, float) for name in float_columns]
+        dtype += [(name, strings[name].dtype) for name in string_columns]
+        dtype += [("Zs", np.int16, (3, )), ("isotopes", np.int16, (3, )), ("charge", np.int8)]
+
+        data = np.zeros(N, dtype=dtype)
+        for name in float_columns:
+            data[name] = columns.get(name, np.nan)
+        for name in string_columns:
+            data[name] = strings[name]
+        for name in species_columns:
+            data[name] = columns.get(name, 0)
+
+        # Fill in wavelengths where they are missing.
+        air, vacuum = (np.isfinite(data["lambda_air"]), np.isfinite(data["lambda_vacuum"]))
+        if np.any(air & ~vacuum):
+            data["lambda_vacuum"][air & ~vacuum] = air_to_vacuum(data["lambda_air"][air & ~vacuum] * u.Angstrom).value
+        if np.any(vacuum & ~air):
+            data["lambda_air"][vacuum & ~air] = vacuum_to_air(data["lambda_vacuum"][vacuum & ~air] * u.Angstrom).value
+        return cls(data, meta=meta)
+
+    @classmethod
+    def from_transitions(cls, transitions):
+        """
+        Create a table from an iterable of :class:`Transition` objects.
+
+        :param transitions:
+            The atomic and molecular transitions.
+        """
+        transitions = list(transitions)
+
+        def value(t, name):
+            v = getattr(t, name, None)
+            if v is None:
+                return np.nan
+            return v.to(_units[name]).value if hasattr(v, "unit") else v
+
+        columns = {name: np.array([value(t, name) for t in transitions], dtype=float) for name in float_columns}
+        for name in string_columns:
+            columns[name] = ["" if getattr(t, name, None) is None else str(getattr(t, name)) for t in transitions]
+        columns["Zs"] = np.array([t.species.Zs for t in transitions], dtype=np.int16).reshape((-1, 3))
+        columns["isotopes"] = np.array([t.species.isotopes for t in transitions], dtype=np.int16).reshape((-1, 3))
+        columns["charge"] = np.array([t.species.charge for t in transitions], dtype=np.int8)
+        return cls.from_columns(**columns)
+
+    def to_transitions(self):
+        """
+        Return a tuple of :class:`Transition` objects.
+        """
+        species, inverse = self.unique_species()
+        strings = {name: self.strings(name) for name in string_columns}
+        floats = {name: self.data[name].tolist() for name in float_columns}
+
+        transitions = []
+        for i, index in enumerate(inverse):
+            kwds = dict(species=species[index])
+            for name in float_columns:
+                v = floats[name][i]
+                if not np.isfinite(v) and name not in ("gamma_stark", "vdW"):
+                    v = None
+                elif name in _units:
+                    v = v * _units[name]
+                kwds[name] = v
+            for name in string_columns:
+                kwds[name] = strings[name][i] or None
+            transitions.append(Transition(**kwds))
+        return Transitions(transitions)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.data[key]
+        data = self.data[key]
+        if data.ndim == 0:
+            return data
+        return self.__class__(data, meta=self.meta)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} of {len(self)} transitions>"
+
+    @property
+    def colnames(self):
+        return self.data.dtype.names
+
+    def strings(self, name):
+        """
+        Return a string column as a list of (decoded) strings.
+
+        :param name:
+            The column name.
+        """
+        return [value.decode("utf-8") for value in self.data[name].tolist()]
+
+    def unique_species(self):
+        """
+        Return the unique species in this table.
+
+        :returns:
+            A two-length tuple containing a list of unique :class:`Species`, and an array of indices into
+            that list for each transition.
+        """
+        # Pack the species into one integer (7 bits per atomic number, 9 bits per isotope, 8 bits for charge).
+        Zs, isotopes, charge = (self.data[name].astype(np.int64) for name in species_columns)
+        keys = (charge + 128)
+        for j in range(3):
+            keys = (keys << 16) | (Zs[:, j] << 9) | isotopes[:, j]
+        _, index, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        unique = self.data[index]
+        return (
+            [as_species(*(row[name] for name in species_columns)) for row in unique],
+            inverse.flatten()
+        )
+
+    @property
+    def is_molecule(self):
+        """ A boolean array to indicate whether each species is a molecule or not. """
+        return np.sum(self.data["Zs"] > 0, axis=1) > 1
+
+    @property
+    def vdW_compact(self):
+        """
+        Compact representation of van der Waals constants.
+        """
+        vdW = self.data["vdW"]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            log_vdW = np.log10(vdW)
+        return np.where((log_vdW < 0) & np.isfinite(log_vdW), log_vdW, vdW)
+
+    def sort(self, key="lambda_vacuum"):
+        """
+        Return a copy of this table, sorted by a column.
+
+        :param key: [optional]
+            The column name to sort by.
+        """
+        return self[np.argsort(self.data[key], kind="stable")]
+
+    def window(self, lambda_min, lambda_max, air=False):
+        """
+        Return the transitions within a wavelength range (inclusive).
+
+        :param lambda_min:
+            The minimum wavelength (Angstroms).
+
+        :param lambda_max:
+            The maximum wavelength (Angstroms).
+
+        :param air: [optional]
+            Use air wavelengths instead of vacuum wavelengths (default: False).
+        """
+        lambdas = self.data["lambda_air" if air else "lambda_vacuum"]
+        return self[(lambdas >= lambda_min) & (lambdas <= lambda_max)]
+
+    def species_mask(self, *species):
+        """
+        Return a boolean mask of the transitions that belong to any of the given species. The order of
+        atoms in molecules is ignored, and isotopes are only matched if they are given.
+
+        :param species:
+            The :class:`Species` (or representations of species, like 'Fe I' or 'OH') to match.
+        """
+        Zs = np.sort(self.data["Zs"], axis=1)
+        mask = np.zeros(len(self), dtype=bool)
+        for each in species:
+            if not isinstance(each, Species):
+                each = Species(each)
+            match = np.all(Zs == sorted(each.Zs), axis=1) & (self.data["charge"] == each.charge)
+            if sum(each.isotopes) > 0:
+                order = np.argsort(each.Zs)
+                isotopes = np.take_along_axis(self.data["isotopes"], np.argsort(self.data["Zs"], axis=1), axis=1)
+                match &= np.all(isotopes == np.array(each.isotopes)[order], axis=1)
+            mask |= match
+        return mask
+
+    def select_species(self, *species):
+        """
+        Return the transitions that belong to any of the given species.
+
+        :param species:
+            The :class:`Species` (or representations of species, like 'Fe I' or 'OH') to select.
+        """
+        return self[self.species_mask(*species)]
+
+
+def read_npy(path, mmap_mode=None):
+    """
+    Read a table of transitions from the binary cache format.
+
+    :param path:
+        The path of the cache.
+
+    :param mmap_mode: [optional]
+        If given, memory-map the table (see `numpy.load`).
+    """
+    return TransitionTable(np.load(path, mmap_mode=mmap_mode, allow_pickle=False))
+
+
+def write_npy(table, path, overwrite=False):
+    """
+    Write a table of transitions to the binary cache format. Only the columns are stored, not the meta.
+
+    :param table:
+        The table of transitions.
+
+    :param path:
+        The path to store the cache.
+
+    :param overwrite: [optional]
+        Overwrite the path if it exists (default: False).
+    """
+    if os.path.exists(path) and not overwrite:
+        raise OSError(f"{path} already exists")
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as fp:
+        np.save(fp, table.data, allow_pickle=False)
+    os.replace(temp_path, path)
+    return None
+
+
+def identify_npy(origin, *args, **kwargs):
+    return isinstance(args[0], str) and args[0].lower().endswith(".npy")
+
+
+registry.register_reader("npy", TransitionTable, read_npy)
+registry.register_writer("npy", TransitionTable, write_npy)
+registry.register_identifier("npy", TransitionTable, identify_npy)
+
+
+if __name__ == "__main__":
+
+    import tempfile
+    from time import time
+    from grok.transitions.vald import write_vald, write_vald_table
+    from grok.synthesis.moog.transitions import write_moog, write_moog_table
+    from grok.synthesis.turbospectrum.transitions import write_transitions, write_transitions_table
+
+    N, N_objects = (1_000_000, 20_000)
+    rng = np.random.default_rng(0)
+
+    representations = np.array(["Fe 0", "Fe 1", "Ti 0", "Ca 1", "Na 0", "Si 0", "OH 0", "CN 0", "TiO 0", "C2 0"])
+    species = get_species_columns(representations)
+    index = rng.integers(0, representations.size, N)
+    E_lower = rng.uniform(0, 8, N)
+
+    def benchmark(description, f, *args, **kwargs):
+        t_init = time()
+        result = f(*args, **kwargs)
+        print(f"{description}: {time() - t_init:.2f} s")
+        return result
+
+    table = benchmark(
+        f"Create table of {N:,} transitions",
+        TransitionTable.from_columns,
+        lambda_air=np.sort(rng.uniform(15_000, 17_000, N)),
+        log_gf=rng.uniform(-5, 1, N),
+        E_lower=E_lower,
+        E_upper=E_lower + rng.uniform(0, 10, N),
+        j_upper=rng.integers(0, 10, N) / 2,
+        gamma_rad=rng.uniform(6, 9, N),
+        gamma_stark=rng.uniform(-7, -4, N),
+        vdW=rng.uniform(-8, -7, N),
+        comment=np.char.add("comment ", (index % 100).astype(str)),
+        **{k: v[index] for k, v in species.items()}
+    )
+    benchmark("Select a 10 A window", table.window, 16_000, 16_010)
+    benchmark("Select Fe I and Fe II", table.select_species, "Fe I", "Fe II")
+    benchmark("Sort by vacuum wavelength", table.sort, "lambda_vacuum")
+
+    with tempfile.TemporaryDirectory() as dir:
+        path = os.path.join(dir, "transitions.npy")
+        benchmark("Write binary cache", table.write, path)
+        benchmark("Read binary cache", TransitionTable.read, path)
+        benchmark("Memory-map binary cache", read_npy, path, mmap_mode="r")
+
+        benchmark("Write MOOG format", write_moog_table, table, os.path.join(dir, "moog"))
+        benchmark("Write Turbospectrum format", write_transitions_table, table, os.path.join(dir, "turbospectrum"), update_missing_data=True)
+        benchmark("Write VALD format", write_vald_table, table, os.path.join(dir, "vald"))
+
+        subset = table[:N_objects]
+        transitions = benchmark(f"Create {N_objects:,} Transition objects", subset.to_transitions)
+        benchmark(f"Write MOOG format from {N_objects:,} Transition objects", write_moog, transitions, os.path.join(dir, "moog"))
+        benchmark(f"Write Turbospectrum format from {N_objects:,} Transition objects", write_transitions, transitions, os.path.join(dir, "turbospectrum"), update_missing_data=True)
+        benchmark(f"Write VALD format from {N_objects:,} Transition objects", write_vald, transitions, os.path.join(dir, "vald"))
@@ -117,11 +117,11 @@ class Transition(object):
 
     @property
     def lambda_vacuum(self):
-        return self._lambda_vacuum or air_to_vacuum(self._lambda_air)
+        return self._lambda_vacuum if self._lambda_vacuum is not None else air_to_vacuum(self._lambda_air)
 
     @property
     def lambda_air(self):
-        return self._lambda_air or vacuum_to_air(self._lambda_vacuum)
+        return self._lambda_air if self._lambda_air is not None else vacuum_to_air(self._lambda_vacuum)
     
     def __repr__(self):
         return f"<{self} with χ = {self.E_lower:.2f}, log(gf) = {self.log_gf:.3f}>"
@@ -5,7 +5,8 @@ from astropy import units as u
 from typing import OrderedDict
 from textwrap import dedent
 
-from grok.transitions import (Species, Transition, Transitions)
+from grok.transitions import (Species, Transition, Transitions, TransitionTable)
+from grok.transitions.table import get_species_columns
 from grok.utils import safe_open
 
 _strip_quotes = lambda s: s.strip("' ")
@@ -279,6 +280,151 @@ def read_extract_all_or_extract_element(path):
     return Transitions(transitions)
     
 
+def read_extract_stellar_long_output_table(path):
+    """
+    Read transitions that have been extracted from the Vienna Atomic Line Database
+    version 3 (VALD3), using the "extract stellar" in long format, into a :class:`TransitionTable`.
+
+    Documentation at https://www.astro.uu.se/valdwiki/select_output
+    """
+
+    path, content, content_stream = safe_open(path)
+    lines = content.split("\n")
+
+    header_pattern = "\s*(?P<lambda_start>[\d\.]+),\s*(?P<lambda_end>[\d\.]+),\s*(?P<n_selected>\d+),\s*(?P<n_processed>\d+),\s*(?P<v_micro>[\d\.]+), Wavelength region, lines selected, lines processed, Vmicro"
+
+    meta = re.match(header_pattern, lines[0])
+    if not meta:
+        raise ValueError(f"Cannot match header with '{header_pattern}'")
+
+    meta = meta.groupdict()
+    for k in meta.keys():
+        dtype = int if k.startswith("n_") else float
+        meta[k] = dtype(meta[k])
+
+    lambda_key = "lambda_vacuum" if "WL_vac" in lines[1] else "lambda_air"
+
+    names = (
+        "species",
+        lambda_key,
+        "E_lower",
+        "v_micro",
+        "log_gf",
+        "gamma_rad",
+        "gamma_stark",
+        "vdW",
+        "lande_factor",
+        "lande_depth",
+        "reference"
+    )
+    data = np.genfromtxt(
+        path,
+        skip_header=3,
+        max_rows=meta["n_selected"],
+        delimiter=",",
+        dtype={
+            "names": names,
+            "formats": ("U10", float, float, float, float, float, float, float, float, float, "U100")
+        },
+        converters={
+            0: _strip_quotes_bytes,
+            10: _strip_quotes_bytes,
+        }
+    )
+    data = np.atleast_1d(data)
+
+    columns = {name: data[name] for name in names[1:] if name != "v_micro"}
+    columns.update(get_species_columns(data["species"], as_species_with_correct_charge))
+    return TransitionTable.from_columns(meta=meta, **columns)
+
+
+def read_extract_all_or_extract_element_table(path):
+    """
+    Read transitions that have been extracted from the Vienna Atomic Line Database
+    version 3 (VALD3), using the "extract all" or "extract element" formats, into a
+    :class:`TransitionTable`.
+
+    Documentation at https://www.astro.uu.se/valdwiki/presformat_output
+    """
+
+    path, content, content_stream = safe_open(path)
+    lines = content.split("\n")
+
+    header_rows = 2
+
+    #  Need to figure out if it's lambda_air or lambda_vac based on header
+    lambda_key = "lambda_vacuum" if "WL_vac" in lines[1] else "lambda_air"
+
+    # Each transition is described by four lines. Find where the transitions end.
+    body = lines[header_rows:]
+    N = len(body)
+    for i, line in enumerate(body):
+        if line.strip() == "References:" or (i % 4 == 0 and line.count(",") < 10):
+            N = i
+            break
+    records = body[:4 * (N // 4)]
+    if not records:
+        raise ValueError(f"No transitions found in {path}")
+
+    values = np.array([line.split(",")[:13] for line in records[0::4]])
+    float_names = (
+        lambda_key, "log_gf", "E_lower", "j_lower", "E_upper", "j_upper", "lande_factor_lower",
+        "lande_factor_upper", "lande_factor_mean", "gamma_rad", "gamma_stark", "vdW"
+    )
+    columns = {name: values[:, j].astype(float) for j, name in enumerate(float_names, start=1)}
+    columns.update(get_species_columns(values[:, 0], as_species_with_correct_charge))
+
+    lower_level_descs = list(map(_strip_quotes, records[1::4]))
+    upper_level_descs = list(map(_strip_quotes, records[2::4]))
+    columns["reference"] = list(map(_strip_quotes, records[3::4]))
+
+    # Parse the orbital information, once per unique pair of levels.
+    orbital_types = {}
+    for pair in set(zip(lower_level_descs, upper_level_descs)):
+        orbital_types[pair] = parse_levels(*pair)
+    columns["lower_orbital_type"], columns["upper_orbital_type"] = np.array(
+        [orbital_types[pair] for pair in zip(lower_level_descs, upper_level_descs)]
+    ).T
+
+    # Build the comment cards.
+    species_names = {}
+    for representation in np.unique(values[:, 0]):
+        species_names[representation] = str(as_species_with_correct_charge(representation))
+
+    def level(desc):
+        coupling = (desc[:2].strip() + "__")[:2]
+        return f"{coupling}:{re.sub(' +', ' ', desc[2:].strip())}"
+
+    columns["comment"] = [
+        f"{species_names[representation]} {level(lower)} {level(upper)}"
+        for representation, lower, upper in zip(values[:, 0], lower_level_descs, upper_level_descs)
+    ]
+    return TransitionTable.from_columns(**columns)
+
+
+def read_vald_table(path):
+    """
+    Read transitions exported from the Vienna Atomic Line Database
+    version 3 (VALD3) into a :class:`TransitionTable`.
+
+    Here we assume the format is not known, and we try our best.
+    """
+
+    methods = [
+        read_extract_all_or_extract_element_table,
+        read_extract_stellar_long_output_table,
+    ]
+    for method in methods:
+        try:
+            t = method(path)
+        except:
+            continue
+        else:
+            return t
+    else:
+        raise IOError(f"Unable to read VALD format. Tried methods: {methods}")
+
+
 def read_vald(path):
     """
     Read transitions exported from the Vienna Atomic Line Database
@@ -316,10 +462,10 @@ def identify_vald_all_or_extract_element(origin, *args, **kwargs):
 
     first_line = args[1].readline()
     if isinstance(first_line, bytes):
-        first_line = first_line.decode("utf-8")
+        first_line = first_line.decode("utf-8", errors="replace")
     second_line = args[1].readline()
     if isinstance(second_line, bytes):
-        second_line = second_line.decode("utf-8")
+        second_line = second_line.decode("utf-8", errors="replace")
     
     # Reset pointer.
     args[1].seek(0)
@@ -336,7 +482,7 @@ def identify_vald_stellar(origin, *args, **kwargs):
     zeroth_line_pattern = "^\s*[\d\.]+,\s*[\d\.]+,\s*\d+,\s\d+,\s[\d\.]+,\s*Wavelength region,\s*lines selected,\s*lines processed, Vmicro"
     zeroth_line = args[1].readline()
     if isinstance(zeroth_line, bytes):
-        zeroth_line = zeroth_line.decode("utf-8")
+        zeroth_line = zeroth_line.decode("utf-8", errors="replace")
     
     args[1].seek(0)
     return re.match(zeroth_line_pattern, zeroth_line) is not None
@@ -372,8 +518,46 @@ def write_vald(transitions, path):
     return None     
 
 
+def write_vald_table(table, path):
+    """
+    Write a :class:`TransitionTable` to path using the VALD extractformat.
+    """
+
+    table = table.sort("lambda_vacuum")
+    species, inverse = table.unique_species()
+    species_reprs = np.array([f"'{''.join(s.atoms)} {s.charge + 1}'" for s in species])[inverse]
+
+    gamma_rad = table["gamma_rad"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        gamma_rad = np.where(gamma_rad > 3, np.log10(gamma_rad), gamma_rad)
+
+    rows = zip(
+        species_reprs.tolist(),
+        table["lambda_vacuum"].tolist(),
+        table["E_lower"].tolist(),
+        table["log_gf"].tolist(),
+        gamma_rad.tolist(),
+        table["gamma_stark"].tolist(),
+        table.vdW_compact.tolist()
+    )
+    fmt = "%s,%16.4f,%8.4f, %8.3f, %6.3f, %6.3f, %6.3f, 0.0, 0.0\n"
+    with open(path, "w") as fp:
+        fp.write("                                             Damping parameters     Lande  Central\n")
+        fp.write("Spec Ion     WL_vac(A)  Excit(eV) log gf* Rad.   Stark   Waals   factor  depth  Reference\n")
+        fp.writelines([fmt % row for row in rows])
+        # Korg needs this, but it will not always be true
+        fp.write("* oscillator strengths were scaled by the solar isotopic ratios.")
+
+    return None
+
+
 registry.register_reader("vald", Transitions, read_vald)
 registry.register_writer("vald.stellar", Transitions, write_vald)
 registry.register_reader("vald.stellar", Transitions, read_extract_stellar_long_output)
 registry.register_identifier("vald", Transitions, identify_vald_all_or_extract_element)
 registry.register_identifier("vald.stellar", Transitions, identify_vald_stellar)
+registry.register_reader("vald", TransitionTable, read_vald_table)
+registry.register_writer("vald.stellar", TransitionTable, write_vald_table)
+registry.register_reader("vald.stellar", TransitionTable, read_extract_stellar_long_output_table)
+registry.register_identifier("vald", TransitionTable, identify_vald_all_or_extract_element)
+registry.register_identifier("vald.stellar", TransitionTable, identify_vald_stellar)
@@ -1,6 +1,6 @@
 
 import numpy as np
-from astra.specutils.continuum.nmf.base import BaseNMFSinusoidsContinuum, load_components
+from astra.specutils.continuum.nmf.base import BaseNMFSinusoidsContinuum, load_components, load_shared_components
 
 class ApogeeNMFContinuum(BaseNMFSinusoidsContinuum):
     
@@ -14,10 +14,11 @@ class ApogeeNMFContinuum(BaseNMFSinusoidsContinuum):
             [15877.64179911 - 25, 16380.9845233 + 45],
             [16494.30420468 - 25, 16898.18264895 + 60]
         ],
-        pad=50
+        pad=50,
+        shared=False
     ):
         dispersion = 10**(4.179 + 6e-6 * np.arange(8575))
-        components = load_components(components_path, dispersion.size - 2 * pad, pad=pad)        
+        components = (load_shared_components if shared else load_components)(components_path, dispersion.size - 2 * pad, pad=pad)        
         super(ApogeeNMFContinuum, self).__init__(
             dispersion,
             components,
@@ -1,13 +1,14 @@
 
+import os
 import numpy as np
 import warnings
 import pickle
-from astra.utils import expand_path
+from astra.utils import expand_path, log
 from functools import cache
 from typing import Optional, Tuple
 from scipy import optimize as op
-from sklearn.decomposition._nmf import _fit_coordinate_descent
 from sklearn.exceptions import ConvergenceWarning
+from astra.specutils.continuum.nmf.solver import BatchNMFSolver
 
 @cache
 def load_components(path, P, pad=0):    
@@ -20,6 +21,26 @@ def load_components(path, P, pad=0):
         components = masked_components
     return components
 
+
+@cache
+def load_shared_components(path, P, pad=0):
+    """
+    Load the NMF components as a read-only memory-mapped array.
+
+    The components are written once to a `.npy` file next to the pickled components, and every
+    process that loads them maps the same file, so worker processes share one copy in memory.
+    """
+    npy_path = f"{expand_path(path)}.{P}.{pad}.npy"
+    if not os.path.exists(npy_path):
+        components = load_components(path, P, pad=pad)
+        # Write to a temporary path first so other processes never read a partial file.
+        temp_path = f"{npy_path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as fp:
+            np.save(fp, components)
+        os.replace(temp_path, npy_path)
+    return np.load(npy_path, mmap_mode="r")
+
+
 class BaseNMFSinusoidsContinuum(object):
 
     def __init__(
@@ -50,6 +71,17 @@ class BaseNMFSinusoidsContinuum(object):
             A[mask, si:ei] = design_matrix(dispersion[mask], self.deg, self.L).T
 
         self.continuum_design_matrix = A
+
+        # The design matrix is shared by all spectra, so we pre-compute the pixel-wise outer
+        # products for each region. The normal equations for any set of inverse variances are
+        # then a single matrix product (see `_theta_step`).
+        K = self.n_parameters_per_region
+        self.region_outer_products = []
+        for i, mask in enumerate(self.region_masks):
+            A_region = A[mask, i * K:(i + 1) * K]
+            self.region_outer_products.append(
+                (A_region[:, :, None] * A_region[:, None, :]).reshape((-1, K * K))
+            )
         # TODO: Refactor to remove dependency on _dmm. Use scontinuum_deisgn_matrix instead
         #design_matrices = [
         #    design_matrix(dispersion[s], self.deg, self.L)
@@ -62,48 +94,62 @@ class BaseNMFSinusoidsContinuum(object):
     def n_parameters_per_region(self):
         return 2 * self.deg + 1
 
-    def _theta_step(self, flux, ivar, rectified_flux):        
+    def _theta_step(self, flux, ivar, rectified_flux):
+        """
+        Solve for the continuum coefficients of all spectra and all regions at once.
+
+        :param flux:
+            A (N, P) shape array of flux values.
+
+        :param ivar:
+            A (N, P) shape array of inverse variances on flux values.
+
+        :param rectified_flux:
+            A (P, ) or (N, P) shape array of the current estimate of the rectified flux.
+
+        :returns:
+            A two-length tuple containing the (N, R, K) shape array of continuum coefficients,
+            and the (N, P) shape array of continuum fluxes.
+        """
         N, P = flux.shape
-        theta = np.zeros((N, self.n_regions, self.n_parameters_per_region))
+        K = self.n_parameters_per_region
         continuum = np.nan * np.ones_like(flux)
         continuum_flux = flux / rectified_flux
         continuum_ivar = ivar * rectified_flux**2
-        for i in range(N):            
-            #for j, (A, mask) in enumerate(zip(*self._dmm)):
-            for j, mask in enumerate(self.region_masks):
-                sj, ej = (j * self.n_parameters_per_region, (j + 1) * self.n_parameters_per_region)
-                A = self.continuum_design_matrix[mask, sj:ej]
-                MTM = A.T @ (continuum_ivar[i, mask][:, None] * A)
-                MTy = A.T @ (continuum_ivar[i, mask] * continuum_flux[i, mask])
-                try:
-                    theta[i, j] = np.linalg.solve(MTM, MTy)
-                except np.linalg.LinAlgError:
-                    if np.any(continuum_ivar[i, mask] > 0):
-                        raise
-                continuum[i, mask] = A @ theta[i, j]        
+
+        MTM = np.empty((N, self.n_regions, K, K))
+        MTy = np.empty((N, self.n_regions, K))
+        for j, (mask, outer) in enumerate(zip(self.region_masks, self.region_outer_products)):
+            A = self.continuum_design_matrix[mask, j * K:(j + 1) * K]
+            MTM[:, j] = (continuum_ivar[:, mask] @ outer).reshape((N, K, K))
+            MTy[:, j] = (continuum_ivar[:, mask] * continuum_flux[:, mask]) @ A
+
+        # Regions without any data have zero coefficients (and zero continuum).
+        no_data = np.array([
+            ~np.any(continuum_ivar[:, mask] > 0, axis=1) for mask in self.region_masks
+        ]).T
+        MTM[no_data] = np.eye(K)
+        MTy[no_data] = 0
+        theta = np.linalg.solve(MTM, MTy[..., None])[..., 0]
+
+        for j, mask in enumerate(self.region_masks):
+            A = self.continuum_design_matrix[mask, j * K:(j + 1) * K]
+            continuum[:, mask] = theta[:, j] @ A.T
 
         return (theta, continuum)
 
 
+    @property
+    def W_solver(self):
+        try:
+            return self._W_solver
+        except AttributeError:
+            self._W_solver = BatchNMFSolver(self)
+            return self._W_solver
+
     def _W_step(self, mean_rectified_flux, W, **kwargs):
-        absorption = 1 - mean_rectified_flux
-        use = np.zeros(mean_rectified_flux.size, dtype=bool)
-        use[np.hstack(self.region_masks)] = True    
-        use *= (
-            np.isfinite(absorption) 
-        &   (absorption >= 0) 
-        &   (mean_rectified_flux > 0)
-        )
-        W_next, _, n_iter = _fit_coordinate_descent(
-            absorption[use].reshape((1, -1)),
-            W,
-            self.components[:, use],
-            update_H=False,
-            verbose=False,
-            shuffle=True
-        )        
-        rectified_model_flux = 1 - (W_next @ self.components)[0]
-        return (W_next, rectified_model_flux, np.sum(use), n_iter)
+        W_next, rectified_model_flux, n_pixels_used, n_iter = self.W_solver.W_step(mean_rectified_flux, W)
+        return (W_next, rectified_model_flux[0], n_pixels_used[0], n_iter[0])
 
 
     def get_initial_guess_by_iteration(self, flux, ivar, A=None, max_iter=32):
@@ -137,6 +183,79 @@ class BaseNMFSinusoidsContinuum(object):
         return thetas[-1]
 
 
+    def get_initial_guesses_by_iteration(self, flux, ivar, max_iter=32, block_size=1000):
+        """
+        Get initial guesses for many independent spectra at once, by alternating between solving
+        for the continuum coefficients and the NMF coefficients of every spectrum.
+
+        Each spectrum stops iterating when its chi-squared value gets worse, and keeps the guess
+        from the previous iteration.
+
+        :param flux:
+            A (N, P) shape array of flux values, where each row is a different spectrum.
+
+        :param ivar:
+            A (N, P) shape array of inverse variances on flux values.
+
+        :param max_iter: [optional]
+            The maximum number of iterations.
+
+        :param block_size: [optional]
+            The number of spectra to solve NMF coefficients for at once.
+
+        :returns:
+            A (N, C + R * K) shape array of initial guesses, which can be given as `x0` to `fit`
+            for each spectrum.
+        """
+        flux, ivar = _check_and_reshape_flux_ivar(
+            self.dispersion,
+            np.array(flux, dtype=float),
+            np.array(ivar, dtype=float)
+        )
+        N, P = flux.shape
+        C = self.components.shape[0]
+        K = self.n_regions * self.n_parameters_per_region
+
+        x0 = np.zeros((N, C + K))
+        W = np.zeros((N, C))
+        rectified_flux = np.ones((N, P))
+        chi_sq = np.inf * np.ones(N)
+        active = np.ones(N, dtype=bool)
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", category=RuntimeWarning)
+
+            for iteration in range(max_iter):
+                indices = np.where(active)[0]
+                theta, continuum = self._theta_step(flux[indices], ivar[indices], rectified_flux[indices])
+                W_next, rectified_flux_next = ([], [])
+                for W_block, rectified_flux_block, *_ in self.W_solver.iter_W_steps(
+                    flux[indices] / continuum,
+                    W=W[indices],
+                    block_size=block_size
+                ):
+                    W_next.append(W_block)
+                    rectified_flux_next.append(rectified_flux_block)
+                W_next, rectified_flux_next = (np.vstack(W_next), np.vstack(rectified_flux_next))
+
+                chi_sq_next = np.nansum((flux[indices] - rectified_flux_next * continuum)**2 * ivar[indices], axis=1)
+                improved = ~(chi_sq_next > chi_sq[indices])
+                accept = indices[improved]
+                x0[accept] = np.hstack([W_next[improved], theta[improved].reshape((-1, K))])
+                W[accept] = W_next[improved]
+                rectified_flux[accept] = rectified_flux_next[improved]
+                chi_sq[accept] = chi_sq_next[improved]
+                active[indices[~improved]] = False
+                if not np.any(active):
+                    break
+
+        log.info(
+            f"Initial guesses for {N} spectra after {iteration + 1} iterations: NMF W-step converged for "
+            f"{self.W_solver.n_converged}/{self.W_solver.n_spectra} spectra in total "
+            f"({self.W_solver.spectra_per_second:.0f} spectra per second)"
+        )
+        return x0
+
+
     def continuum(self, wavelength, theta):
         C, P = self.components.shape
         
@@ -1,6 +1,6 @@
 
 import numpy as np
-from astra.specutils.continuum.nmf.base import BaseNMFSinusoidsContinuum, load_components
+from astra.specutils.continuum.nmf.base import BaseNMFSinusoidsContinuum, load_components, load_shared_components
 
 class BossNMFContinuum(BaseNMFSinusoidsContinuum):
     
@@ -12,10 +12,11 @@ class BossNMFContinuum(BaseNMFSinusoidsContinuum):
         regions=[
             [3750, 6250],
             [6350, 12000]
-        ]                
+        ],
+        shared=False
     ):
         dispersion = 10**(3.5523 + 1e-4 * np.arange(4648))
-        components = load_components(components_path, dispersion.size)
+        components = (load_shared_components if shared else load_components)(components_path, dispersion.size)
         super(BossNMFContinuum, self).__init__(
             dispersion,
             components,
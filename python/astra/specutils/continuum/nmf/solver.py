@@ -0,0 +1,160 @@
+"""Solve for the NMF coefficients of many spectra at once, given fixed components."""
+
+import numpy as np
+from time import time
+from typing import Optional
+
+from astra.utils import log
+
+
+class BatchNMFSolver(object):
+
+    def __init__(
+        self,
+        model,
+        max_iter: Optional[int] = 1000,
+        tol: Optional[float] = 1e-8,
+    ):
+        """
+        A multi-spectrum solver for the NMF coefficients (W) of a continuum model.
+
+        The components are held fixed, so the problem for each spectrum is a non-negative least
+        squares problem. This is solved for a whole block of spectra at once with accelerated
+        projected gradient steps on stacked arrays. The per-spectrum Gram matrices are formed
+        from the pixel-wise outer products of the components, which are computed once and shared
+        by all blocks. Each block is warm-started from the solution of the previous block.
+
+        :param model:
+            A `BaseNMFSinusoidsContinuum` model.
+
+        :param max_iter: [optional]
+            The maximum number of projected gradient iterations per block.
+
+        :param tol: [optional]
+            The relative change in W (per spectrum) below which a spectrum is converged.
+        """
+        self.model = model
+        self.max_iter = max_iter
+        self.tol = tol
+
+        C, P = self.model.components.shape
+        self.use = np.zeros(P, dtype=bool)
+        self.use[np.hstack(self.model.region_masks)] = True
+        self.W = None
+        self.n_spectra = 0
+        self.n_converged = 0
+        self.t_elapsed = 0
+        return None
+
+    @property
+    def component_outer_products(self):
+        try:
+            return self._component_outer_products
+        except AttributeError:
+            H = np.nan_to_num(self.model.components.T)
+            C = H.shape[1]
+            self._component_outer_products = (H[:, :, None] * H[:, None, :]).reshape((-1, C * C))
+            return self._component_outer_products
+
+    @property
+    def spectra_per_second(self):
+        return self.n_spectra / self.t_elapsed if self.t_elapsed > 0 else np.nan
+
+    def W_step(self, mean_rectified_flux, W=None):
+        """
+        Solve for the NMF coefficients of a block of spectra.
+
+        :param mean_rectified_flux:
+            A (N, P) shape array of rectified fluxes.
+
+        :param W: [optional]
+            A (N, C) shape array of initial coefficients. If `None`, the block is warm-started
+            from the mean solution of the previous block (or zeros for the first block).
+
+        :returns:
+            A four-length tuple containing the (N, C) shape array of coefficients, the (N, P) shape
+            array of rectified model fluxes, the (N, ) shape array of pixels used per spectrum, and
+            the (N, ) shape array of iterations needed per spectrum.
+        """
+        t_init = time()
+        mean_rectified_flux = np.atleast_2d(mean_rectified_flux)
+        N, P = mean_rectified_flux.shape
+        C = self.model.components.shape[0]
+        H = np.nan_to_num(self.model.components)
+
+        absorption = 1 - mean_rectified_flux
+        with np.errstate(invalid="ignore"):
+            use = (
+                self.use
+            &   np.isfinite(absorption)
+            &   (absorption >= 0)
+            &   (mean_rectified_flux > 0)
+            )
+        X = np.where(use, absorption, 0)
+
+        G = (use.astype(float) @ self.component_outer_products).reshape((N, C, C))
+        R = X @ H.T
+        L = np.linalg.eigvalsh(G)[:, -1]
+        L[L <= 0] = 1
+
+        if W is None:
+            W = np.zeros((N, C)) if self.W is None else np.tile(np.mean(self.W, axis=0), (N, 1))
+        W = np.clip(np.array(W, dtype=float).reshape((N, C)), 0, None)
+
+        # Accelerated projected gradient (FISTA) steps, with a per-spectrum step size.
+        Y, t = (W.copy(), 1)
+        n_iter = np.zeros(N, dtype=int)
+        converged = np.zeros(N, dtype=bool)
+        for iteration in range(1, 1 + self.max_iter):
+            gradient = np.einsum("nc,ncd->nd", Y, G) - R
+            W_next = np.clip(Y - gradient / L[:, None], 0, None)
+            change = np.max(np.abs(W_next - W), axis=1) / np.clip(np.max(W_next, axis=1), 1e-12, None)
+            n_iter[~converged] = iteration
+            converged |= (change < self.tol)
+            t_next = 0.5 * (1 + np.sqrt(1 + 4 * t**2))
+            Y = W_next + ((t - 1) / t_next) * (W_next - W)
+            W, t = (W_next, t_next)
+            if np.all(converged):
+                break
+
+        rectified_model_flux = 1 - W @ self.model.components
+
+        t_elapsed = time() - t_init
+        self.W = W
+        self.n_spectra += N
+        self.n_converged += np.sum(converged)
+        self.t_elapsed += t_elapsed
+        log.debug(
+            f"NMF W-step converged for {np.sum(converged)}/{N} spectra in {np.max(n_iter)} iterations "
+            f"({N / t_elapsed:.0f} spectra per second)"
+        )
+        return (W, rectified_model_flux, np.sum(use, axis=1), n_iter)
+
+    def iter_W_steps(self, mean_rectified_flux, W=None, block_size=1000):
+        """
+        Solve for the NMF coefficients of many spectra, one block at a time.
+
+        :param mean_rectified_flux:
+            A (N, P) shape array of rectified fluxes.
+
+        :param W: [optional]
+            A (N, C) shape array of initial coefficients. If `None`, each block is warm-started
+            from the solution of the previous block.
+
+        :param block_size: [optional]
+            The number of spectra to solve for at once.
+
+        :returns:
+            A generator that yields the output of `W_step` for each block.
+        """
+        mean_rectified_flux = np.atleast_2d(mean_rectified_flux)
+        for si in range(0, mean_rectified_flux.shape[0], block_size):
+            yield self.W_step(
+                mean_rectified_flux[si:si + block_size],
+                None if W is None else W[si:si + block_size]
+            )
+
+        log.debug(
+            f"NMF W-step converged for {self.n_converged}/{self.n_spectra} spectra in total "
+            f"({self.spectra_per_second:.0f} spectra per second)"
+        )
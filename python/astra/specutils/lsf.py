@@ -65,6 +65,46 @@ def instrument_lsf_kernel(λ: np.array, λc: float, R: Tuple[int, float], **kwar
     return (mask, ϕ)
 
 
+def instrument_lsf_coo(λ_input: np.array, λ_output: np.array, R: Tuple[int, float], σ_window: Tuple[float, int] = 5):
+    """
+    Construct the non-zero entries of a matrix to convolve fluxes at input wavelengths (λ_input) at an 
+    instrument spectral resolution (R) and resample to the given output wavelengths (λ_output).
+
+    Only the entries within the kernel support window are computed, for all output wavelengths at once.
+
+    :param λ_input:
+        A N-length array of input wavelength values. This must be sorted in increasing order.
+
+    :param λ_output:
+        A M-length array of output wavelength values.
+
+    :param R:
+        Spectral resolution.
+    
+    :param σ_window: [optional]
+        The number of sigma where the LSF contributes (default: 5).
+
+    :returns:
+        A three-length tuple containing the kernel values, the row (input) indices, and the column
+        (output) indices.
+    """
+    λ_input, λ_output = (np.asarray(λ_input), np.asarray(λ_output))
+    σ, (lower, upper) = lsf_sigma_and_bounds(λ_output, R, σ_window)
+    si = np.searchsorted(λ_input, lower, side="left")
+    ei = np.searchsorted(λ_input, upper, side="right")
+    
+    rows = si[:, None] + np.arange(max(np.max(ei - si, initial=0), 0))
+    valid = rows < ei[:, None]
+    rows = np.where(valid, rows, 0)
+
+    ϕ = np.where(valid, np.exp(-0.5 * ((λ_input[rows] - λ_output[:, None]) / σ[:, None])**2), 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ϕ /= np.sum(ϕ, axis=1, keepdims=True)
+    
+    cols = np.repeat(np.arange(λ_output.size), np.sum(valid, axis=1))
+    return (ϕ[valid], rows[valid], cols)
+
+
 def instrument_lsf_dense_matrix(λ_input: np.array, λ_output: np.array, R: Tuple[int, float], **kwargs):
     """
     Construct a dense matrix to convolve fluxes at input wavelengths (λ_input) at an instrument spectral
@@ -82,10 +122,9 @@ def instrument_lsf_dense_matrix(λ_input: np.array, λ_output: np.array, R: Tupl
     :returns:
         A (N, M) dense array representing a convolution kernel.
     """
-    K = np.empty((λ_input.size, λ_output.size), dtype=float)
-    for o, λ in enumerate(λ_output):
-        mask, ϕ = instrument_lsf_kernel(λ_input, λ, R, **kwargs)
-        K[mask, o] += ϕ 
+    data, rows, cols = instrument_lsf_coo(λ_input, λ_output, R, **kwargs)
+    K = np.zeros((λ_input.size, λ_output.size), dtype=float)
+    K[rows, cols] = data
     return K
     
 
@@ -106,17 +145,19 @@ def instrument_lsf_sparse_matrix(λ_input: np.array, λ_output: np.array, R: Tup
     :returns:
         A (N, M) sparse array representing a convolution kernel.
     """    
-    K = instrument_lsf_dense_matrix(λ_input, λ_output, R, **kwargs)
-    return sparse.coo_array(K).tocsc()
+    data, rows, cols = instrument_lsf_coo(λ_input, λ_output, R, **kwargs)
+    return sparse.coo_array((data, (rows, cols)), shape=(λ_input.size, λ_output.size)).tocsc()
 
 
-def rotational_broadening_sparse_matrix(λ: np.array, vsini: Tuple[int, float], epsilon: Tuple[int, float]):
+def rotational_broadening_coo(λ: np.array, vsini: Tuple[int, float], epsilon: Tuple[int, float]):
     """
-    Construct a sparse matrix to convolve fluxes at input wavelengths (λ) with a rotational broadening kernel
-    with a given vsini and epsilon.
+    Construct the non-zero entries of a matrix to convolve fluxes at input wavelengths (λ) with a 
+    rotational broadening kernel with a given vsini and epsilon.
+
+    Only the entries within the kernel support window are computed, for all pixels at once.
     
     :param λ:
-        A N-length array of input wavelength values.
+        A N-length array of input wavelength values, assumed to be uniformly sampled.
         
     :param vsini:
         The projected rotational velocity of the star in km/s.
@@ -125,10 +166,9 @@ def rotational_broadening_sparse_matrix(λ: np.array, vsini: Tuple[int, float],
         The limb darkening coefficient.
     
     :returns:
-        A (N, N) sparse array representing a convolution kernel.
+        A three-length tuple containing the kernel values, the row indices, and the column indices.
     """
-
-    # Let's pre-calculate some things that are needed in the hot loop.
+    λ = np.asarray(λ)
     denominator = np.pi * vsini * (1.0 - epsilon / 3.0)
     c1 = 2.0 * (1.0 - epsilon) / denominator
     c2 = 0.5 * np.pi * epsilon / denominator    
@@ -137,24 +177,45 @@ def rotational_broadening_sparse_matrix(λ: np.array, vsini: Tuple[int, float],
     scale = vsini_c / (λ[1] - λ[0]) # assume uniform sampling
     N = λ.size
 
-    data, row_index, col_index = ([], [], [])
-    for i, λ_i in enumerate(λ):
-        n_pix = int(np.ceil(λ_i * scale))
-        si, ei = (max(0, i - n_pix), min(i + n_pix + 1, N))
-        mask = slice(si, ei) # ignoring edge effects
+    n_pix = np.ceil(λ * scale).astype(int)
+    i = np.arange(N)
+    si, ei = (np.clip(i - n_pix, 0, None), np.clip(i + n_pix + 1, None, N))
+
+    rows = si[:, None] + np.arange(np.max(ei - si))
+    valid = rows < ei[:, None]
+    rows = np.where(valid, rows, 0)
 
-        λ_delta_max = λ_i * vsini_c
-        λ_delta = λ[mask] - λ_i
-        λ_ratio_sq = (λ_delta / λ_delta_max)**2.0
+    λ_delta_max = λ * vsini_c
+    λ_ratio_sq = ((λ[rows] - λ[:, None]) / λ_delta_max[:, None])**2.0
+    with np.errstate(invalid="ignore"):
         ϕ = c1 * np.sqrt(1.0 - λ_ratio_sq) + c2 * (1.0 - λ_ratio_sq)
-        ϕ[λ_ratio_sq >= 1.0] = 0.0 # flew too close to the sun
-        ϕ /= np.sum(ϕ)
+    ϕ[(λ_ratio_sq >= 1.0) | ~valid] = 0.0 # flew too close to the sun
+    ϕ /= np.sum(ϕ, axis=1, keepdims=True)
+
+    cols = np.repeat(i, np.sum(valid, axis=1))
+    return (ϕ[valid], rows[valid], cols)
 
-        data.extend(ϕ)
-        row_index.extend(list(range(si, ei)))
-        col_index.extend([i] * (ei - si))
+
+def rotational_broadening_sparse_matrix(λ: np.array, vsini: Tuple[int, float], epsilon: Tuple[int, float]):
+    """
+    Construct a sparse matrix to convolve fluxes at input wavelengths (λ) with a rotational broadening kernel
+    with a given vsini and epsilon.
+    
+    :param λ:
+        A N-length array of input wavelength values.
+        
+    :param vsini:
+        The projected rotational velocity of the star in km/s.
+    
+    :param epsilon:
+        The limb darkening coefficient.
     
+    :returns:
+        A (N, N) sparse array representing a convolution kernel.
+    """
+    data, row_index, col_index = rotational_broadening_coo(λ, vsini, epsilon)
     return sparse.csr_matrix(
         (data, (row_index, col_index)), 
         shape=(λ.size, λ.size)
-    )
\ No newline at end of file
+    )
+
@@ -1,5 +1,5 @@
 import numpy as np
-from scipy import interpolate
+from scipy import interpolate, sparse
 from astropy.constants import c
 from astropy import units as u
 from collections import OrderedDict
@@ -432,6 +432,50 @@ def sample_forward_model(wavelength, flux, ivar, pixel_flags, delta_wavelength,
     return Xstar @ theta_hat
 
 
+def cubic_spline_sparse_matrix(λ_input, λ_output, tol=1e-12, chunk_size=512):
+    """
+    Construct a sparse matrix that resamples fluxes at input wavelengths (λ_input) to output wavelengths
+    (λ_output) with a not-a-knot cubic spline, as `scipy.interpolate.CubicSpline` (and `specutils`'s
+    `SplineInterpolatedResampler`) would.
+
+    A cubic spline through fixed knots is linear in the values at the knots, and the weight of each knot
+    decays quickly with distance, so the spline is a banded matrix once weights smaller than `tol` are
+    dropped. Output wavelengths outside the input wavelength range are extrapolated.
+
+    :param λ_input:
+        A N-length array of input wavelength values. This must be sorted in increasing order.
+
+    :param λ_output:
+        A M-length array of output wavelength values.
+
+    :param tol: [optional]
+        The absolute weight below which matrix entries are dropped.
+
+    :param chunk_size: [optional]
+        The number of input pixels to compute spline weights for at once.
+
+    :returns:
+        A (N, M) sparse array, such that `flux @ K` resamples a (N_spectra, N) flux array.
+    """
+    λ_input, λ_output = (np.asarray(λ_input), np.asarray(λ_output))
+    N = λ_input.size
+    # The weight of a knot decays by ~0.27 per pixel, so knots far outside the output range do not contribute.
+    lower = max(np.searchsorted(λ_input, np.min(λ_output)) - 64, 0)
+    upper = min(np.searchsorted(λ_input, np.max(λ_output)) + 64, N)
+    data, rows, cols = ([], [], [])
+    for si in range(lower, upper, chunk_size):
+        basis = np.eye(N, min(chunk_size, upper - si), k=-si)
+        ϕ = interpolate.CubicSpline(λ_input, basis)(λ_output)
+        j, i = np.nonzero(np.abs(ϕ) > tol)
+        data.append(ϕ[j, i])
+        rows.append(si + i)
+        cols.append(j)
+    return sparse.coo_array(
+        (np.hstack(data), (np.hstack(rows), np.hstack(cols))), 
+        shape=(N, λ_output.size)
+    ).tocsc()
+
+
 if __name__ == "__main__":
 
     from astra.models.apogee import ApogeeVisitSpectrum
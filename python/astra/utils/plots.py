@@ -0,0 +1,207 @@
+"""Defer diagnostic figures to an on-disk queue, and render them out of band."""
+
+import os
+import json
+import hashlib
+import numpy as np
+import concurrent.futures
+from fnmatch import fnmatch
+from glob import glob
+from tqdm import tqdm
+
+from astra.utils import log, expand_path, callable
+
+DEFAULT_PLOT_QUEUE_DIR = "$MWM_ASTRA/{version}/plots/queue"
+
+
+def get_plot_queue_dir(queue_dir=None):
+    """
+    Return the expanded path of the plot queue directory.
+
+    :param queue_dir: [optional]
+        The queue directory. If `None`, this defaults to `$MWM_ASTRA/<version>/plots/queue`.
+    """
+    from astra import __version__
+    return expand_path((queue_dir or DEFAULT_PLOT_QUEUE_DIR).format(version=__version__))
+
+
+def defer_plot(function, path, queue_dir=None, **kwargs):
+    """
+    Write a plot specification to the on-disk queue, so the figure can be rendered later with
+    `render_plots` (or `astra plots render`).
+
+    Arrays (and lists or tuples of arrays) are stored in a `.npz` file, and all other keyword arguments
+    must be JSON-serialisable. Deferring the same figure path again replaces the queued specification.
+
+    :param function:
+        The plotting function, or its dotted path (resolved with `astra.utils.callable`). It must accept
+        the keyword arguments and return a `matplotlib.figure.Figure`.
+
+    :param path:
+        The path to save the figure to.
+
+    :param queue_dir: [optional]
+        The queue directory.
+
+    :returns:
+        The path of the queued specification.
+    """
+    if not isinstance(function, str):
+        function = f"{function.__module__}.{function.__qualname__}"
+
+    path = expand_path(path)
+    spec = dict(function=function, path=path, kwargs={}, arrays=[], sequences={})
+    arrays = {}
+    for key, value in kwargs.items():
+        if isinstance(value, np.ndarray):
+            spec["arrays"].append(key)
+            arrays[key] = value
+        elif isinstance(value, (list, tuple)) and len(value) > 0 and all(isinstance(v, np.ndarray) for v in value):
+            spec["sequences"][key] = len(value)
+            arrays.update({f"{key}.{i}": v for i, v in enumerate(value)})
+        elif isinstance(value, np.generic):
+            spec["kwargs"][key] = value.item()
+        else:
+            spec["kwargs"][key] = value
+
+    queue_dir = get_plot_queue_dir(queue_dir)
+    os.makedirs(queue_dir, exist_ok=True)
+    spec_path = os.path.join(queue_dir, f"{hashlib.md5(path.encode()).hexdigest()}.npz")
+    temp_path = f"{spec_path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as fp:
+        np.savez(fp, __spec__=np.array(json.dumps(spec)), **arrays)
+    os.replace(temp_path, spec_path)
+    return spec_path
+
+
+def _read_spec(data):
+    return json.loads(str(data["__spec__"]))
+
+
+def _read_plot_path(spec_path):
+    with np.load(spec_path, allow_pickle=False) as data:
+        return _read_spec(data)["path"]
+
+
+def read_plot_spec(spec_path):
+    """
+    Read a queued plot specification.
+
+    :param spec_path:
+        The path of the queued specification.
+
+    :returns:
+        A three-length tuple containing the dotted path of the plotting function, the figure path, and
+        the keyword arguments for the plotting function.
+    """
+    with np.load(spec_path, allow_pickle=False) as data:
+        spec = _read_spec(data)
+        kwargs = spec["kwargs"]
+        kwargs.update({key: data[key] for key in spec["arrays"]})
+        kwargs.update({key: [data[f"{key}.{i}"] for i in range(n)] for key, n in spec["sequences"].items()})
+    return (spec["function"], spec["path"], kwargs)
+
+
+def save_or_defer_plot(function, path, defer=True, queue_dir=None, **kwargs):
+    """
+    Defer a figure to the plot queue, or render and save it now.
+
+    :param function:
+        The plotting function, or its dotted path.
+
+    :param path:
+        The path to save the figure to.
+
+    :param defer: [optional]
+        Defer the figure to the plot queue (default: `True`). Otherwise, render and save it now.
+
+    :param queue_dir: [optional]
+        The queue directory.
+    """
+    if defer:
+        return defer_plot(function, path, queue_dir=queue_dir, **kwargs)
+    return _render(callable(function), expand_path(path), kwargs)
+
+
+def _render(function, path, kwargs):
+    import matplotlib.pyplot as plt
+
+    fig = function(**kwargs)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fig.savefig(path)
+    plt.close(fig)
+    return path
+
+
+def _render_plot_specs(spec_paths, keep=False):
+    import matplotlib
+    matplotlib.use("Agg")
+
+    results = []
+    for spec_path in spec_paths:
+        try:
+            function, path, kwargs = read_plot_spec(spec_path)
+            _render(callable(function), path, kwargs)
+        except Exception as e:
+            results.append((spec_path, f"{type(e).__name__}: {e}"))
+        else:
+            if not keep:
+                os.unlink(spec_path)
+            results.append((spec_path, None))
+    return results
+
+
+def render_plots(queue_dir=None, pattern=None, limit=None, max_workers=1, batch_size=16, keep=False):
+    """
+    Render queued figures.
+
+    :param queue_dir: [optional]
+        The queue directory.
+
+    :param pattern: [optional]
+        Only render figures with paths that match this shell-style pattern (e.g., `*/snow_white/*`).
+
+    :param limit: [optional]
+        The maximum number of figures to render.
+
+    :param max_workers: [optional]
+        The number of processes to render figures with.
+
+    :param batch_size: [optional]
+        The number of figures to send to each worker at once.
+
+    :param keep: [optional]
+        Keep the specifications in the queue after rendering them. By default, rendered specifications
+        are removed, and specifications that failed to render are kept.
+
+    :returns:
+        A two-length tuple containing the number of figures rendered, and the number that failed.
+    """
+    spec_paths = sorted(glob(os.path.join(get_plot_queue_dir(queue_dir), "*.npz")))
+    if pattern is not None:
+        spec_paths = [p for p in spec_paths if fnmatch(_read_plot_path(p), pattern)]
+    spec_paths = spec_paths[:limit]
+
+    batches = [spec_paths[i:i + batch_size] for i in range(0, len(spec_paths), batch_size)]
+    if max_workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers)
+        futures = [executor.submit(_render_plot_specs, batch, keep) for batch in batches]
+        results = (future.result() for future in concurrent.futures.as_completed(futures))
+    else:
+        executor = None
+        results = (_render_plot_specs(batch, keep) for batch in batches)
+
+    n_rendered, n_failed = (0, 0)
+    with tqdm(total=len(spec_paths), desc="Rendering", unit="figures") as pb:
+        for result in results:
+            for spec_path, error in result:
+                if error is None:
+                    n_rendered += 1
+                else:
+                    n_failed += 1
+                    log.warning(f"Could not render {spec_path}: {error}")
+            pb.update(len(result))
+
+    if executor is not None:
+        executor.shutdown()
+    return (n_rendered, n_failed)
@@ -0,0 +1,26 @@
+import pytest
+from peewee import SqliteDatabase, BigBitField
+
+
+@pytest.fixture
+def sqlite_database():
+    """
+    Return a function that binds models to a new in-memory SQLite database, and creates their tables.
+    """
+    database = SqliteDatabase(":memory:")
+    bound = []
+
+    def bind(*models):
+        from astra.models.source import Source
+        # `Source.sdss5_target_flags` is only defined when Astra is configured with PostgreSQL.
+        if Source in models and "sdss5_target_flags" not in Source._meta.fields:
+            Source._meta.add_field("sdss5_target_flags", BigBitField(null=True))
+        bound.extend([(model, model._meta.database) for model in models])
+        database.bind(models)
+        database.create_tables(models)
+        return database
+
+    yield bind
+    for model, previous in bound:
+        model._meta.set_database(previous)
+    database.close()
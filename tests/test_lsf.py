@@ -0,0 +1,64 @@
+import numpy as np
+from scipy import sparse
+
+from astra.specutils.lsf import (
+    instrument_lsf_kernel,
+    instrument_lsf_dense_matrix,
+    instrument_lsf_sparse_matrix,
+    rotational_broadening_sparse_matrix,
+)
+
+
+def per_pixel_instrument_lsf_dense_matrix(λ_input, λ_output, R, **kwargs):
+    # The previous construction, with one kernel per output pixel.
+    K = np.zeros((λ_input.size, λ_output.size), dtype=float)
+    for o, λ in enumerate(λ_output):
+        mask, ϕ = instrument_lsf_kernel(λ_input, λ, R, **kwargs)
+        K[mask, o] += ϕ
+    return K
+
+
+def per_pixel_rotational_broadening_sparse_matrix(λ, vsini, epsilon):
+    # The previous construction, with one kernel per pixel.
+    denominator = np.pi * vsini * (1.0 - epsilon / 3.0)
+    c1 = 2.0 * (1.0 - epsilon) / denominator
+    c2 = 0.5 * np.pi * epsilon / denominator
+
+    vsini_c = vsini / 299792.458
+    scale = vsini_c / (λ[1] - λ[0])
+    N = λ.size
+
+    data, row_index, col_index = ([], [], [])
+    for i, λ_i in enumerate(λ):
+        n_pix = int(np.ceil(λ_i * scale))
+        si, ei = (max(0, i - n_pix), min(i + n_pix + 1, N))
+        λ_ratio_sq = ((λ[si:ei] - λ_i) / (λ_i * vsini_c))**2.0
+        with np.errstate(invalid="ignore"):
+            ϕ = c1 * np.sqrt(1.0 - λ_ratio_sq) + c2 * (1.0 - λ_ratio_sq)
+        ϕ[λ_ratio_sq >= 1.0] = 0.0
+        ϕ /= np.sum(ϕ)
+        data.extend(ϕ)
+        row_index.extend(range(si, ei))
+        col_index.extend([i] * (ei - si))
+    return sparse.csr_matrix((data, (row_index, col_index)), shape=(N, N))
+
+
+def test_instrument_lsf_matrices_match_per_pixel_kernels():
+    λ_output = 10**(4.179 + 6e-6 * np.arange(500))
+    λ_input = np.arange(λ_output[0] - 5, λ_output[-1] + 5, 0.05)
+
+    for R, σ_window in ((22_500, 5), (5_000, 3)):
+        expected = per_pixel_instrument_lsf_dense_matrix(λ_input, λ_output, R, σ_window=σ_window)
+        dense = instrument_lsf_dense_matrix(λ_input, λ_output, R, σ_window=σ_window)
+        K = instrument_lsf_sparse_matrix(λ_input, λ_output, R, σ_window=σ_window)
+        assert np.allclose(dense, expected, rtol=1e-12, atol=1e-15)
+        assert np.allclose(K.toarray(), expected, rtol=1e-12, atol=1e-15)
+        assert K.nnz == np.count_nonzero(expected)
+
+
+def test_rotational_broadening_matches_per_pixel_kernels():
+    λ = np.arange(15_100, 15_130, 0.01)
+    for vsini, epsilon in ((10, 0.6), (50, 0.3)):
+        expected = per_pixel_rotational_broadening_sparse_matrix(λ, vsini, epsilon)
+        K = rotational_broadening_sparse_matrix(λ, vsini, epsilon)
+        assert np.allclose(K.toarray(), expected.toarray(), rtol=1e-12, atol=1e-15)
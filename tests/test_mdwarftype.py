@@ -0,0 +1,46 @@
+import numpy as np
+
+from astra.pipelines.mdwarftype.templates import TemplateBank
+
+
+def make_bank_and_spectra(N_templates=7, N_spectra=5, N_pixels=400, seed=0):
+    rng = np.random.default_rng(seed)
+    template_flux = rng.uniform(0.5, 1.5, (N_templates, N_pixels))
+    # Templates do not cover the full wavelength range.
+    for i, (si, ei) in enumerate(rng.integers(0, 50, (N_templates, 2))):
+        template_flux[i, :si] = np.nan
+        template_flux[i, N_pixels - ei:] = np.nan
+    types = [("M", str(i)) for i in range(N_templates)]
+
+    flux = rng.uniform(0.5, 1.5, (N_spectra, N_pixels))
+    ivar = rng.uniform(1, 100, (N_spectra, N_pixels))
+    flux[rng.uniform(size=flux.shape) < 0.05] = np.nan
+    ivar[rng.uniform(size=ivar.shape) < 0.05] = np.nan
+    return (TemplateBank(template_flux, types), flux, ivar)
+
+
+def test_chi2_matches_nansum_per_spectrum():
+    bank, flux, ivar = make_bank_and_spectra()
+    chi2, scale = bank.chi2(flux, ivar)
+
+    # The previous implementation, one spectrum at a time.
+    expected = np.array([np.nansum((f - bank.flux)**2 * v, axis=1) for f, v in zip(flux, ivar)])
+    assert np.allclose(chi2, expected, rtol=1e-10, atol=1e-8)
+    assert np.all(scale == 1)
+    assert np.all(np.argmin(chi2, axis=1) == np.argmin(expected, axis=1))
+
+
+def test_chi2_with_fit_scale_matches_nansum_per_spectrum():
+    bank, flux, ivar = make_bank_and_spectra(seed=1)
+    chi2, scale = bank.chi2(flux, ivar, fit_scale=True)
+
+    expected_scale = np.array([
+        np.nansum(v * f * bank.flux, axis=1) / np.nansum(v * np.isfinite(f) * bank.flux**2, axis=1)
+        for f, v in zip(flux, ivar)
+    ])
+    expected = np.array([
+        np.nansum((f - a[:, None] * bank.flux)**2 * v, axis=1)
+        for f, v, a in zip(flux, ivar, expected_scale)
+    ])
+    assert np.allclose(scale, expected_scale, rtol=1e-10)
+    assert np.allclose(chi2, expected, rtol=1e-8, atol=1e-8)
@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+from peewee import chunked
+
+from astra.models.source import Source
+from astra.models.spectrum import Spectrum
+from astra.migrations.utils import (
+    update_from_staging_table,
+    reserve_spectrum_pks,
+    generate_new_spectrum_pks,
+    enumerate_new_spectrum_pks,
+)
+
+
+FIELDS = (Source.w1_mag, Source.gaia_dr3_source_id, Source.v_jkc_mag_flag, Source.ph_qual)
+
+
+def source_rows():
+    q = Source.select(Source.pk, Source.sdss_id, *FIELDS).order_by(Source.pk).tuples()
+    return list(q)
+
+
+@pytest.fixture
+def sources(sqlite_database):
+    sqlite_database(Source)
+    N = 1_200
+    Source.insert_many(
+        [(pk, 10 * pk, 1.0) for pk in range(1, N + 1)],
+        fields=[Source.pk, Source.sdss_id, Source.w1_mag]
+    ).execute()
+    rng = np.random.default_rng(0)
+    pks = rng.choice(np.arange(1, N + 1), 1_000, replace=False)
+    w1_mag = rng.uniform(5, 15, pks.size)
+    columns = dict(
+        w1_mag=np.array([None if i % 7 == 0 else v for i, v in enumerate(w1_mag.tolist())], dtype=object),
+        gaia_dr3_source_id=rng.integers(0, 2**60, pks.size),
+        v_jkc_mag_flag=rng.integers(0, 2, pks.size),
+        ph_qual=rng.choice(["AAA", "AAB", "ABC"], pks.size),
+    )
+    return (pks, columns)
+
+
+def bulk_update(pks, key, columns, batch_size=1_000):
+    # The previous approach: set attributes on each instance and use `Model.bulk_update`.
+    instances = { getattr(s, key.name): s for s in Source.select().where(key.in_(pks.tolist())) }
+    for i, pk in enumerate(pks.tolist()):
+        for name, values in columns.items():
+            value = values[i]
+            setattr(instances[pk], name, value.item() if isinstance(value, np.generic) else value)
+    Source.bulk_update(list(instances.values()), fields=list(columns.keys()), batch_size=batch_size)
+
+
+@pytest.mark.parametrize("key", [None, Source.sdss_id])
+def test_update_from_staging_table_matches_bulk_update(sources, key):
+    pks, columns = sources
+    if key is not None:
+        pks = 10 * pks
+    original = source_rows()
+
+    bulk_update(pks, key or Source.pk, columns)
+    expected = source_rows()
+    assert expected != original
+
+    Source.delete().execute()
+    Source.insert_many(original, fields=[Source.pk, Source.sdss_id, *FIELDS]).execute()
+
+    # A small batch size, so that the staging table is filled in several statements.
+    n_updated = update_from_staging_table(Source, pks, batch_size=300, key=key, **columns)
+    assert n_updated == pks.size
+    assert source_rows() == expected
+
+
+def test_update_from_staging_table_without_rows(sources):
+    assert update_from_staging_table(Source, [], w1_mag=[]) == 0
+
+
+def insert_spectrum_pks(N, batch_size=100):
+    # The previous approach: insert rows in batches and return their primary keys.
+    pks = []
+    for batch in chunked([{"spectrum_type_flags": 0}] * N, batch_size):
+        pks.extend(pk for pk, in Spectrum.insert_many(batch).returning(Spectrum.pk).tuples().execute())
+    return pks
+
+
+def test_reserve_spectrum_pks_matches_insert_many(sqlite_database):
+    sqlite_database(Spectrum)
+    expected = insert_spectrum_pks(250)
+    Spectrum.delete().execute()
+
+    assert reserve_spectrum_pks(0) == []
+    assert reserve_spectrum_pks(250) == expected
+    assert reserve_spectrum_pks(3) == [251, 252, 253]
+    pks = [pk for pk, in Spectrum.select(Spectrum.pk).order_by(Spectrum.pk).tuples()]
+    assert pks == list(range(1, 254))
+    assert Spectrum.select().where(Spectrum.spectrum_type_flags != 0).count() == 0
+
+
+def test_enumerate_new_spectrum_pks(sqlite_database):
+    sqlite_database(Spectrum)
+    insert_spectrum_pks(10)
+    items = ["a", "b", "c"]
+    assert list(enumerate_new_spectrum_pks(items)) == [(11, "a"), (12, "b"), (13, "c")]
+    assert list(generate_new_spectrum_pks(2)) == [14, 15]
+    assert Spectrum.select().count() == 15
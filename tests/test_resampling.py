@@ -0,0 +1,21 @@
+import numpy as np
+from scipy import interpolate
+
+from astra.specutils.resampling import cubic_spline_sparse_matrix
+
+
+def test_cubic_spline_sparse_matrix_matches_cubic_spline():
+    rng = np.random.default_rng(0)
+    λ_input = np.sort(rng.uniform(15_100, 15_200, 2_000))
+    flux = 1 + 0.1 * rng.normal(size=(3, λ_input.size))
+
+    # Includes output wavelengths outside the input range, which are extrapolated.
+    for λ_output in (
+        10**(4.179 + 6e-6 * np.arange(300)),
+        np.linspace(15_090, 15_210, 1_000),
+        np.linspace(15_150, 15_151, 10),
+    ):
+        K = cubic_spline_sparse_matrix(λ_input, λ_output)
+        expected = interpolate.CubicSpline(λ_input, flux, axis=1)(λ_output)
+        assert K.shape == (λ_input.size, λ_output.size)
+        assert np.allclose(flux @ K, expected, rtol=1e-9, atol=1e-9)
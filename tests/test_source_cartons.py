@@ -0,0 +1,55 @@
+import pytest
+
+from astra.models.source import Source, SourceCarton
+from astra.migrations.targeting import check_source_cartons, sync_source_cartons_from_bigbitfield
+
+
+def carton_bits(source_pk):
+    q = SourceCarton.select(SourceCarton.carton_bit).where(SourceCarton.source == source_pk).tuples()
+    return sorted(bit for bit, in q)
+
+
+@pytest.fixture
+def database(sqlite_database):
+    return sqlite_database(Source, SourceCarton)
+
+
+def test_save_updates_source_cartons(database):
+    source = Source.create(pk=1)
+    source.sdss5_target_flags.set_bit(3)
+    source.sdss5_target_flags.set_bit(10)
+    source.save()
+    assert carton_bits(1) == [3, 10]
+
+    source.sdss5_target_flags.clear_bit(3)
+    source.save()
+    assert carton_bits(1) == [10]
+    assert check_source_cartons() == []
+
+
+def test_carton_expression_agrees_with_python(database):
+    for pk, bits in ((1, [0, 5]), (2, [5]), (3, [])):
+        source = Source.create(pk=pk)
+        for bit in bits:
+            source.sdss5_target_flags.set_bit(bit)
+        source.save()
+
+    for bit in (0, 5, 7):
+        selected = [s.pk for s in Source.select().where(Source.is_sdss5_target_bit_set(bit)).order_by(Source.pk)]
+        expected = [s.pk for s in Source.select().order_by(Source.pk) if s.is_sdss5_target_bit_set(bit)]
+        assert selected == expected
+
+
+def test_sync_source_cartons_from_bigbitfield(database):
+    Source.create(pk=1)
+    Source.create(pk=2)
+    SourceCarton.insert(carton_bit=4, source=2).execute()
+
+    # Flags written without `Source.save` leave the link table stale.
+    Source.update(sdss5_target_flags=bytes([0b11])).where(Source.pk == 1).execute()
+    assert check_source_cartons() == [1, 2]
+
+    assert sync_source_cartons_from_bigbitfield() == 2
+    assert check_source_cartons() == []
+    assert carton_bits(1) == [0, 1]
+    assert carton_bits(2) == []
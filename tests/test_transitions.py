@@ -0,0 +1,42 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip("grok")
+
+from grok.transitions.table import TransitionTable, get_species_columns
+from grok.transitions.vald import write_vald, write_vald_table
+
+
+@pytest.fixture
+def table():
+    N = 200
+    rng = np.random.default_rng(0)
+    representations = np.array(["Fe 0", "Fe 1", "Ti 0", "Ca 1", "OH 0", "CN 0", "TiO 0"])
+    species = get_species_columns(representations)
+    index = rng.integers(0, representations.size, N)
+    E_lower = rng.uniform(0, 8, N)
+    return TransitionTable.from_columns(
+        lambda_air=rng.uniform(15_000, 17_000, N),
+        log_gf=rng.uniform(-5, 1, N),
+        E_lower=E_lower,
+        E_upper=E_lower + rng.uniform(0, 10, N),
+        j_upper=rng.integers(0, 10, N) / 2,
+        # Includes damping constants that are given directly, and as log10 values.
+        gamma_rad=np.where(rng.uniform(size=N) < 0.5, rng.uniform(6, 9, N), 10**rng.uniform(6, 9, N)),
+        gamma_stark=rng.uniform(-7, -4, N),
+        vdW=rng.uniform(-8, -7, N),
+        **{k: v[index] for k, v in species.items()}
+    )
+
+
+def test_write_vald_table_matches_write_vald(table, tmp_path):
+    write_vald(table.to_transitions(), os.path.join(tmp_path, "transitions"))
+    write_vald_table(table, os.path.join(tmp_path, "table"))
+
+    with open(os.path.join(tmp_path, "transitions")) as fp:
+        expected = fp.read()
+    with open(os.path.join(tmp_path, "table")) as fp:
+        actual = fp.read()
+    assert len(expected.splitlines()) == len(table) + 3
+    assert actual.splitlines() == expected.splitlines()